@@ -1,3 +1,4 @@
+import os
 import sys
 import asyncio
 import logging
@@ -5,7 +6,17 @@ import argparse
 import socket
 import signal
 
-from . import IRC, Server
+from . import IRC, Server, snapshot, upgrade, metrics
+from .history import History
+from .accounts import SQLiteAccountStore
+from .journal import Journal
+from .filter import Filter
+from .clones import CloneIndex, CLONE_LIMIT, CIDR_LIMIT
+from .ident import IdentResolver, IDENT_TIMEOUT
+from .flood import FloodControl, FLOOD_BURST, FLOOD_RATE
+from .sched import LINK_WEIGHT
+from .net import PROCESS_MODES, PROCESS_QUEUE
+from .watchdog import Watchdog
 
 logging.basicConfig(
     level=logging.DEBUG,
@@ -34,15 +45,49 @@ async def resolve_address(host, port):
 
 async def main(args):
     addr, port = args.listen
-    irc = IRC(args.host)
-    server = Server(irc)
+    history = History(backend=Journal(args.history_dir)) if args.history_dir else None
+    accounts = SQLiteAccountStore(args.accounts_db) if args.accounts_db else None
+    content_filter = Filter(args.filters) if args.filters else None
+    clones = CloneIndex(limit=args.clone_limit, cidr_limit=args.clone_cidr_limit, classes=args.clone_class or ())
+    irc = IRC(args.host, history=history, accounts=accounts, opers=args.oper, filter=content_filter, clones=clones,
+              broadcast_threshold=args.broadcast_threshold)
+    flood = FloodControl(burst=args.flood_burst, rate=args.flood_rate)
+    ident = IdentResolver(timeout=args.ident_timeout) if args.ident else None
+    server = Server(irc, flood=flood, link_weight=args.link_weight, mode=args.process, ident=ident)
+    loop = asyncio.get_running_loop()
+
+    takeover = upgrade.receive(irc, args.takeover) if args.takeover else None
+
+    if args.watchdog:
+        Watchdog(server, threshold=args.watchdog).start()
+
+    if args.metrics:
+        loop.create_task(metrics.serve(irc.metrics, args.metrics[0], args.metrics[1]))
+
+    if args.snapshot:
+        if not takeover:
+            snapshot.load(irc, args.snapshot)
+        loop.create_task(snapshot.periodic(irc, args.snapshot, args.snapshot_interval))
+        loop.add_signal_handler(signal.SIGUSR1, lambda: asyncio.create_task(snapshot.save(irc, args.snapshot)))
 
     async def _shutdown():
         log.info("shutdown")
+        if args.snapshot:
+            await snapshot.save(irc, args.snapshot)
         await server.shutdown()
 
+    async def _upgrade():
+        try:
+            await upgrade.handoff(server)
+        except upgrade.UpgradeError as e:
+            log.error("upgrade failed: %s", e)
+            return
+        logging.shutdown()
+        os._exit(0)
+
     for sig in (signal.SIGHUP, signal.SIGINT, signal.SIGTERM):
-        asyncio.get_running_loop().add_signal_handler(sig, lambda: asyncio.create_task(_shutdown()))
+        loop.add_signal_handler(sig, lambda: asyncio.create_task(_shutdown()))
+    loop.add_signal_handler(signal.SIGUSR2, lambda: asyncio.create_task(_upgrade()))
 
     await server.run(
         client_listen_addr=args.listen[0],
@@ -53,6 +98,7 @@ async def main(args):
         peer_port=args.peer[1] if args.peer else None,
         ws_addr=args.ws[0] if args.ws else None,
         ws_port=args.ws[1] if args.ws else None,
+        takeover=takeover,
     )
 
 
@@ -63,6 +109,27 @@ if __name__ == "__main__":
     parser.add_argument("--link", help="link address", type=parse_address, default=LINK_LISTEN_ADDRESS)
     parser.add_argument("--peer", help="peer address", type=parse_address)
     parser.add_argument("--ws", help="websocket listen address", type=parse_address)
+    parser.add_argument("--metrics", help="prometheus metrics listen address", type=parse_address)
+    parser.add_argument("--history-dir", help="persist channel history to this directory")
+    parser.add_argument("--accounts-db", help="sqlite database of registered accounts")
+    parser.add_argument("--filters", help="content filter rules, reloaded by REHASH")
+    parser.add_argument("--oper", help="account allowed to use OPER, may be repeated", action="append")
+    parser.add_argument("--snapshot", help="snapshot file to restore from and periodically save to")
+    parser.add_argument("--snapshot-interval", help="seconds between snapshots", type=int, default=snapshot.SNAPSHOT_INTERVAL)
+    parser.add_argument("--flood-burst", help="commands a client may send at once", type=int, default=FLOOD_BURST)
+    parser.add_argument("--flood-rate", help="commands per second a client may sustain", type=float, default=FLOOD_RATE)
+    parser.add_argument("--clone-limit", help="connections allowed per address, 0 for no limit", type=int, default=CLONE_LIMIT)
+    parser.add_argument("--clone-cidr-limit", help="connections allowed per /24 or /64", type=int, default=CIDR_LIMIT)
+    parser.add_argument("--clone-class", help="NETWORK=LIMIT connections per address in network, may be repeated",
+                        action="append")
+    parser.add_argument("--ident", help="look up usernames with RFC 1413 ident", action="store_true")
+    parser.add_argument("--ident-timeout", help="seconds to wait for an ident reply", type=float, default=IDENT_TIMEOUT)
+    parser.add_argument("--broadcast-threshold", help="deliver to channels with this many members through a shared log",
+                        type=int)
+    parser.add_argument("--link-weight", help="share of processing given to server links", type=int, default=LINK_WEIGHT)
+    parser.add_argument("--process", help="how inbound messages are processed", choices=PROCESS_MODES, default=PROCESS_QUEUE)
+    parser.add_argument("--watchdog", help="log the loop's stack when it blocks for this many seconds", type=float)
+    parser.add_argument("--takeover", help=argparse.SUPPRESS)
     parser.add_argument("--verbose", help="verbose mode", action="store_true")
     args = parser.parse_args(sys.argv[1:])
 
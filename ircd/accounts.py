@@ -0,0 +1,311 @@
+import os
+import hmac
+import time
+import base64
+import sqlite3
+import getpass
+import asyncio
+import hashlib
+import logging
+import argparse
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+log = logging.getLogger(__name__)
+
+ITERATIONS = 100000
+SALT_BYTES = 16
+NONCE_BYTES = 18
+VERIFY_WORKERS = 4
+# verifications queued or running across the server
+MAX_PENDING = 64
+CACHE_SIZE = 1024
+# seconds a verified password is trusted without checking it again
+CACHE_TTL = 300
+
+MECHANISMS = ("PLAIN", "SCRAM-SHA-256")
+
+
+def _hmac(key, msg):
+    return hmac.new(key, msg, hashlib.sha256).digest()
+
+
+def _h(msg):
+    return hashlib.sha256(msg).digest()
+
+
+def _xor(a, b):
+    return bytes(x ^ y for x, y in zip(a, b))
+
+
+class Credentials:
+    """
+    Salted PBKDF2-SHA256 credentials kept in the form SCRAM-SHA-256 needs, which PLAIN can verify against too.
+    """
+    __slots__ = ("salt", "iterations", "stored_key", "server_key")
+
+    def __init__(self, salt, iterations, stored_key, server_key):
+        self.salt = salt
+        self.iterations = iterations
+        self.stored_key = stored_key
+        self.server_key = server_key
+
+    @staticmethod
+    def salted_password(password, salt, iterations):
+        return hashlib.pbkdf2_hmac("sha256", password.encode(), salt, iterations)
+
+    @classmethod
+    def create(cls, password, iterations=ITERATIONS):
+        salt = os.urandom(SALT_BYTES)
+        salted = cls.salted_password(password, salt, iterations)
+        return cls(salt, iterations, _h(_hmac(salted, b"Client Key")), _hmac(salted, b"Server Key"))
+
+    def verify(self, password):
+        salted = self.salted_password(password, self.salt, self.iterations)
+        return hmac.compare_digest(_h(_hmac(salted, b"Client Key")), self.stored_key)
+
+    def to_tuple(self):
+        return self.salt, self.iterations, self.stored_key, self.server_key
+
+
+class AccountStore:
+    """
+    In memory account store, verification is done on a bounded thread pool with recent successes cached for
+    cache_ttl seconds, so a password changed by another process stops working within that time.
+    """
+    def __init__(self, workers=VERIFY_WORKERS, cache_size=CACHE_SIZE, cache_ttl=CACHE_TTL, max_pending=MAX_PENDING):
+        self.accounts = {}
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ircd-verify")
+        self.max_pending = max_pending
+        self.pending = 0
+        self.cache_size = cache_size
+        self.cache_ttl = cache_ttl
+        # (name, keyed hash of the password) -> expiry
+        self.cache = OrderedDict()
+        self.cache_key = os.urandom(32)
+
+    def __len__(self):
+        return len(self.accounts)
+
+    def get(self, name):
+        return self.accounts.get(name)
+
+    def set(self, name, credentials):
+        self.accounts[name] = credentials
+
+    def register(self, name, password, iterations=ITERATIONS):
+        self.set(name, Credentials.create(password, iterations=iterations))
+        for key in [key for key in self.cache if key[0] == name]:
+            del self.cache[key]
+
+    def dump(self):
+        return {name: credentials.to_tuple() for name, credentials in self.accounts.items()}
+
+    def load(self, accounts):
+        for name, fields in accounts.items():
+            self.set(name, Credentials(*fields))
+
+    def verify(self, name, password):
+        credentials = self.get(name)
+        return credentials is not None and credentials.verify(password)
+
+    def verify_async(self, name, password, callback):
+        """
+        Verifies a password off the event loop and calls back on it with the result. Returns False without
+        calling back when max_pending verifications are already queued.
+        """
+        key = (name, _hmac(self.cache_key, password.encode()))
+        expires = self.cache.get(key)
+        if expires is not None:
+            if expires > time.monotonic():
+                self.cache.move_to_end(key)
+                callback(True)
+                return True
+            del self.cache[key]
+
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            callback(self.verify(name, password))
+            return True
+
+        if self.pending >= self.max_pending:
+            return False
+        self.pending += 1
+
+        def _done(future):
+            self.pending -= 1
+            valid = not future.exception() and future.result()
+            if valid:
+                self.cache[key] = time.monotonic() + self.cache_ttl
+                if len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+            callback(valid)
+
+        future = asyncio.wrap_future(self.executor.submit(self.verify, name, password), loop=loop)
+        future.add_done_callback(_done)
+        return True
+
+    def get_async(self, name, callback):
+        """
+        Looks up an account off the event loop and calls back on it with its credentials or None. Returns False
+        without calling back when max_pending lookups and verifications are already queued.
+        """
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            callback(self.get(name))
+            return True
+
+        if self.pending >= self.max_pending:
+            return False
+        self.pending += 1
+
+        def _done(future):
+            self.pending -= 1
+            callback(None if future.exception() else future.result())
+
+        future = asyncio.wrap_future(self.executor.submit(self.get, name), loop=loop)
+        future.add_done_callback(_done)
+        return True
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+
+class SQLiteAccountStore(AccountStore):
+    def __init__(self, path, **kwargs):
+        super(SQLiteAccountStore, self).__init__(**kwargs)
+        self.path = path
+        self.local = threading.local()
+        with self.connection as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS accounts (
+                    name TEXT PRIMARY KEY,
+                    salt BLOB NOT NULL,
+                    iterations INTEGER NOT NULL,
+                    stored_key BLOB NOT NULL,
+                    server_key BLOB NOT NULL
+                )
+            """)
+
+    @property
+    def connection(self):
+        # sqlite connections can't be shared between the loop and the verification threads
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = self.local.conn = sqlite3.connect(self.path)
+        return conn
+
+    def __len__(self):
+        return self.connection.execute("SELECT COUNT(*) FROM accounts").fetchone()[0]
+
+    def get(self, name):
+        row = self.connection.execute(
+            "SELECT salt, iterations, stored_key, server_key FROM accounts WHERE name = ?", (name,)
+        ).fetchone()
+        return Credentials(*row) if row else None
+
+    def set(self, name, credentials):
+        with self.connection as conn:
+            conn.execute("INSERT OR REPLACE INTO accounts VALUES (?, ?, ?, ?, ?)", (name,) + credentials.to_tuple())
+
+    def dump(self):
+        # already durable
+        return {}
+
+
+def _parse_attributes(s):
+    return dict(part.split("=", 1) for part in s.split(",") if "=" in part)
+
+
+class ScramExchange:
+    """
+    Server side of a SCRAM-SHA-256 exchange (RFC 5802, RFC 7677).
+    """
+    def __init__(self, store):
+        self.store = store
+        self.account = None
+        self.credentials = None
+        self.gs2_header = None
+        self.client_first_bare = None
+        self.server_first = None
+        self.nonce = None
+        self.verified = False
+        # the account is being looked up
+        self.looking_up = False
+
+    def client_first(self, data, callback):
+        """
+        Looks the account up off the event loop and calls back with the server-first message, None if the
+        client-first message is invalid.
+        """
+        parts = data.split(",", 2)
+        if len(parts) < 3 or parts[0] not in ("n", "y"):
+            callback(None)
+            return
+        self.gs2_header = parts[0] + "," + parts[1] + ","
+        self.client_first_bare = parts[2]
+
+        attributes = _parse_attributes(self.client_first_bare)
+        self.account = attributes.get("n", "").replace("=2C", ",").replace("=3D", "=")
+        client_nonce = attributes.get("r")
+        if not self.account or not client_nonce:
+            callback(None)
+            return
+
+        def _found(credentials):
+            self.looking_up = False
+            self.credentials = credentials
+            # unknown accounts still get a plausible challenge and fail at the end
+            salt, iterations = (credentials.salt, credentials.iterations) if credentials else \
+                (_hmac(self.store.cache_key, self.account.encode())[:SALT_BYTES], ITERATIONS)
+
+            self.nonce = client_nonce + base64.b64encode(os.urandom(NONCE_BYTES)).decode()
+            self.server_first = "r={},s={},i={}".format(self.nonce, base64.b64encode(salt).decode(), iterations)
+            callback(self.server_first)
+
+        self.looking_up = True
+        if not self.store.get_async(self.account, _found):
+            self.looking_up = False
+            callback(None)
+
+    def client_final(self, data):
+        without_proof, _, proof = data.rpartition(",p=")
+        attributes = _parse_attributes(without_proof)
+        if not self.credentials or attributes.get("r") != self.nonce:
+            return None
+        if attributes.get("c") != base64.b64encode(self.gs2_header.encode()).decode():
+            return None
+
+        try:
+            proof = base64.b64decode(proof)
+        except ValueError:
+            return None
+
+        auth_message = ",".join([self.client_first_bare, self.server_first, without_proof]).encode()
+        client_signature = _hmac(self.credentials.stored_key, auth_message)
+        client_key = _xor(proof, client_signature)
+        if len(proof) != len(client_signature) or not hmac.compare_digest(_h(client_key), self.credentials.stored_key):
+            return None
+
+        self.verified = True
+        return "v=" + base64.b64encode(_hmac(self.credentials.server_key, auth_message)).decode()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="manage ircd accounts")
+    parser.add_argument("db", help="account database")
+    parser.add_argument("name", help="account name")
+    args = parser.parse_args()
+
+    password = getpass.getpass("password for {}: ".format(args.name))
+    store = SQLiteAccountStore(args.db)
+    store.register(args.name, password)
+    store.close()
+    print("registered {}".format(args.name))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,355 @@
+"""
+Load generator, runs simulated clients against a server and reports throughput, delivery latency and server
+resource use as JSON.
+
+    python -m ircd.bench --clients 500 --channels 50 --rate 5000 --duration 30
+    python -m ircd.bench --spawn --clients 100
+    python -m ircd.bench --connect 127.0.0.1:9999 --pid 1234
+"""
+import os
+import sys
+import json
+import time
+import random
+import socket
+import asyncio
+import logging
+import argparse
+import resource
+import subprocess
+
+from ircd.irc import IRC
+from ircd.net import Server
+from ircd.flood import FloodControl
+
+log = logging.getLogger(__name__)
+
+HOST = "bench"
+CLIENTS = 100
+CHANNELS = 10
+JOINS = 2
+RATE = 1000
+DURATION = 10
+TICK = .01
+CONNECT_CONCURRENCY = 50
+REGISTER_TIMEOUT = 30
+DRAIN_TIMEOUT = 5
+ZIPF_EXPONENT = 1.1
+
+UNLIMITED = 1e12
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(p * len(values)))]
+
+
+def choose_channels(rng, channels, joins, distribution):
+    """
+    Picks the channels one client joins, zipf makes a few channels very large and most small.
+    """
+    joins = min(joins, len(channels))
+    if distribution == "uniform":
+        return rng.sample(channels, joins)
+
+    weights = [1 / (rank + 1) ** ZIPF_EXPONENT for rank in range(len(channels))]
+    chosen = []
+    while len(chosen) < joins:
+        channel = rng.choices(channels, weights)[0]
+        if channel not in chosen:
+            chosen.append(channel)
+    return chosen
+
+
+class ProcessStats:
+    """
+    CPU time and resident size of a process, read from /proc, or of ourselves when pid is None.
+    """
+    def __init__(self, pid=None):
+        self.pid = pid
+
+    def sample(self):
+        if self.pid is None:
+            usage = resource.getrusage(resource.RUSAGE_SELF)
+            with open("/proc/self/statm") as f:
+                rss = int(f.read().split()[1]) * resource.getpagesize()
+            return usage.ru_utime + usage.ru_stime, rss
+
+        with open("/proc/{}/stat".format(self.pid)) as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        ticks = os.sysconf("SC_CLK_TCK")
+        cpu = (int(fields[11]) + int(fields[12])) / ticks
+        with open("/proc/{}/statm".format(self.pid)) as f:
+            rss = int(f.read().split()[1]) * resource.getpagesize()
+        return cpu, rss
+
+
+class BenchClient:
+    def __init__(self, bench, index, channels):
+        self.bench = bench
+        self.index = index
+        self.nickname = "bench{}".format(index)
+        self.channels = channels
+        self.reader = None
+        self.writer = None
+        self.registered = asyncio.Event()
+        self.pending_joins = set(channels)
+        self.joined = asyncio.Event()
+
+    async def connect(self, host, port):
+        self.reader, self.writer = await asyncio.open_connection(host, port)
+        self.writer.write(
+            "CAP REQ :message-tags\r\nNICK {0}\r\nUSER {0} 0 * :{0}\r\n".format(self.nickname).encode())
+        asyncio.create_task(self.read())
+        await self.registered.wait()
+        self.writer.write("".join("JOIN {}\r\n".format(channel) for channel in self.channels).encode())
+        if self.channels:
+            await self.joined.wait()
+        else:
+            self.joined.set()
+
+    def send(self, channel, tagmsg=False):
+        stamp = time.perf_counter_ns()
+        if tagmsg:
+            line = "@+bench={} TAGMSG {}\r\n".format(stamp, channel)
+        else:
+            line = "PRIVMSG {} :bench {}\r\n".format(channel, stamp)
+        self.writer.write(line.encode())
+
+    async def read(self):
+        bench = self.bench
+        while True:
+            try:
+                line = await self.reader.readline()
+            except ConnectionError:
+                break
+            if not line:
+                break
+
+            now = time.perf_counter_ns()
+            if b" PRIVMSG " in line:
+                bench.received(now - int(line.rsplit(b" ", 1)[1]))
+            elif b" TAGMSG " in line and line.startswith(b"@"):
+                tags = dict(tag.split(b"=", 1) for tag in line[1:line.index(b" ")].split(b";") if b"=" in tag)
+                if b"+bench" in tags:
+                    bench.received(now - int(tags[b"+bench"]))
+            elif b" 001 " in line:
+                self.registered.set()
+            elif b" 366 " in line:
+                self.pending_joins.discard(line.split()[3].decode())
+                if not self.pending_joins:
+                    self.joined.set()
+            elif line.startswith(b"ERROR"):
+                log.warning("%s: %s", self.nickname, line.decode().strip())
+                break
+
+    def close(self):
+        if self.writer:
+            self.writer.close()
+
+
+class Bench:
+    def __init__(self, clients=CLIENTS, channels=CHANNELS, joins=JOINS, distribution="uniform", rate=RATE,
+                 duration=DURATION, tagmsg_ratio=0, seed=0):
+        self.num_clients = clients
+        self.num_channels = channels
+        self.joins = joins
+        self.distribution = distribution
+        self.rate = rate
+        self.duration = duration
+        self.tagmsg_ratio = tagmsg_ratio
+        self.rng = random.Random(seed)
+
+        self.clients = []
+        self.sent = 0
+        self.send_elapsed = 0
+        self.expected = 0
+        self.latencies = []
+        self.channel_sizes = {}
+
+    def received(self, latency_ns):
+        self.latencies.append(latency_ns)
+
+    def config(self):
+        return {
+            "clients": self.num_clients,
+            "channels": self.num_channels,
+            "joins": self.joins,
+            "distribution": self.distribution,
+            "rate": self.rate,
+            "duration": self.duration,
+            "tagmsg_ratio": self.tagmsg_ratio,
+        }
+
+    async def setup(self, host, port):
+        channels = ["#bench{}".format(i) for i in range(self.num_channels)]
+        for i in range(self.num_clients):
+            chosen = choose_channels(self.rng, channels, self.joins, self.distribution)
+            for channel in chosen:
+                self.channel_sizes[channel] = self.channel_sizes.get(channel, 0) + 1
+            self.clients.append(BenchClient(self, i, chosen))
+
+        semaphore = asyncio.Semaphore(CONNECT_CONCURRENCY)
+
+        async def _connect(client):
+            async with semaphore:
+                await client.connect(host, port)
+
+        await asyncio.wait_for(asyncio.gather(*[_connect(client) for client in self.clients]), REGISTER_TIMEOUT)
+
+    async def load(self):
+        senders = [client for client in self.clients if client.channels]
+        if not senders:
+            return
+
+        start = time.perf_counter()
+        i = 0
+        while time.perf_counter() - start < self.duration:
+            await asyncio.sleep(TICK)
+            # catch up to where the target rate says we should be, sleep overshoots
+            due = int((time.perf_counter() - start) * self.rate)
+            while i < due:
+                client = senders[i % len(senders)]
+                channel = client.channels[(i // len(senders)) % len(client.channels)]
+                tagmsg = self.rng.random() < self.tagmsg_ratio
+                client.send(channel, tagmsg=tagmsg)
+                self.sent += 1
+                self.expected += self.channel_sizes[channel] - 1
+                i += 1
+
+        self.send_elapsed = time.perf_counter() - start
+        deadline = time.perf_counter() + DRAIN_TIMEOUT
+        while len(self.latencies) < self.expected and time.perf_counter() < deadline:
+            await asyncio.sleep(TICK)
+
+    async def run(self, host, port, stats):
+        await self.setup(host, port)
+        cpu_before, _ = stats.sample()
+        start = time.perf_counter()
+        await self.load()
+        elapsed = time.perf_counter() - start
+        cpu_after, rss = stats.sample()
+
+        for client in self.clients:
+            client.close()
+        return self.report(elapsed, cpu_after - cpu_before if cpu_before is not None else None, rss)
+
+    def report(self, elapsed, cpu, rss):
+        latencies = sorted(self.latencies)
+
+        def ms(value):
+            return value / 1e6 if value is not None else None
+
+        return {
+            "config": self.config(),
+            "sent": self.sent,
+            "expected": self.expected,
+            "delivered": len(latencies),
+            "elapsed": elapsed,
+            "send_rate": self.sent / self.send_elapsed if self.send_elapsed else 0,
+            "throughput": len(latencies) / elapsed if elapsed else 0,
+            "latency_ms": {
+                "p50": ms(percentile(latencies, .5)),
+                "p99": ms(percentile(latencies, .99)),
+                "p999": ms(percentile(latencies, .999)),
+                "max": ms(latencies[-1] if latencies else None),
+            },
+            "server": {
+                "rss_bytes": rss,
+                "cpu_seconds": cpu,
+                "cpu_us_per_message": cpu / self.sent * 1e6 if self.sent and cpu is not None else None,
+            },
+        }
+
+
+class NullStats:
+    """
+    Stands in for a server that can't be measured, its CPU time and size are reported as unknown.
+    """
+    def sample(self):
+        return None, None
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def run_inprocess(bench):
+    """
+    Runs the server in this process and event loop, resource numbers include the simulated clients.
+    """
+    port = free_port()
+    irc = IRC(HOST)
+    server = Server(irc, flood=FloodControl(burst=UNLIMITED, rate=UNLIMITED, recvq=UNLIMITED))
+    asyncio.create_task(server.run("127.0.0.1", port))
+    await server.running.wait()
+    try:
+        return await bench.run("127.0.0.1", port, ProcessStats())
+    finally:
+        await server.shutdown()
+
+
+async def run_spawned(bench):
+    port = free_port()
+    proc = subprocess.Popen([
+        sys.executable, "-m", "ircd", "--host", HOST, "--listen", "127.0.0.1:{}".format(port),
+        "--link", "127.0.0.1:{}".format(free_port()),
+        "--flood-burst", str(int(UNLIMITED)), "--flood-rate", str(UNLIMITED),
+    ], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        for _ in range(100):
+            try:
+                socket.create_connection(("127.0.0.1", port)).close()
+                break
+            except OSError:
+                await asyncio.sleep(.1)
+        return await bench.run("127.0.0.1", port, ProcessStats(proc.pid))
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ircd load generator")
+    target = parser.add_mutually_exclusive_group()
+    target.add_argument("--connect", help="host:port of a running server")
+    target.add_argument("--spawn", help="start a server process to benchmark", action="store_true")
+    parser.add_argument("--pid", help="pid of the server given with --connect, for resource usage", type=int)
+    parser.add_argument("--clients", type=int, default=CLIENTS)
+    parser.add_argument("--channels", type=int, default=CHANNELS)
+    parser.add_argument("--joins", help="channels each client joins", type=int, default=JOINS)
+    parser.add_argument("--distribution", choices=("uniform", "zipf"), default="uniform")
+    parser.add_argument("--rate", help="messages per second across all clients", type=float, default=RATE)
+    parser.add_argument("--duration", help="seconds to send for", type=float, default=DURATION)
+    parser.add_argument("--tagmsg-ratio", help="fraction of messages sent as TAGMSG", type=float, default=0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    bench = Bench(clients=args.clients, channels=args.channels, joins=args.joins, distribution=args.distribution,
+                  rate=args.rate, duration=args.duration, tagmsg_ratio=args.tagmsg_ratio, seed=args.seed)
+
+    if args.connect:
+        host, port = args.connect.rsplit(":", 1)
+        stats = ProcessStats(args.pid) if args.pid else None
+        result = asyncio.run(bench.run(host, int(port), stats or NullStats()))
+    elif args.spawn:
+        result = asyncio.run(run_spawned(bench))
+    else:
+        result = asyncio.run(run_inprocess(bench))
+
+    result["mode"] = "connect" if args.connect else "spawn" if args.spawn else "inprocess"
+    output = json.dumps(result, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
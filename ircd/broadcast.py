@@ -0,0 +1,37 @@
+"""
+Delivery for large channels: a message is appended once to the channel's ring and every member's send queue
+reads it through its own cursor (see LaneQueue.subscribe), rather than each member queueing a reference to it.
+"""
+RING_SIZE = 4096
+SENDQ_EXCEEDED = "SendQ exceeded"
+
+
+class BroadcastLog:
+    __slots__ = ("size", "entries", "head", "waiting")
+
+    def __init__(self, size=RING_SIZE):
+        self.size = size
+        # (message, queue of the sender, who doesn't read it back)
+        self.entries = [None] * size
+        # sequence number of the next entry
+        self.head = 0
+        # subscribed queues waiting for something to read, woken by the next append
+        self.waiting = set()
+
+    @property
+    def tail(self):
+        """
+        Sequence number of the oldest entry still in the ring.
+        """
+        return max(0, self.head - self.size)
+
+    def append(self, message, skip=None):
+        self.entries[self.head % self.size] = (message, skip)
+        self.head += 1
+        if self.waiting:
+            for queue in self.waiting:
+                queue.ready.set()
+            self.waiting.clear()
+
+    def read(self, cursor):
+        return self.entries[cursor % self.size]
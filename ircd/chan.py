@@ -10,10 +10,18 @@ class Channel:
         self.name = name
         self.owner = owner
         self.key = key
+        self.limit = None
+        self.flood = None
+        # flags set by flood protection, cleared when the lock expires unless an operator changed them since
+        self.locked = set()
         self.topic = None
-        self.members = [owner]
-        self.operators = [owner]
+        # restored channels have no owner, joining one doesn't make anyone an operator
+        self.members = [owner] if owner else []
+        self.operators = [owner] if owner else []
+        self.voiced = []
         self.invited = []
+        # BroadcastLog once the channel is large enough, see IRC.send_to_channel
+        self.log = None
         self.mode = Mode.for_channel(self)
         self.bans = []
         self.exceptions = []
@@ -41,6 +49,13 @@ class Channel:
     def is_invite_only(self):
         return self.mode.has_flag(Mode.CHANNEL_IS_INVITE_ONLY)
 
+    @property
+    def is_moderated(self):
+        return self.mode.has_flag(Mode.CHANNEL_MODERATED)
+
+    def can_speak(self, nickname):
+        return not self.is_moderated or nickname in self.operators or nickname in self.voiced
+
     @property
     def is_private(self):
         return self.mode.has_flag(Mode.CHANNEL_IS_PRIVATE)
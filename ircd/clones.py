@@ -0,0 +1,206 @@
+"""
+Live connection counts per address and per network, checked before a connection gets a Client. Addresses in an
+allow-listed class have their own per address limit and are not counted against their network.
+
+    --clone-limit 8 --clone-cidr-limit 32 --clone-class 10.1.0.0/16=200
+"""
+import logging
+import ipaddress
+
+log = logging.getLogger(__name__)
+
+CLONE_LIMIT = 16
+CIDR_LIMIT = 64
+IPV4_PREFIX = 24
+IPV6_PREFIX = 64
+# local connections (bouncers, ircd.bench) are unlimited unless configured otherwise
+LOCAL_CLASSES = ("127.0.0.0/8=0", "::1/128=0")
+
+TOO_MANY_CONNECTIONS = "Too many connections from your host"
+
+
+class CloneClass:
+    __slots__ = ("network", "limit")
+
+    def __init__(self, network, limit):
+        self.network = network
+        # 0 or None is unlimited
+        self.limit = limit or None
+
+    @classmethod
+    def parse(cls, s):
+        """
+        NETWORK=LIMIT, e.g. 10.1.0.0/16=200
+        """
+        network, _, limit = s.partition("=")
+        return cls(ipaddress.ip_network(network.strip(), strict=False), int(limit) if limit else None)
+
+    def __repr__(self):
+        return "CloneClass({}={})".format(self.network, self.limit or "unlimited")
+
+
+class Bucket:
+    __slots__ = ("count", "keys", "lower", "higher")
+
+    def __init__(self, count):
+        self.count = count
+        self.keys = set()
+        self.lower = None
+        self.higher = None
+
+
+class CountIndex:
+    """
+    Counts per key with keys grouped into buckets of equal count, linked in count order. Counts only ever move by
+    one so a bucket's neighbour is found without searching, and the top k keys are read off the highest buckets.
+    """
+    def __init__(self):
+        self.buckets = {}
+        self.highest = None
+        self.lowest = None
+
+    def __len__(self):
+        return len(self.buckets)
+
+    def __getitem__(self, key):
+        bucket = self.buckets.get(key)
+        return bucket.count if bucket else 0
+
+    def _link(self, bucket, lower, higher):
+        bucket.lower, bucket.higher = lower, higher
+        if lower:
+            lower.higher = bucket
+        else:
+            self.lowest = bucket
+        if higher:
+            higher.lower = bucket
+        else:
+            self.highest = bucket
+
+    def _unlink(self, bucket):
+        if bucket.lower:
+            bucket.lower.higher = bucket.higher
+        else:
+            self.lowest = bucket.higher
+        if bucket.higher:
+            bucket.higher.lower = bucket.lower
+        else:
+            self.highest = bucket.lower
+
+    def _move(self, key, current, count, lower, higher):
+        if count:
+            if higher and higher.count == count:
+                target = higher
+            elif lower and lower.count == count:
+                target = lower
+            else:
+                target = Bucket(count)
+                self._link(target, lower, higher)
+            target.keys.add(key)
+            self.buckets[key] = target
+        else:
+            del self.buckets[key]
+
+        if current:
+            current.keys.discard(key)
+            if not current.keys:
+                self._unlink(current)
+
+    def increment(self, key):
+        current = self.buckets.get(key)
+        if current:
+            self._move(key, current, current.count + 1, current, current.higher)
+        else:
+            self._move(key, None, 1, None, self.lowest)
+
+    def decrement(self, key):
+        current = self.buckets.get(key)
+        if current:
+            self._move(key, current, current.count - 1, current.lower, current)
+
+    def top(self, n):
+        """
+        Up to n (key, count) pairs, highest count first.
+        """
+        results = []
+        bucket = self.highest
+        while bucket and len(results) < n:
+            for key in bucket.keys:
+                results.append((key, bucket.count))
+                if len(results) >= n:
+                    break
+            bucket = bucket.lower
+        return results
+
+
+class CloneIndex:
+    def __init__(self, limit=CLONE_LIMIT, cidr_limit=CIDR_LIMIT, ipv4_prefix=IPV4_PREFIX, ipv6_prefix=IPV6_PREFIX,
+                 classes=()):
+        self.limit = limit
+        self.cidr_limit = cidr_limit
+        self.prefixes = {4: ipv4_prefix, 6: ipv6_prefix}
+        # the most specific class wins
+        self.classes = sorted((CloneClass.parse(c) if isinstance(c, str) else c for c in (*classes, *LOCAL_CLASSES)),
+                              key=lambda c: c.network.prefixlen, reverse=True)
+        self.addresses = CountIndex()
+        self.networks = CountIndex()
+
+    def classify(self, address):
+        for clone_class in self.classes:
+            if address.version == clone_class.network.version and address in clone_class.network:
+                return clone_class
+        return None
+
+    def _parse(self, address):
+        try:
+            address = ipaddress.ip_address(address.split("%", 1)[0])
+        except ValueError:
+            return None, None, None
+        if address.version == 6 and address.ipv4_mapped:
+            address = address.ipv4_mapped
+        clone_class = self.classify(address)
+        network = None
+        if not clone_class:
+            network = ipaddress.ip_network((address, self.prefixes[address.version]), strict=False)
+        return str(address), network, clone_class
+
+    def admit(self, address):
+        """
+        Counts a new connection from address, False without counting it if that would go over a limit.
+        """
+        key, network, clone_class = self._parse(address)
+        if key is None:
+            return True
+
+        limit = clone_class.limit if clone_class else self.limit
+        if limit and self.addresses[key] >= limit:
+            return False
+        if network and self.cidr_limit and self.networks[network] >= self.cidr_limit:
+            return False
+
+        self.addresses.increment(key)
+        if network:
+            self.networks.increment(network)
+        return True
+
+    def add(self, address):
+        """
+        Counts a connection regardless of limits, for connections inherited from another process.
+        """
+        key, network, _ = self._parse(address)
+        if key is None:
+            return
+        self.addresses.increment(key)
+        if network:
+            self.networks.increment(network)
+
+    def release(self, address):
+        key, network, _ = self._parse(address)
+        if key is None:
+            return
+        self.addresses.decrement(key)
+        if network:
+            self.networks.decrement(network)
+
+    def top(self, n):
+        return self.addresses.top(n), self.networks.top(n)
@@ -1,51 +1,77 @@
+import time
 import logging
 import base64
 import binascii
-from functools import wraps
 
 from ircd.message import IRCMessage
 from ircd.common import IRCError
+from ircd.history import parse_reference
+from ircd.accounts import MECHANISMS, ScramExchange
+from ircd.net import Client
 
 log = logging.getLogger(__name__)
 
 
 def validate(nickname=False, identity=False, num_params=None):
+    """
+    Declares what a command requires, checked by Command.dispatch before the handler runs.
+    """
     def _validate(func):
-        @wraps(func)
-        def __validate(self, msg):
-            # log.debug("validate: %s", msg)
-            if (nickname and not self.client.has_nickname) or (identity and not self.client.has_identity):
-                self.irc.drop_client(self.client, "invalid")
-                return None
-
-            if num_params is not None and len(msg.args) < num_params:
-                raise IRCError(IRCMessage.error_needs_more_params(self.irc.host, self.client.name, msg.command))
-
-            return func(self, msg)
-        return __validate
+        func.requirements = (nickname, identity, num_params)
+        return func
     return _validate
 
 
+class Command:
+    def __init__(self, name, func, nickname=False, identity=False, num_params=None):
+        self.name = name
+        self.func = func
+        self.nickname = nickname
+        self.identity = identity
+        self.num_params = num_params
+
+    def __repr__(self):
+        return "Command({})".format(self.name)
+
+    def dispatch(self, handler, msg):
+        client = handler.client
+        if (self.nickname and not client.name) or (self.identity and not client.has_identity):
+            handler.irc.drop_client(client, "invalid")
+            return
+
+        if self.num_params is not None and len(msg.args) < self.num_params:
+            raise IRCError(IRCMessage.error_needs_more_params(handler.irc.host, client.name, msg.command))
+
+        self.func(handler, msg)
+
+
 class Handler:
+    """
+    Command context for a single connection, created once and reused for every message it sends.
+    """
     def __init__(self, irc, client):
         self.irc = irc
         self.client = client
+        self.nickname = None
 
     def __call__(self, msg):
-        handler = msg.command.lower()
-
-        # log.debug("dispatching: %s", handler)
-
-        callback = getattr(self, handler, None)
-        if callback and callable(callback):
+        command = COMMANDS.get(msg.command) or COMMANDS.get(msg.command.upper())
+        if command:
+            irc = self.irc
+            start, queued = time.perf_counter(), Client.queued
             try:
-                callback(msg)
+                command.dispatch(self, msg)
             except IRCError as e:
                 self.client.send(e.msg)
             except Exception:
                 log.exception("error applying message: %s", msg)
+            irc.command_seconds.labels(command.name).observe(time.perf_counter() - start)
+            irc.command_sent.labels(command.name).observe(Client.queued - queued)
 
-        nickname = self.irc.get_nickname(self.client.name) if self.client.name else None
+        # nicknames are renamed in place so the one we find stays ours for the life of the connection
+        nickname = self.nickname
+        if nickname is None and self.client.name:
+            nickname = self.nickname = self.irc.get_nickname(self.client.name)
         if nickname:
             nickname.seen()
 
@@ -86,15 +112,23 @@ class Handler:
         else:
             self.client.send(IRCMessage.error_invalid_cap_subcommand(self.irc.host, self.client.name, command))
 
+    @validate(num_params=1)
     def authenticate(self, msg):
 
         if not self.client.authentication_method:  # initial message
-            if msg.args[0] != "PLAIN":
-                self.client.send(IRCMessage.error_sasl_mechanism(self.irc.host, self.client.name))
+            if msg.args[0] not in MECHANISMS:
+                self.client.send(IRCMessage.error_sasl_mechanism(self.irc.host, self.client.name, ",".join(MECHANISMS)))
                 return
 
             self.client.authentication_method = msg.args[0]
+            if self.client.authentication_method == "SCRAM-SHA-256":
+                self.client.sasl = ScramExchange(self.irc.accounts)
             self.client.send(IRCMessage.sasl_continue(self.irc.host))
+        elif msg.args[0] == "*":
+            self.client.authentication_method = self.client.sasl = None
+            self.client.send(IRCMessage.error_sasl_aborted(self.irc.host, self.client.name))
+        elif self.client.authentication_method == "SCRAM-SHA-256":
+            self._authenticate_scram(msg)
         else:  # authentication message
             try:
                 auth = base64.b64decode(msg.args[0])
@@ -107,13 +141,38 @@ class Handler:
                 self.client.send(IRCMessage.error_sasl_fail(self.irc.host, self.client.name))
                 return
 
+            # authorization identities other than our own are not supported
             authzid, authcid, password = parts
-            valid = self.irc.authenticate(self.client.name, authcid, password)
-            if valid:
-                self.client.send(IRCMessage.sasl_logged_in(self.irc.host, self.client.name, self.client.identity, authcid))
-                self.client.send(IRCMessage.sasl_success(self.irc.host, self.client.name))
-            else:
-                self.client.send(IRCMessage.error_sasl_fail(self.irc.host, self.client.name))
+            self.irc.authenticate(self.client, authcid, password)
+
+    def _authenticate_scram(self, msg):
+        exchange = self.client.sasl
+        if exchange.verified:  # client acknowledged the server signature
+            self.client.authentication_method = self.client.sasl = None
+            self.irc.login(self.client, exchange.account)
+            return
+
+        try:
+            data = base64.b64decode(msg.args[0]).decode()
+        except (binascii.Error, UnicodeDecodeError):
+            data = None
+
+        if data and exchange.server_first is None and not exchange.looking_up:
+            exchange.client_first(data, lambda reply: self._scram_reply(exchange, reply))
+            return
+
+        # anything sent while the account is looked up fails the exchange
+        self._scram_reply(exchange, exchange.client_final(data) if data and exchange.server_first else None)
+
+    def _scram_reply(self, exchange, reply):
+        if not self.client.connected or self.client.sasl is not exchange:
+            return
+        if not reply:
+            self.client.authentication_method = self.client.sasl = None
+            self.client.send(IRCMessage.error_sasl_fail(self.irc.host, self.client.name))
+            return
+
+        self.client.send(IRCMessage.sasl_challenge(self.irc.host, base64.b64encode(reply.encode()).decode()))
 
     @validate(identity=True, num_params=1)
     def join(self, msg):
@@ -163,7 +222,6 @@ class Handler:
     def mode(self, msg):
         target = msg.args[0]
         flags = msg.args[1] if len(msg.args) > 1 else None
-        param = msg.args[2] if len(msg.args) > 2 else None
 
         if self.irc.has_nickname(target):
             if flags:
@@ -172,7 +230,7 @@ class Handler:
                 self.irc.send_user_mode(self.client, target)
         elif self.irc.has_channel(target):
             if flags:
-                self.irc.set_channel_mode(self.client, target, flags, param=param)
+                self.irc.set_channel_mode(self.client, target, flags, msg.args[2:])
             else:
                 self.irc.send_channel_mode(self.client, target)
 
@@ -250,3 +308,60 @@ class Handler:
             nickname.clear_away()
             msg = IRCMessage.reply_unaway(self.irc.host, self.client.name)
         self.client.send(msg)
+
+    @validate(identity=True, num_params=2)
+    def oper(self, msg):
+        self.irc.oper(self.client, msg.args[0], msg.args[1])
+
+    @validate(identity=True, num_params=1)
+    def wallops(self, msg):
+        if not self.irc.is_operator(self.client):
+            raise IRCError(IRCMessage.error_no_privileges(self.irc.host, self.client.name))
+        self.irc.send_wallops(self.client, msg.args[0])
+
+    @validate(identity=True)
+    def rehash(self, msg):
+        if not self.irc.is_operator(self.client):
+            raise IRCError(IRCMessage.error_no_privileges(self.irc.host, self.client.name))
+        self.irc.rehash(self.client)
+
+    @validate(identity=True, num_params=1)
+    def stats(self, msg):
+        if not self.irc.is_operator(self.client):
+            raise IRCError(IRCMessage.error_no_privileges(self.irc.host, self.client.name))
+        self.irc.send_stats(self.client, msg.args[0])
+
+    @validate(identity=True, num_params=4)
+    def chathistory(self, msg):
+        subcommand = msg.args[0].upper()
+        if subcommand not in ("LATEST", "BEFORE", "AFTER", "AROUND", "BETWEEN"):
+            raise IRCError(IRCMessage.fail(self.irc.host, "CHATHISTORY", "INVALID_PARAMS", subcommand, "Unknown subcommand"))
+
+        num_refs = 2 if subcommand == "BETWEEN" else 1
+        if len(msg.args) < num_refs + 3:
+            raise IRCError(IRCMessage.error_needs_more_params(self.irc.host, self.client.name, msg.command))
+
+        target = msg.args[1]
+        refs = [parse_reference(arg) for arg in msg.args[2:2 + num_refs]]
+        invalid = any(ref is None or (ref[0] == "*" and subcommand != "LATEST") for ref in refs)
+        try:
+            limit = int(msg.args[2 + num_refs])
+        except ValueError:
+            invalid = True
+
+        if invalid or limit < 1:
+            raise IRCError(IRCMessage.fail(self.irc.host, "CHATHISTORY", "INVALID_PARAMS", subcommand, "Invalid parameters"))
+
+        self.irc.send_history(self.client, subcommand, target, refs, limit)
+
+
+def build_commands(handler_class):
+    commands = {}
+    for name, func in vars(handler_class).items():
+        if name.startswith("_") or not callable(func):
+            continue
+        commands[name.upper()] = Command(name.upper(), func, *getattr(func, "requirements", ()))
+    return commands
+
+
+COMMANDS = build_commands(Handler)
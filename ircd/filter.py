@@ -0,0 +1,225 @@
+"""
+Operator configured content filters for PRIVMSG and NOTICE. A rules file has one rule per line:
+
+    <action> <kind> <pattern>
+
+    block literal buy cheap watches
+    tag url *.example.ru/*
+    kill regex fr[e3]{2} +b[i1]tc[o0]in
+
+Actions are tag (deliver with a filter tag), block (drop the message) and kill (drop the message and the
+sender). Literals are matched case insensitively anywhere in the text, url patterns are globs over URLs and
+regexes are python regular expressions. Lines starting with # are ignored.
+"""
+import re
+import logging
+from collections import deque
+
+log = logging.getLogger(__name__)
+
+TAG = "tag"
+BLOCK = "block"
+KILL = "kill"
+# in increasing severity, the most severe matching rule wins
+ACTIONS = (TAG, BLOCK, KILL)
+
+LITERAL = "literal"
+URL = "url"
+REGEX = "regex"
+KINDS = (LITERAL, URL, REGEX)
+
+FILTER_TAG = "ircd/filter"
+
+
+class Rule:
+    __slots__ = ("name", "action", "kind", "pattern", "severity", "regex")
+
+    def __init__(self, name, action, kind, pattern):
+        self.name = name
+        self.action = action
+        self.kind = kind
+        self.pattern = pattern
+        self.severity = ACTIONS.index(action)
+        self.regex = None
+
+    def __repr__(self):
+        return "Rule({}: {} {} {})".format(self.name, self.action, self.kind, self.pattern)
+
+    def to_regex(self):
+        if self.kind == URL:
+            glob = re.escape(self.pattern).replace(r"\*", r"[^\s]*")
+            return r"(?:https?://)?" + glob
+        return self.pattern
+
+    def compile(self):
+        """
+        Compiles url and regex rules on their own, raises re.error for a bad pattern.
+        """
+        if self.kind != LITERAL and self.regex is None:
+            self.regex = re.compile(self.to_regex(), re.IGNORECASE)
+        return self.regex
+
+    @property
+    def combinable(self):
+        """
+        Whether the pattern means the same inside an alternation with others: no groups a backreference could
+        count and no inline flags, which must come first.
+        """
+        if self.regex.groups:
+            return False
+        try:
+            re.compile("(?:{})".format(self.to_regex()))
+        except re.error:
+            return False
+        return True
+
+
+class Automaton:
+    """
+    Aho-Corasick automaton over lowercased literals, finds every rule whose literal occurs in one pass over the
+    text.
+    """
+    def __init__(self, literals):
+        self.goto = [{}]
+        self.fail = [0]
+        self.out = [()]
+
+        for literal, rule in literals:
+            state = 0
+            for char in literal.lower():
+                child = self.goto[state].get(char)
+                if child is None:
+                    child = len(self.goto)
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.out.append(())
+                    self.goto[state][char] = child
+                state = child
+            self.out[state] += (rule,)
+
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, child in self.goto[state].items():
+                queue.append(child)
+                fallback = self.fail[state]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[child] = self.goto[fallback].get(char, 0)
+                self.out[child] += self.out[self.fail[child]]
+
+    def search(self, text):
+        goto, fail, out = self.goto, self.fail, self.out
+        matches = []
+        state = 0
+        for char in text.lower():
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if out[state]:
+                matches.extend(out[state])
+        return matches
+
+
+def parse_rules(lines):
+    rules = []
+    for lineno, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+
+        parts = line.split(None, 2)
+        if len(parts) != 3 or parts[0] not in ACTIONS or parts[1] not in KINDS:
+            log.warning("ignoring filter rule on line %d: %s", lineno, line)
+            continue
+
+        rule = Rule(str(lineno), *parts)
+        try:
+            rule.compile()
+        except re.error as e:
+            log.warning("ignoring filter rule on line %d: %s", lineno, e)
+            continue
+        rules.append(rule)
+    return rules
+
+
+class Filter:
+    """
+    Scans message text against all literals at once through an Aho-Corasick automaton and all url and regex
+    rules that can share an alternation through one combined regex. Text that matches the combined regex is
+    rescanned one severity at a time, most severe first, so overlapping matches can't hide a severe rule.
+    Patterns with inline flags or groups are run on their own.
+    """
+    def __init__(self, path=None, rules=()):
+        self.path = path
+        self.rules = []
+        self.automaton = None
+        self.combined = None
+        # (severity, combined regex or None, rules run on their own), most severe first
+        self.levels = []
+        self.groups = {}
+        if path:
+            self.load()
+        else:
+            self.set_rules(rules)
+
+    def load(self, path=None):
+        """
+        (Re)reads the rules file, the old rules stay in place if it can't be read or compiled.
+        """
+        self.path = path or self.path
+        with open(self.path) as f:
+            rules = parse_rules(f)
+        self.set_rules(rules)
+        log.info("loaded %d filter rules from %s", len(rules), self.path)
+
+    def set_rules(self, rules):
+        literals = [(rule.pattern, rule) for rule in rules if rule.kind == LITERAL]
+        others = [rule for rule in rules if rule.kind != LITERAL]
+        for rule in others:
+            rule.compile()
+
+        combined = [rule for rule in others if rule.combinable]
+        groups = {"r{}".format(i): rule for i, rule in enumerate(combined)}
+
+        def alternation(names):
+            pattern = "|".join("(?P<{}>{})".format(name, groups[name].to_regex()) for name in names)
+            return re.compile(pattern, re.IGNORECASE) if names else None
+
+        levels = []
+        for severity in reversed(range(len(ACTIONS))):
+            names = [name for name, rule in groups.items() if rule.severity == severity]
+            separate = [rule for rule in others if rule.severity == severity and rule not in combined]
+            if names or separate:
+                levels.append((severity, alternation(names), separate))
+
+        self.automaton = Automaton(literals) if literals else None
+        self.combined = alternation(list(groups))
+        self.levels = levels
+        self.groups = groups
+        self.rules = list(rules)
+
+    def scan(self, text):
+        matches = self.automaton.search(text) if self.automaton else []
+        best = max(matches, key=lambda rule: rule.severity, default=None)
+        # most text matches nothing, one pass rules out every combined pattern
+        hit = self.combined is not None and self.combined.search(text)
+        for severity, regex, separate in self.levels:
+            if best is not None and severity <= best.severity:
+                break
+            if hit and regex:
+                match = regex.search(text)
+                if match:
+                    return self.groups[match.lastgroup]
+            for rule in separate:
+                if rule.regex.search(text):
+                    return rule
+        return best
+
+    def check(self, message):
+        """
+        The most severe rule matching the message's text, None if nothing matches.
+        """
+        if not self.rules or not message.args:
+            return None
+        return self.scan(message.args[-1])
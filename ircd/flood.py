@@ -0,0 +1,171 @@
+import time
+import logging
+
+log = logging.getLogger(__name__)
+
+FLOOD_BURST = 20
+FLOOD_RATE = 2.0
+FLOOD_EXCESS = 40
+RECVQ = 8192
+
+LINK_BURST = 5000
+LINK_RATE = 1000.0
+LINK_EXCESS = 100000
+
+EXCESS_FLOOD = "Excess Flood"
+
+DEFAULT_COST = 1
+
+# commands not listed cost DEFAULT_COST, commands taking a target list are charged per target
+COMMAND_COSTS = {
+    "PING": 0,
+    "PONG": 0,
+    "QUIT": 0,
+    "CAP": 0,
+    "AUTHENTICATE": 2,
+    "PRIVMSG": 1,
+    "NOTICE": 1,
+    "TAGMSG": 1,
+    "JOIN": 2,
+    "LIST": 5,
+    "NAMES": 2,
+    "CHATHISTORY": 3,
+}
+
+PER_TARGET = {"PRIVMSG", "NOTICE", "TAGMSG", "JOIN", "PART", "NAMES"}
+
+
+class TokenBucket:
+    """
+    Tokens refill at rate per second up to burst, taking more than is available puts the bucket in debt.
+    """
+    __slots__ = ("burst", "rate", "tokens", "last", "link")
+
+    def __init__(self, burst, rate, link=False):
+        self.burst = burst
+        self.rate = rate
+        self.tokens = burst
+        self.last = time.monotonic()
+        self.link = link
+
+    def take(self, cost, now=None):
+        now = time.monotonic() if now is None else now
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        self.tokens -= cost
+        return self.tokens
+
+    def delay(self):
+        # seconds until the bucket is out of debt
+        return -self.tokens / self.rate if self.tokens < 0 else 0
+
+
+class FloodControl:
+    """
+    Charges each incoming message against a per connection bucket. A client in debt has its input delayed
+    (fakelag) until it is paid off, it is disconnected once the debt exceeds excess or once more than recvq
+    bytes pile up unread while it is lagged. Links get their own much larger budget and operators are not
+    limited at all.
+    """
+    def __init__(self, burst=FLOOD_BURST, rate=FLOOD_RATE, excess=FLOOD_EXCESS, recvq=RECVQ, costs=None,
+                 link_burst=LINK_BURST, link_rate=LINK_RATE, link_excess=LINK_EXCESS):
+        self.burst = burst
+        self.rate = rate
+        self.excess = excess
+        self.recvq = recvq
+        self.costs = dict(COMMAND_COSTS, **(costs or {}))
+        self.link_burst = link_burst
+        self.link_rate = link_rate
+        self.link_excess = link_excess
+
+    def cost(self, message):
+        command = message.command.upper()
+        cost = self.costs.get(command, DEFAULT_COST)
+        if cost and command in PER_TARGET and message.args:
+            cost *= message.args[0].count(",") + 1
+        return cost
+
+    def bucket(self, client):
+        # a connection becomes a link after registering with SERVER and moves to the link budget
+        is_link = bool(client.link or client.server)
+        bucket = client.flood
+        if bucket is None or bucket.link != is_link:
+            if is_link:
+                bucket = TokenBucket(self.link_burst, self.link_rate, link=True)
+            else:
+                bucket = TokenBucket(self.burst, self.rate)
+            client.flood = bucket
+        return bucket
+
+    def charge(self, client, message, buffered=0, exempt=False):
+        """
+        Returns how long to hold the message before processing it, None if the client is flooding.
+        """
+        if exempt:
+            return 0
+
+        bucket = self.bucket(client)
+        tokens = bucket.take(self.cost(message))
+        delay = bucket.delay()
+        if tokens < -(self.link_excess if bucket.link else self.excess) or \
+                (delay and not bucket.link and buffered > self.recvq):
+            log.info("%s exceeded flood limit", client)
+            return None
+        return delay
+
+
+class WindowCounter:
+    """
+    Events per period estimated from the counts of the current and previous fixed windows, the previous one
+    weighted by how much of it still overlaps the sliding window. Constant time and space per event.
+    """
+    __slots__ = ("limit", "period", "start", "current", "previous")
+
+    def __init__(self, limit, period):
+        self.limit = limit
+        self.period = period
+        self.start = time.monotonic()
+        self.current = 0
+        self.previous = 0
+
+    def hit(self, now=None):
+        """
+        Counts an event, returns True if it takes the rate over the limit.
+        """
+        now = time.monotonic() if now is None else now
+        elapsed = now - self.start
+        if elapsed >= self.period:
+            self.previous = self.current if elapsed < 2 * self.period else 0
+            self.current = 0
+            self.start = now - elapsed % self.period
+            elapsed = now - self.start
+
+        self.current += 1
+        return self.previous * (self.period - elapsed) / self.period + self.current > self.limit
+
+
+class ChannelFlood:
+    """
+    Channel flood limits from a +f parameter, "<lines>:<seconds>" for messages and "j<joins>:<seconds>" for
+    joins separated by a comma, e.g. "10:5,j3:30".
+    """
+    __slots__ = ("param", "messages", "joins")
+
+    def __init__(self, param, messages=None, joins=None):
+        self.param = param
+        self.messages = messages
+        self.joins = joins
+
+    @classmethod
+    def parse(cls, param):
+        messages = joins = None
+        for part in (param or "").split(","):
+            counter = part[1:] if part.startswith("j") else part
+            limit, _, seconds = counter.partition(":")
+            if not (limit.isdigit() and seconds.isdigit() and int(limit) and int(seconds)):
+                return None
+            if part.startswith("j"):
+                joins = WindowCounter(int(limit), int(seconds))
+            else:
+                messages = WindowCounter(int(limit), int(seconds))
+        return cls(param, messages, joins)
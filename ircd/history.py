@@ -0,0 +1,357 @@
+import bisect
+import asyncio
+import logging
+import datetime
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+log = logging.getLogger(__name__)
+
+HISTORY_LENGTH = 1000
+HISTORY_BYTES = 64 * 1024 * 1024
+HISTORY_LIMIT = 100
+
+# rough per entry cost of the entry and message objects on top of the text
+ENTRY_OVERHEAD = 256
+
+
+def parse_timestamp(s):
+    """
+    Parses an ISO 8601 timestamp into naive UTC like message times, None if invalid.
+    """
+    try:
+        timestamp = datetime.datetime.fromisoformat(s.rstrip("Z"))
+    except ValueError:
+        return None
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return timestamp
+
+
+def parse_reference(s):
+    """
+    Parses a CHATHISTORY message reference, returns a (kind, value) tuple or None if invalid.
+    """
+    if s == "*":
+        return "*", None
+
+    kind, _, value = s.partition("=")
+    if not value:
+        return None
+    if kind == "timestamp":
+        timestamp = parse_timestamp(value)
+        return (kind, timestamp) if timestamp else None
+    if kind == "msgid":
+        return kind, value
+    return None
+
+
+def dm_key(a, b):
+    return (a, b) if a < b else (b, a)
+
+
+class HistoryEntry:
+    __slots__ = ("seq", "timestamp", "msgid", "message", "size")
+
+    def __init__(self, seq, timestamp, msgid, message, size):
+        self.seq = seq
+        self.timestamp = timestamp
+        self.msgid = msgid
+        self.message = message
+        self.size = size
+
+
+class RingBuffer:
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.entries = [None] * capacity
+        self.start = 0
+        self.end = 0
+        self.size = 0
+        self.ids = {}
+
+    def __len__(self):
+        return self.end - self.start
+
+    def __getitem__(self, i):
+        if i < 0 or i >= len(self):
+            raise IndexError(i)
+        return self.entries[(self.start + i) % self.capacity]
+
+    @property
+    def oldest(self):
+        return self[0] if len(self) else None
+
+    @property
+    def newest(self):
+        return self[len(self) - 1] if len(self) else None
+
+    def append(self, message, size):
+        timestamp = message.time
+        newest = self.newest
+        # keep timestamps ordered for bisection even if the clock steps back
+        if newest and timestamp < newest.timestamp:
+            timestamp = newest.timestamp
+
+        freed = 0
+        if len(self) == self.capacity:
+            freed = self.pop()
+
+        entry = HistoryEntry(self.end, timestamp, message.id, message, size)
+        self.entries[self.end % self.capacity] = entry
+        self.ids[entry.msgid] = entry.seq
+        self.end += 1
+        self.size += size
+        return freed
+
+    def pop(self):
+        entry = self.entries[self.start % self.capacity]
+        self.entries[self.start % self.capacity] = None
+        self.start += 1
+        self.size -= entry.size
+        del self.ids[entry.msgid]
+        return entry.size
+
+    def timestamp(self, i):
+        return self[i].timestamp
+
+    def find_id(self, msgid):
+        seq = self.ids.get(msgid)
+        return seq - self.start if seq is not None else None
+
+    def slice(self, lo, hi):
+        return [self[i].message for i in range(max(lo, 0), min(hi, len(self)))]
+
+
+class _Timestamps:
+    def __init__(self, ring):
+        self.ring = ring
+
+    def __len__(self):
+        return len(self.ring)
+
+    def __getitem__(self, i):
+        return self.ring.timestamp(i)
+
+
+def _bounds(ring, ref):
+    """
+    Resolves a reference to the (before_end, after_start) indices of the ring, None if it is unknown.
+    """
+    kind, value = ref
+    if kind == "msgid":
+        i = ring.find_id(value)
+        return (i, i + 1) if i is not None else None
+
+    timestamps = _Timestamps(ring)
+    return bisect.bisect_left(timestamps, value), bisect.bisect_right(timestamps, value)
+
+
+def latest(ring, ref, limit):
+    lo = 0
+    if ref[0] != "*":
+        bounds = _bounds(ring, ref)
+        if bounds is None:
+            return []
+        lo = bounds[1]
+    return ring.slice(max(lo, len(ring) - limit), len(ring))
+
+
+def before(ring, ref, limit):
+    bounds = _bounds(ring, ref)
+    if bounds is None:
+        return []
+    hi = bounds[0]
+    return ring.slice(hi - limit, hi)
+
+
+def after(ring, ref, limit):
+    bounds = _bounds(ring, ref)
+    if bounds is None:
+        return []
+    lo = bounds[1]
+    return ring.slice(lo, lo + limit)
+
+
+def around(ring, ref, limit):
+    bounds = _bounds(ring, ref)
+    if bounds is None:
+        return []
+    hi = bounds[0]
+    messages = ring.slice(hi - limit // 2, hi)
+    return messages + ring.slice(hi, hi + limit - len(messages))
+
+
+def between(ring, start, end, limit):
+    start_bounds = _bounds(ring, start)
+    end_bounds = _bounds(ring, end)
+    if start_bounds is None or end_bounds is None:
+        return []
+
+    if start_bounds[0] <= end_bounds[0]:
+        lo, hi = start_bounds[1], end_bounds[0]
+        return ring.slice(lo, min(hi, lo + limit))
+
+    lo, hi = end_bounds[1], start_bounds[0]
+    return ring.slice(max(lo, hi - limit), hi)
+
+
+QUERIES = {
+    "LATEST": latest,
+    "BEFORE": before,
+    "AFTER": after,
+    "AROUND": around,
+    "BETWEEN": between,
+}
+
+
+def query(ring, subcommand, refs, limit):
+    return QUERIES[subcommand](ring, *refs, limit)
+
+
+def covers(ring, refs, messages):
+    """
+    Whether an answer from the ring alone is complete. The ring holds a target's newest messages, so it is
+    unless the answer reaches back to the ring's oldest entry, before which older messages may be stored.
+    """
+    if messages:
+        return messages[0] is not ring.oldest.message
+
+    for ref in refs:
+        bounds = _bounds(ring, ref) if ref[0] != "*" else None
+        if not bounds or bounds[0] == 0:
+            return False
+    return True
+
+
+class History:
+    """
+    Per target ring buffers of recent messages, backed by an optional store for older ones. Queries the
+    buffers can't answer are merged with the backend's answer on a worker thread.
+    """
+    def __init__(self, length=HISTORY_LENGTH, max_bytes=HISTORY_BYTES, backend=None):
+        self.length = length
+        self.max_bytes = max_bytes
+        self.backend = backend
+        self.size = 0
+        self.buffers = OrderedDict()
+        self.executor = None
+
+    def __len__(self):
+        return len(self.buffers)
+
+    def estimate_size(self, message):
+        return ENTRY_OVERHEAD + len(str(message.prefix)) + sum(len(arg) for arg in message.args)
+
+    def get(self, target):
+        ring = self.buffers.get(target)
+        if ring is not None:
+            self.buffers.move_to_end(target)
+        return ring
+
+    def add(self, target, message):
+        ring = self.get(target)
+        if ring is None:
+            ring = self.buffers[target] = RingBuffer(self.length)
+
+        size = self.estimate_size(message)
+        self.size += size - ring.append(message, size)
+        self.evict(target)
+
+        if self.backend:
+            self.backend.append(target, message)
+
+    def evict(self, keep):
+        while self.size > self.max_bytes:
+            target, ring = next(iter(self.buffers.items()))
+            if target == keep:
+                if len(ring) <= 1:
+                    break
+                self.size -= ring.pop()
+                continue
+
+            log.debug("evicting history for %s", target)
+            del self.buffers[target]
+            self.size -= ring.size
+
+    def resolve(self, target, ref):
+        """
+        Turns a message id found in the buffer into its timestamp so the backend can be queried by time.
+        """
+        kind, value = ref
+        if kind != "msgid":
+            return ref
+
+        ring = self.buffers.get(target)
+        i = ring.find_id(value) if ring else None
+        return ("timestamp", ring.timestamp(i)) if i is not None else ref
+
+    def _from_buffer(self, subcommand, target, refs, limit):
+        ring = self.get(target)
+        messages = query(ring, subcommand, refs, limit) if ring else []
+        return messages, not self.backend or (ring is not None and covers(ring, refs, messages))
+
+    def _from_backend(self, subcommand, target, refs, limit, messages):
+        # the buffer doesn't reach back far enough, merge with what the backend has stored
+        resolved = []
+        for kind, value in refs:
+            if kind == "msgid":
+                value = self.backend.find_timestamp(target, value)
+                if value is None:
+                    return messages
+                kind = "timestamp"
+            resolved.append((kind, value))
+
+        merged = {message.id: message for message in self.backend.query(subcommand, target, resolved, limit)}
+        merged.update((message.id, message) for message in messages)
+
+        ring = RingBuffer(len(merged))
+        for message in sorted(merged.values(), key=lambda message: message.time):
+            ring.append(message, 0)
+        return query(ring, subcommand, resolved, limit)
+
+    def query(self, subcommand, target, refs, limit):
+        messages, complete = self._from_buffer(subcommand, target, refs, limit)
+        if complete:
+            return messages
+        return self._from_backend(subcommand, target, [self.resolve(target, ref) for ref in refs], limit, messages)
+
+    def query_async(self, subcommand, target, refs, limit, callback):
+        """
+        Calls back with the answer right away when the buffer covers it, otherwise once the backend has been
+        queried off the event loop.
+        """
+        messages, complete = self._from_buffer(subcommand, target, refs, limit)
+        if complete:
+            callback(messages)
+            return
+
+        refs = [self.resolve(target, ref) for ref in refs]
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            callback(self._from_backend(subcommand, target, refs, limit, messages))
+            return
+
+        def _done(future):
+            if future.exception():
+                log.error("error querying history for %s: %r", target, future.exception())
+                callback(messages)
+            else:
+                callback(future.result())
+
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="ircd-history")
+        future = loop.run_in_executor(self.executor, self._from_backend, subcommand, target, refs, limit, messages)
+        future.add_done_callback(_done)
+
+    def open(self):
+        if self.backend:
+            self.backend.start()
+
+    def close(self):
+        if self.executor:
+            self.executor.shutdown()
+            self.executor = None
+        if self.backend:
+            self.backend.close()
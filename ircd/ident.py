@@ -0,0 +1,106 @@
+"""
+RFC 1413 ident lookups. A lookup runs alongside the reverse DNS lookup when a client connects and never holds
+back registration: a client registering before its lookup succeeds gets the usual ~ in front of the username it
+gave in USER.
+"""
+import re
+import time
+import asyncio
+import logging
+
+log = logging.getLogger(__name__)
+
+IDENT_PORT = 113
+IDENT_TIMEOUT = 10
+IDENT_CONCURRENCY = 64
+IDENT_CACHE_TTL = 60
+USERLEN = 10
+
+UNVERIFIED_PREFIX = "~"
+
+VALID_USER = re.compile(r"^[^\s@!:~]+$")
+
+
+def parse_response(line, remote_port, local_port):
+    """
+    The user id from a "<port>, <port> : USERID : <os> : <user>" response to our query, None for errors.
+    """
+    parts = line.split(":", 3)
+    if len(parts) != 4 or parts[1].strip().upper() != "USERID":
+        return None
+
+    try:
+        ports = tuple(int(port) for port in parts[0].split(","))
+    except ValueError:
+        return None
+    if ports != (remote_port, local_port):
+        return None
+
+    user = parts[3].strip()[:USERLEN]
+    return user if VALID_USER.match(user) else None
+
+
+def unverified(user):
+    return (UNVERIFIED_PREFIX + user)[:USERLEN]
+
+
+async def query(address, remote_port, local_port, port=IDENT_PORT, local_address=None):
+    # from the address the client connected to, on a multi-homed host that's the one it can reach and will answer
+    reader, writer = await asyncio.open_connection(
+        address, port, local_addr=(local_address, 0) if local_address else None)
+    try:
+        writer.write("{}, {}\r\n".format(remote_port, local_port).encode())
+        await writer.drain()
+        line = await reader.readline()
+    finally:
+        writer.close()
+    return parse_response(line.decode("ascii", "replace"), remote_port, local_port)
+
+
+class IdentResolver:
+    def __init__(self, timeout=IDENT_TIMEOUT, concurrency=IDENT_CONCURRENCY, cache_ttl=IDENT_CACHE_TTL,
+                 port=IDENT_PORT):
+        self.timeout = timeout
+        self.concurrency = concurrency
+        self.cache_ttl = cache_ttl
+        self.port = port
+        self.semaphore = None
+        # (address, remote port, local address, local port) -> (expires, user)
+        self.cache = {}
+
+    def _cached(self, key, now):
+        entry = self.cache.get(key)
+        if entry and entry[0] > now:
+            return True, entry[1]
+        return False, None
+
+    def _store(self, key, user, now):
+        if len(self.cache) >= self.concurrency * 16:
+            self.cache = {k: v for k, v in self.cache.items() if v[0] > now}
+        self.cache[key] = (now + self.cache_ttl, user)
+
+    async def _query(self, address, remote_port, local_address, local_port):
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.concurrency)
+        async with self.semaphore:
+            return await query(address, remote_port, local_port, port=self.port, local_address=local_address)
+
+    async def lookup(self, address, remote_port, local_port, local_address=None):
+        """
+        The user the client's host says owns the connection, None when it didn't say in time.
+        """
+        key = (address, remote_port, local_address, local_port)
+        hit, user = self._cached(key, time.monotonic())
+        if hit:
+            return user
+
+        try:
+            # waiting for the semaphore counts against the timeout
+            user = await asyncio.wait_for(
+                self._query(address, remote_port, local_address, local_port), self.timeout)
+        except (OSError, UnicodeError, asyncio.TimeoutError) as e:
+            log.debug("ident lookup for %s:%s failed: %r", address, remote_port, e)
+            user = None
+
+        self._store(key, user, time.monotonic())
+        return user
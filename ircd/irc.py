@@ -1,18 +1,30 @@
+import re
 import time
+import asyncio
 import logging
 from queue import Queue
 from datetime import datetime
 
 from ircd.chan import Channel
 from ircd.nick import Nickname
-from ircd.message import IRCMessage
+from ircd.message import IRCMessage, Tag, generate_id, CHAN_START_CHARS
+from ircd.history import History, HISTORY_LIMIT, dm_key
+from ircd.accounts import AccountStore
+from ircd.filter import Filter, TAG, KILL, FILTER_TAG
+from ircd.clones import CloneIndex
+from ircd.ident import unverified
+from ircd.broadcast import BroadcastLog, RING_SIZE
+from ircd.metrics import Registry, SIZE_BUCKETS, COMMAND_BUCKETS
 from ircd.commands import Handler
-from ircd.mode import Mode, ModeParamMissing
+from ircd.mode import Mode, ModeIndex, MODES, parse_modes, format_modes, valid_param
 from ircd.common import IRCError
 
 SERVER_NAME = "ircd"
 SERVER_VERSION = "0.1"
-CHAN_START_CHARS = "&#!+"
+# seconds a channel stays +m or +i after tripping its +f limits
+CHANNEL_FLOOD_LOCK = 60
+# clone sources listed by STATS c
+CLONE_STATS_TOP = 10
 
 log = logging.getLogger(__name__)
 
@@ -21,6 +33,8 @@ CAPABILITIES = [
     "server-time",
     "message-ids",
     "sasl",
+    "batch",
+    "draft/chathistory",
 ]
 
 ISUPPORT = {
@@ -28,11 +42,14 @@ ISUPPORT = {
     "CASEMAPPING": "ascii",
     "CHANLIMIT": "",
     "CHANTYPES": "#",
+    "CHATHISTORY": str(HISTORY_LIMIT),
+    "MODES": str(MODES),
 }
 
 
 class IRC:
-    def __init__(self, host):
+    def __init__(self, host, history=None, accounts=None, opers=None, filter=None, clones=None,
+                 broadcast_threshold=None, broadcast_ring=RING_SIZE):
         self.host = host
         self.running = True
         self.incoming = Queue()
@@ -42,9 +59,44 @@ class IRC:
         self.channels = {}
         self.nicknames = {}
         self.nick_client = {}
-        self.known_identities = {}
+        self.accounts = accounts or AccountStore()
         self.motd = "hello world"
-        self.operators = []
+        # accounts allowed to OPER up
+        self.opers = set(opers or ())
+        self.user_modes = ModeIndex()
+        self.operators = self.user_modes[Mode.OPERATOR]
+        self.wallops = self.user_modes[Mode.WALLOPS]
+        self.notice_subscribers = self.user_modes.server_notices
+        self.history = history or History()
+        self.channel_flood_lock = CHANNEL_FLOOD_LOCK
+        self.filter = filter or Filter()
+        self.clones = clones or CloneIndex()
+        # channels with this many members deliver through a shared log, None never does
+        self.broadcast_threshold = broadcast_threshold
+        self.broadcast_ring = broadcast_ring
+
+        self.metrics = Registry()
+        self.messages_received = self.metrics.counter("ircd_messages_received_total", "Messages processed")
+        self.registrations = self.metrics.counter("ircd_registrations_total", "Clients that completed registration")
+        self.verifications_refused = self.metrics.counter(
+            "ircd_verifications_refused_total", "Password verifications refused for being over a limit")
+        self.fanout = self.metrics.histogram(
+            "ircd_channel_fanout", "Recipients of each message sent to a channel", buckets=SIZE_BUCKETS)
+        self.command_seconds = self.metrics.histogram(
+            "ircd_command_seconds", "Time spent handling each command", labels=("command",), buckets=COMMAND_BUCKETS)
+        self.command_sent = self.metrics.histogram(
+            "ircd_command_messages_sent", "Messages queued by each command", labels=("command",), buckets=SIZE_BUCKETS)
+        self.metrics.gauge("ircd_clients", "Registered clients", func=lambda: len(self.clients))
+        self.metrics.gauge("ircd_nicknames", "Nicknames in use", func=lambda: len(self.nicknames))
+        self.metrics.gauge("ircd_channels", "Channels", func=lambda: len(self.channels))
+        self.metrics.gauge("ircd_links", "Linked servers", func=lambda: len(self.links))
+        self.metrics.gauge("ircd_verifications_pending", "Password verifications queued or running",
+                           func=lambda: self.accounts.pending)
+
+    def shutdown(self):
+        self.running = False
+        self.history.close()
+        self.accounts.close()
 
     def add_link(self, client, name, hop_count, token, info):
         client.set_server(name, hop_count, token, info)
@@ -54,13 +106,77 @@ class IRC:
     def get_capabilities(self):
         return CAPABILITIES
 
-    def authenticate(self, nickname, identity, password):
-        owner = self.known_identities.get(nickname)
-        if not owner:
-            self.known_identities[nickname] = {"identity": identity, "password": password}
-            return True
-        valid = owner["identity"] == identity and owner["password"] == password
-        return valid
+    def authenticate(self, client, account, password):
+        def _verified(valid):
+            if not client.connected:
+                return
+            if valid:
+                self.login(client, account)
+            else:
+                client.send(IRCMessage.error_sasl_fail(self.host, client.name))
+
+        self.verify(client, account, password, _verified)
+
+    def oper(self, client, account, password):
+        if account not in self.opers:
+            raise IRCError(IRCMessage.error_no_oper_host(self.host, client.name))
+
+        def _verified(valid):
+            nickname = self.get_nickname(client.name)
+            if not client.connected or not nickname:
+                return
+            if not valid:
+                client.send(IRCMessage.error_password_mismatch(self.host, client.name))
+                return
+
+            log.info("%s is now an operator (%s)", client.identity, account)
+            nickname.set_mode(Mode.OPERATOR)
+            client.send(IRCMessage.reply_youre_oper(self.host, client.name))
+            client.send(IRCMessage.mode(client.identity, client.name, "+" + Mode.OPERATOR))
+            self.server_notice("{} is now an operator".format(client.identity))
+
+        self.verify(client, account, password, _verified)
+
+    def verify(self, client, account, password, callback):
+        """
+        Verifies a password for client, one verification at a time per client. Attempts past that or past the
+        store's limit on pending verifications fail without being verified.
+        """
+        if client.verifying:
+            self.verifications_refused.inc()
+            callback(False)
+            return
+
+        def _verified(valid):
+            client.verifying = False
+            callback(valid)
+
+        client.verifying = True
+        if not self.accounts.verify_async(account, password, _verified):
+            client.verifying = False
+            self.verifications_refused.inc()
+            callback(False)
+
+    def server_notice(self, text):
+        """
+        Sends a notice to each operator with +s.
+        """
+        for nickname in self.notice_subscribers:
+            other = self.lookup_client(nickname.nickname)
+            if other and other.connected:
+                other.send(IRCMessage.server_notice(self.host, nickname.nickname, text))
+
+    def send_wallops(self, client, text):
+        msg = IRCMessage.wallops(client.identity, text)
+        for nickname in self.wallops:
+            other = self.lookup_client(nickname.nickname)
+            if other and other.connected:
+                other.send(msg)
+
+    def login(self, client, account):
+        client.account = account
+        client.send(IRCMessage.sasl_logged_in(self.host, client.name, client.identity, account))
+        client.send(IRCMessage.sasl_success(self.host, client.name))
 
     def get_channels(self):
         return self.channels.values()
@@ -92,6 +208,10 @@ class IRC:
         if identity in self.clients:
             del self.clients[identity]
 
+    def is_operator(self, client):
+        nickname = self.get_nickname(client.name) if client.name else None
+        return bool(nickname and nickname.is_operator)
+
     def get_nicknames(self):
         return self.nicknames.values()
 
@@ -105,7 +225,10 @@ class IRC:
         return self.nick_client.get(nickname)
 
     def process(self, client, msg):
-        handler = Handler(self, client)
+        self.messages_received.inc()
+        handler = client.handler
+        if handler is None:
+            handler = client.handler = Handler(self, client)
         handler(msg)
 
         for link in self.links:
@@ -129,7 +252,7 @@ class IRC:
             del self.nicknames[old]
             nickname.set_nick(new_nickname)
         else:
-            nickname = Nickname(new_nickname)
+            nickname = Nickname(new_nickname, index=self.user_modes)
 
         self.nicknames[nickname.nickname] = nickname
         self.nick_client[nickname.nickname] = client
@@ -144,9 +267,15 @@ class IRC:
                 self.send_to_channel(client, channel, msg, skip_self=True)
 
     def set_ident(self, client, user, realname):
+        if client.ident:
+            user = client.ident
+        elif client.ident is not None:
+            user = unverified(user)
         client.set_identity(user, realname)
         self.set_client(client)
+        self.registrations.inc()
         log.info("%s connected", client.identity)
+        self.server_notice("Client connecting: {} [{}]".format(client.identity, client.address))
 
         client.send(IRCMessage.nick(client.identity, client.name))
         client.send(IRCMessage.reply_welcome(self.host, client.name, client.name, client.user, client.host))
@@ -173,12 +302,38 @@ class IRC:
         else:
             client.send(IRCMessage.reply_no_motd(self.host, client.name))
 
+    def send_stats(self, client, query):
+        if query == "m":
+            for (command,), histogram in sorted(self.command_seconds.children.items()):
+                client.send(IRCMessage.reply_stats_commands(self.host, client.name, command, histogram.count))
+        elif query == "l":
+            now = time.time()
+            for other in self.links + list(self.clients.values()):
+                client.send(IRCMessage.reply_stats_link(
+                    self.host, client.name, other.name if other.server else other.identity, other.outgoing.qsize(),
+                    other.messages_out, other.bytes_out, other.messages_in, other.bytes_in,
+                    int(now - other.connected_at)))
+        elif query == "p":
+            for (command,), histogram in sorted(self.command_seconds.children.items()):
+                sent = self.command_sent.labels(command)
+                client.send(IRCMessage.reply_stats_debug(
+                    self.host, client.name, "{} calls={} avg={:.1f}us p50<={:.0f}us p99<={:.0f}us sent={:.1f}".format(
+                        command, histogram.count, histogram.sum / histogram.count * 1e6,
+                        histogram.quantile(.5) * 1e6, histogram.quantile(.99) * 1e6, sent.sum / sent.count)))
+        elif query == "c":
+            addresses, networks = self.clones.top(CLONE_STATS_TOP)
+            for source, count in addresses + networks:
+                client.send(IRCMessage.reply_stats_debug(self.host, client.name, "clones {} {}".format(source, count)))
+        client.send(IRCMessage.reply_end_stats(self.host, client.name, query))
+
     def drop_client(self, client, message=None):
         if not client.connected:
             return
 
         log.info("%s disconnected (%s)", client.identity, message or "none")
         client.disconnect()
+        if client.has_identity:
+            self.server_notice("Client exiting: {} [{}]".format(client.identity, message or "none"))
 
         nickname = self.get_nickname(client.name)
         if nickname:
@@ -193,6 +348,7 @@ class IRC:
                 del self.nick_client[nickname.nickname]
             if nickname.nickname in self.nicknames:
                 del self.nicknames[nickname.nickname]
+            self.user_modes.remove(nickname)
 
         self.remove_client(client.identity)
 
@@ -206,6 +362,9 @@ class IRC:
             channel = Channel(name, nickname)
             self.set_channel(channel)
 
+        if channel.flood and channel.flood.joins and channel.flood.joins.hit():
+            self.lock_channel(channel, Mode.CHANNEL_IS_INVITE_ONLY)
+
         if not channel.can_join_channel(nickname):
             raise IRCError(IRCMessage.error_invite_only_channel(self.host, client.name, name))
 
@@ -216,6 +375,8 @@ class IRC:
         if not joined:
             client.send(IRCMessage.error_bad_channel_key(self.host, client.name, channel.name))
             return
+        if channel.log:
+            client.outgoing.subscribe(channel.log)
 
         self.send_to_channel(client, channel, IRCMessage.join(client.identity, name))
         self.send_topic(client, channel)
@@ -272,6 +433,8 @@ class IRC:
         nickname = self.get_nickname(client.name)
         self.send_to_channel(client, channel, IRCMessage.part(client.identity, name, message=message))
         channel.part(nickname)
+        if channel.log:
+            client.outgoing.unsubscribe(channel.log)
         if not channel.members:
             del self.channels[name]
 
@@ -280,25 +443,125 @@ class IRC:
         if nickname not in channel.members:
             raise IRCError(IRCMessage.error_not_in_channel(self.host, client.name))
 
+        self.fanout.observe(len(channel.members))
+        if caps:
+            missing = [cap for cap in caps if cap not in client.capabilities]
+            if missing:
+                return
+
+        if channel.log is None and self.broadcast_threshold and len(channel.members) >= self.broadcast_threshold:
+            self.start_broadcast_log(channel)
+        if channel.log:
+            # the sender gets its own copy directly so it stays in order with the rest of its replies
+            channel.log.append(msg, skip=client.outgoing)
+            if not skip_self:
+                client.send(msg)
+            return
+
         for member in channel.members:
             if skip_self and member.nickname == client.name:
                 continue
             member_client = self.lookup_client(member.nickname)
+            if member_client:
+                member_client.send(msg)
 
-            if caps:
-                missing = [cap for cap in caps if cap not in client.capabilities]
-                if missing:
-                    continue
+    def start_broadcast_log(self, channel):
+        """
+        Switches a channel to appending each message once to a ring that every member reads from, a member
+        that falls a whole ring behind is disconnected.
+        """
+        log.info("%s has %d members, delivering through a broadcast log", channel.name, len(channel.members))
+        channel.log = BroadcastLog(self.broadcast_ring)
+        for member in channel.members:
+            member_client = self.lookup_client(member.nickname)
+            if member_client and member_client.outgoing is not None:
+                member_client.outgoing.subscribe(channel.log)
 
+    def send_to_members(self, channel, msg):
+        if channel.log:
+            channel.log.append(msg)
+            return
+        for member in channel.members:
+            member_client = self.lookup_client(member.nickname)
             if member_client:
                 member_client.send(msg)
 
+    def lock_channel(self, channel, flag):
+        """
+        Sets flag on a flooded channel for channel_flood_lock seconds, unless it is already set.
+        """
+        if channel.mode.has_flag(flag):
+            return
+
+        log.info("flood on %s, setting +%s", channel.name, flag)
+        channel.set_mode(flag)
+        channel.locked.add(flag)
+        self.send_to_members(channel, IRCMessage.mode(self.host, channel.name, "+" + flag))
+        self.server_notice("Flood on {}, set +{}".format(channel.name, flag))
+        try:
+            asyncio.get_running_loop().call_later(self.channel_flood_lock, self.unlock_channel, channel, flag)
+        except RuntimeError:  # no loop, the flag stays until an operator clears it
+            pass
+
+    def unlock_channel(self, channel, flag):
+        if self.channels.get(channel.name) is not channel or flag not in channel.locked:
+            return
+        channel.locked.discard(flag)
+        if channel.clear_mode(flag):
+            self.send_to_members(channel, IRCMessage.mode(self.host, channel.name, "-" + flag))
+
+    def check_channel_message(self, client, channel):
+        nickname = self.get_nickname(client.name)
+        flood = channel.flood
+        if flood and flood.messages and not channel.is_operator(nickname) and flood.messages.hit():
+            self.lock_channel(channel, Mode.CHANNEL_MODERATED)
+
+        if not channel.can_speak(nickname):
+            raise IRCError(IRCMessage.error_cannot_send_to_channel(self.host, client.name, channel.name))
+
+    def filter_message(self, client, message):
+        """
+        Applies content filters, returns the message to deliver or None if it was blocked.
+        """
+        rule = self.filter.check(message)
+        if rule is None:
+            return message
+
+        if rule.action == TAG:
+            message.tags[FILTER_TAG] = Tag.build(FILTER_TAG, rule.name)
+            return message
+
+        log.info("filter %s (%s) matched message from %s", rule.name, rule.action, client.identity)
+        self.server_notice("Filter {} ({}) matched message from {}".format(rule.name, rule.action, client.identity))
+        if rule.action == KILL:
+            client.send(IRCMessage.error_closing_link(client.host, "Killed (filtered)"))
+            self.drop_client(client, "Killed (filtered)")
+        else:
+            client.send(IRCMessage.notice(self.host, client.name, "Message blocked by filter {}".format(rule.name)))
+        return None
+
+    def rehash(self, client):
+        if self.filter.path:
+            try:
+                self.filter.load()
+            except (OSError, re.error) as e:
+                log.error("error reloading filters: %s", e)
+                client.send(IRCMessage.notice(self.host, client.name, "Error reloading filters: {}".format(e)))
+                return
+        log.info("%s rehashed", client.identity)
+        client.send(IRCMessage.reply_rehashing(self.host, client.name, self.filter.path or "filters"))
+
     def send_private_message_to_channel(self, client, channel_name, msg):
         channel = self.get_channel(channel_name)
         if not channel:
             raise IRCError(IRCMessage.error_no_such_channel(self.host, client.name, channel_name))
+        self.check_channel_message(client, channel)
 
-        self.send_to_channel(client, channel, IRCMessage.private_message(client.identity, channel_name, msg.args[1], tags=msg.client_tags), skip_self=True)
+        message = self.filter_message(client, IRCMessage.private_message(client.identity, channel_name, msg.args[1], tags=msg.client_tags))
+        if not message:
+            return
+        self.send_to_channel(client, channel, message, skip_self=True)
+        self.history.add(channel.name, message)
 
     def send_private_message_to_client(self, client, nickname, msg):
         other = self.lookup_client(nickname)
@@ -309,26 +572,44 @@ class IRC:
         if other_nick.is_away:
             client.send(IRCMessage.reply_away(other.identity, client.name, nickname, other_nick.away_message))
         else:
-            other.send(IRCMessage.private_message(client.identity, nickname, msg.args[1], tags=msg.client_tags))
+            message = self.filter_message(client, IRCMessage.private_message(client.identity, nickname, msg.args[1], tags=msg.client_tags))
+            if not message:
+                return
+            other.send(message)
+            key = self.dm_target(client, other)
+            if key:
+                self.history.add(key, message)
 
     def send_notice_to_channel(self, client, channel_name, msg):
         channel = self.get_channel(channel_name)
         if not channel:
             raise IRCError(IRCMessage.error_no_such_channel(self.host, client.name, channel_name))
+        self.check_channel_message(client, channel)
 
-        self.send_to_channel(client, channel, IRCMessage.notice(client.identity, channel_name, msg.args[1], tags=msg.client_tags), skip_self=True)
+        message = self.filter_message(client, IRCMessage.notice(client.identity, channel_name, msg.args[1], tags=msg.client_tags))
+        if not message:
+            return
+        self.send_to_channel(client, channel, message, skip_self=True)
+        self.history.add(channel.name, message)
 
     def send_notice_to_client(self, client, nickname, msg):
         other = self.lookup_client(nickname)
         if not other:
             raise IRCError(IRCMessage.error_no_such_nickname(self.host, client.name, nickname))
 
-        other.send(IRCMessage.notice(client.identity, nickname, msg.args[1], tags=msg.client_tags))
+        message = self.filter_message(client, IRCMessage.notice(client.identity, nickname, msg.args[1], tags=msg.client_tags))
+        if not message:
+            return
+        other.send(message)
+        key = self.dm_target(client, other)
+        if key:
+            self.history.add(key, message)
 
     def send_tag_message_to_channel(self, client, channel_name, msg):
         channel = self.get_channel(channel_name)
         if not channel:
             raise IRCError(IRCMessage.error_no_such_channel(self.host, client.name, channel_name))
+        self.check_channel_message(client, channel)
 
         self.send_to_channel(client, channel, IRCMessage.tag_message(client.identity, channel_name, tags=msg.client_tags), skip_self=True, caps=["message-tags"])
 
@@ -339,6 +620,47 @@ class IRC:
         if "message-tags" in other.capabilities:
             other.send(IRCMessage.tag_message(client.identity, nickname, tags=msg.client_tags))
 
+    def dm_target(self, client, other):
+        """
+        History key for messages between two logged in clients, keyed by account rather than nickname so
+        whoever holds a nickname later can't read the conversation. None if either side has no account.
+        """
+        if not client.account or not other.account:
+            return None
+        return dm_key("account:" + client.account, "account:" + other.account)
+
+    def get_history_target(self, client, target):
+        if target[0] in CHAN_START_CHARS:
+            channel = self.get_channel(target)
+            if not channel or not channel.is_member(self.get_nickname(client.name)):
+                return None
+            return channel.name
+
+        if not client.account:
+            return None
+        # an online nickname stands for its account, otherwise the target is taken as an account name
+        other = self.lookup_client(target)
+        account = other.account if other else target
+        if not account:
+            return None
+        return dm_key("account:" + client.account, "account:" + account)
+
+    def send_history(self, client, subcommand, target, refs, limit):
+        key = self.get_history_target(client, target)
+        if key is None:
+            raise IRCError(IRCMessage.fail(self.host, "CHATHISTORY", "INVALID_TARGET", subcommand, target, "Messages could not be retrieved"))
+
+        def _send(messages):
+            if not client.connected:
+                return
+            batch_id = generate_id()
+            client.send(IRCMessage.batch_start(self.host, batch_id, "chathistory", target))
+            for message in messages:
+                client.send(message.in_batch(batch_id))
+            client.send(IRCMessage.batch_end(self.host, batch_id))
+
+        self.history.query_async(subcommand, key, refs, min(limit, HISTORY_LIMIT), _send)
+
     def ping(self, client):
         client.send(IRCMessage.ping(self.host))
 
@@ -348,25 +670,34 @@ class IRC:
             raise IRCError(IRCMessage.error_no_such_nickname(self.host, client.name, chan_name))
         client.send(IRCMessage.reply_channel_mode_is(self.host, client.name, channel.name, str(channel.mode.mode)))
 
-    def set_channel_mode(self, client, target, flags, param=None):
+    def set_channel_mode(self, client, target, flags, params=()):
         channel = self.get_channel(target)
         nickname = self.get_nickname(client.name)
         if not channel.is_operator(nickname):
             raise IRCError(IRCMessage.error_channel_operator_needed(self.host, client.name, channel.name))
 
-        op, flags = flags[0], flags[1:]
-
-        modified = None
-        try:
+        # check everything before changing anything so a bad mode leaves the channel untouched
+        changes = parse_modes(flags, params)
+        for op, flag, param in changes:
+            if not valid_param(op, flag, param):
+                raise IRCError(IRCMessage.error_needs_more_params(self.host, client.name, "MODE"))
+            if param and flag in "ov" and not channel.get_member(param):
+                raise IRCError(IRCMessage.error_user_not_in_channel(self.host, client.name, param, channel.name))
+
+        applied = []
+        for op, flag, param in changes:
+            # an operator setting or clearing a flag takes it over from flood protection
+            channel.locked.discard(flag)
             if op == "+":
-                modified = channel.set_mode(flags, param=param)
-            elif op == "-":
-                modified = channel.clear_mode(flags, param=param)
-        except ModeParamMissing:
-            raise IRCError(IRCMessage.error_needs_more_params(self.host, client.name, "MODE"))
+                changed = channel.set_mode(flag, param=param)
+            else:
+                changed = channel.clear_mode(flag, param=param)
+            if changed:
+                applied.append((op, flag, param))
 
-        if modified:
-            self.send_to_channel(client, channel, IRCMessage.mode(client.identity, target, op + flags, param))
+        if applied:
+            flags, params = format_modes(applied)
+            self.send_to_channel(client, channel, IRCMessage.mode(client.identity, target, flags, *params))
 
     def send_user_mode(self, client, nick):
         nickname = self.get_nickname(nick)
@@ -406,4 +737,6 @@ class IRC:
         channel.kick(nickname)
 
         other_client = self.lookup_client(nickname.nickname)
+        if channel.log and other_client:
+            other_client.outgoing.unsubscribe(channel.log)
         other_client.send(IRCMessage.kick(client.identity, channel, nickname, comment=comment))
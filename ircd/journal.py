@@ -0,0 +1,346 @@
+import os
+import mmap
+import queue
+import struct
+import hashlib
+import logging
+import datetime
+import threading
+from urllib.parse import quote
+
+from ircd import history
+from ircd.message import IRCMessage
+
+log = logging.getLogger(__name__)
+
+SEGMENT_BYTES = 16 * 1024 * 1024
+FLUSH_INTERVAL = 1.0
+RETENTION = 30 * 24 * 60 * 60
+EXPIRE_INTERVAL = 60
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+# log records are a length prefixed line, the index maps time to offset and message id
+RECORD = struct.Struct("<I")
+INDEX = struct.Struct("<qQ16s")
+DIGEST_OFFSET = 16
+
+
+def to_micros(dt):
+    delta = dt - EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+
+def from_micros(us):
+    return EPOCH + datetime.timedelta(microseconds=us)
+
+
+def digest(msgid):
+    return hashlib.blake2b(msgid.encode(), digest_size=16).digest()
+
+
+def target_path(target):
+    name = target if isinstance(target, str) else ",".join(target)
+    return quote(name, safe="")
+
+
+def load_message(line):
+    message = IRCMessage.parse(line)
+    time = message.tags.pop("time", None)
+    msgid = message.tags.pop("msgid", None)
+    if time:
+        message.time = datetime.datetime.fromisoformat(time.value.rstrip("Z"))
+    if msgid:
+        message.id = msgid.value
+    return message
+
+
+class Segment:
+    def __init__(self, directory, number):
+        self.number = number
+        self.log_path = os.path.join(directory, "{:08d}.log".format(number))
+        self.index_path = os.path.join(directory, "{:08d}.idx".format(number))
+
+        # writer side
+        self.log = None
+        self.index = None
+        self.size = 0
+        self.last = 0
+
+        # reader side
+        self.fd = None
+        self.map = None
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def open_writer(self):
+        self.log = open(self.log_path, "ab")
+        self.index = open(self.index_path, "ab")
+        self.size = self.log.tell()
+        if self.index.tell() >= INDEX.size:
+            with open(self.index_path, "rb") as f:
+                f.seek(-INDEX.size, os.SEEK_END)
+                self.last = INDEX.unpack(f.read(INDEX.size))[0]
+
+    def close_writer(self):
+        if self.log:
+            self.sync()
+            self.log.close()
+            self.index.close()
+            self.log = self.index = None
+
+    def append(self, timestamp, msgid, data):
+        # keep the index ordered for bisection even if the clock steps back
+        timestamp = self.last = max(timestamp, self.last)
+        offset = self.size
+        self.log.write(RECORD.pack(len(data)))
+        self.log.write(data)
+        # the record reaches the file before its index entry is published, so a reader never finds an
+        # entry pointing past the data
+        self.log.flush()
+        self.index.write(INDEX.pack(timestamp, offset, msgid))
+        self.index.flush()
+        self.size += RECORD.size + len(data)
+
+    def flush(self):
+        self.log.flush()
+        self.index.flush()
+
+    def sync(self):
+        self.flush()
+        os.fsync(self.log.fileno())
+        os.fsync(self.index.fileno())
+
+    def refresh(self):
+        try:
+            size = os.path.getsize(self.index_path)
+        except FileNotFoundError:
+            size = 0
+        count = size // INDEX.size
+        if count == self.count:
+            return
+
+        if self.map:
+            self.map.close()
+        if self.fd is None:
+            self.fd = os.open(self.log_path, os.O_RDONLY)
+        with open(self.index_path, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), count * INDEX.size, access=mmap.ACCESS_READ)
+        self.count = count
+
+    def close_reader(self):
+        if self.map:
+            self.map.close()
+            self.map = None
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+        self.count = 0
+
+    def timestamp(self, i):
+        return INDEX.unpack_from(self.map, i * INDEX.size)[0]
+
+    def find_digest(self, msgid):
+        pos = self.map.rfind(msgid) if self.map else -1
+        while pos >= 0 and pos % INDEX.size != DIGEST_OFFSET:
+            pos = self.map.rfind(msgid, 0, pos + len(msgid) - 1)
+        return pos // INDEX.size if pos >= 0 else None
+
+    def read(self, i):
+        _, offset, _ = INDEX.unpack_from(self.map, i * INDEX.size)
+        length, = RECORD.unpack(os.pread(self.fd, RECORD.size, offset))
+        return load_message(os.pread(self.fd, length, offset + RECORD.size).decode())
+
+
+class View:
+    """
+    A read only view over all segments of a target that looks like a history ring buffer.
+    """
+    def __init__(self, segments):
+        self.segments = [segment for segment in segments if len(segment)]
+        self.length = sum(len(segment) for segment in self.segments)
+
+    def __len__(self):
+        return self.length
+
+    def locate(self, i):
+        for segment in self.segments:
+            if i < len(segment):
+                return segment, i
+            i -= len(segment)
+        raise IndexError(i)
+
+    def timestamp(self, i):
+        segment, i = self.locate(i)
+        return from_micros(segment.timestamp(i))
+
+    def find_id(self, msgid):
+        key = digest(msgid)
+        base = self.length
+        for segment in reversed(self.segments):
+            base -= len(segment)
+            i = segment.find_digest(key)
+            if i is not None:
+                return base + i
+        return None
+
+    def slice(self, lo, hi):
+        messages = []
+        for i in range(max(lo, 0), min(hi, self.length)):
+            segment, j = self.locate(i)
+            messages.append(segment.read(j))
+        return messages
+
+
+class TargetLog:
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        numbers = sorted(int(name[:-4]) for name in os.listdir(directory) if name.endswith(".idx"))
+        self.segments = [Segment(directory, number) for number in numbers]
+        # segment numbers keep increasing even once every segment has expired
+        self.next_number = numbers[-1] + 1 if numbers else 0
+
+    @property
+    def current(self):
+        return self.segments[-1] if self.segments else None
+
+    def roll(self):
+        if self.current:
+            self.current.close_writer()
+        segment = Segment(self.directory, self.next_number)
+        self.next_number += 1
+        segment.open_writer()
+        self.segments.append(segment)
+        return segment
+
+
+class Journal:
+    """
+    Append only, segmented on disk message log. Writes are handed off to a background thread that batches and
+    periodically fsyncs them, lookups bisect a memory mapped index and only read the records they return.
+    """
+    def __init__(self, root, segment_bytes=SEGMENT_BYTES, flush_interval=FLUSH_INTERVAL, retention=RETENTION):
+        self.root = root
+        self.segment_bytes = segment_bytes
+        self.flush_interval = flush_interval
+        self.retention = retention
+        self.targets = {}
+        self.lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+        self.pending = queue.SimpleQueue()
+        self.writer = None
+        self.start()
+
+    def start(self):
+        self.writer = threading.Thread(target=self._writer, name="ircd-journal", daemon=True)
+        self.writer.start()
+
+    def get_log(self, target):
+        name = target_path(target)
+        target_log = self.targets.get(name)
+        if target_log is None:
+            target_log = self.targets[name] = TargetLog(os.path.join(self.root, name))
+        return target_log
+
+    def append(self, target, message):
+        tags = message.client_tags + ["time=" + message.time.isoformat() + "Z", "msgid=" + message.id]
+        line = "@" + ";".join(tags) + " " + message.format()
+        self.pending.put((target, to_micros(message.time), digest(message.id), line.encode()))
+
+    def close(self):
+        self.pending.put(None)
+        self.writer.join()
+        with self.lock:
+            for target_log in self.targets.values():
+                for segment in target_log.segments:
+                    segment.close_writer()
+                    segment.close_reader()
+
+    def _write(self, target, timestamp, msgid, data):
+        with self.lock:
+            target_log = self.get_log(target)
+            segment = target_log.current
+            if segment is None or segment.size >= self.segment_bytes:
+                segment = target_log.roll()
+            elif segment.log is None:
+                segment.open_writer()
+            segment.append(timestamp, msgid, data)
+        return segment
+
+    def _writer(self):
+        last_sync = last_expire = datetime.datetime.utcnow()
+        dirty = set()
+        running = True
+        while running:
+            try:
+                batch = [self.pending.get(timeout=self.flush_interval)]
+            except queue.Empty:
+                batch = []
+            while True:
+                try:
+                    batch.append(self.pending.get_nowait())
+                except queue.Empty:
+                    break
+
+            for item in batch:
+                if item is None:
+                    running = False
+                    continue
+                try:
+                    dirty.add(self._write(*item))
+                except OSError:
+                    log.exception("error writing history for %s", item[0])
+
+            now = datetime.datetime.utcnow()
+            if dirty and (not running or (now - last_sync).total_seconds() >= self.flush_interval):
+                for segment in dirty:
+                    if segment.log:
+                        segment.sync()
+                dirty.clear()
+                last_sync = now
+
+            if (now - last_expire).total_seconds() >= EXPIRE_INTERVAL:
+                self.expire(now)
+                last_expire = now
+
+        log.debug("journal writer shutdown")
+
+    def expire(self, now=None):
+        cutoff = to_micros((now or datetime.datetime.utcnow()) - datetime.timedelta(seconds=self.retention))
+        with self.lock:
+            for name in os.listdir(self.root):
+                if name not in self.targets:
+                    self.targets[name] = TargetLog(os.path.join(self.root, name))
+
+            for target_log in self.targets.values():
+                # the current segment goes too once its whole range has expired, the next write rolls a new one
+                while target_log.segments:
+                    segment = target_log.segments[0]
+                    segment.refresh()
+                    if len(segment) and segment.timestamp(len(segment) - 1) >= cutoff:
+                        break
+                    log.info("expiring history segment %s", segment.log_path)
+                    segment.close_writer()
+                    segment.close_reader()
+                    os.unlink(segment.log_path)
+                    os.unlink(segment.index_path)
+                    target_log.segments.pop(0)
+
+    def view(self, target):
+        target_log = self.get_log(target)
+        for segment in target_log.segments:
+            segment.refresh()
+        return View(target_log.segments)
+
+    def find_timestamp(self, target, msgid):
+        with self.lock:
+            view = self.view(target)
+            i = view.find_id(msgid)
+            return view.timestamp(i) if i is not None else None
+
+    def query(self, subcommand, target, refs, limit):
+        with self.lock:
+            return history.query(self.view(target), subcommand, refs, limit)
@@ -6,7 +6,7 @@ class Mask:
         self.nickname = nickname or "*"
         self.user = user or "*"
         self.host = host or "*"
-        self.pattern = re.compile(self.build_pattern(), re.IGNORECASE)
+        self._pattern = None
 
     def __eq__(self, other):
         return isinstance(other, self.__class__) and all([
@@ -21,6 +21,13 @@ class Mask:
     def __repr__(self):
         return "<{}({})>".format(self.__class__.__name__, str(self))
 
+    @property
+    def pattern(self):
+        # compiled on first use so restoring thousands of bans stays cheap
+        if self._pattern is None:
+            self._pattern = re.compile(self.build_pattern(), re.IGNORECASE)
+        return self._pattern
+
     def build_pattern(self):
         glob = lambda s: "(" + s.replace(".", "\.").replace("*", ".+?") + ")"
         return "{nickname}!{user}@{host}$".format(nickname=glob(self.nickname), user=glob(self.user), host=glob(self.host))
@@ -4,6 +4,13 @@ import datetime
 
 TERMINATOR = "\r\n"
 
+# IRCv3 limits in bytes, the message body includes the CRLF and tags include the leading @ and trailing space
+MESSAGE_LIMIT = 512
+TAGS_LIMIT = 8191
+LINE_LIMIT = TAGS_LIMIT + MESSAGE_LIMIT
+
+CHAN_START_CHARS = "&#!+"
+
 
 def utcnow():
     return datetime.datetime.utcnow()
@@ -13,6 +20,51 @@ def generate_id():
     return uuid.uuid4().hex
 
 
+def truncate(s, limit):
+    """
+    s cut to at most limit bytes of UTF-8 without splitting a character.
+    """
+    # no character takes more than 4 bytes, short strings fit without encoding them
+    if len(s) * 4 <= limit:
+        return s
+    data = s.encode()
+    if len(data) <= limit:
+        return s
+    return data[:limit].decode("utf-8", "ignore")
+
+
+def join_tags(tags, limit=TAGS_LIMIT - 2):
+    """
+    Tags joined with ; leaving out any that would take the result past limit bytes.
+    """
+    joined = ";".join(tags)
+    if len(joined) * 4 <= limit or len(joined.encode()) <= limit:
+        return joined
+
+    kept, size = [], 0
+    for tag in tags:
+        length = len(tag.encode()) + (1 if kept else 0)
+        if size + length <= limit:
+            kept.append(tag)
+            size += length
+    return ";".join(kept)
+
+
+def too_long(data):
+    """
+    Whether a line as read, terminator included, is over the tag or message limits.
+    """
+    body = len(data)
+    if data[:1] == b"@":
+        space = data.find(b" ")
+        if space == -1:
+            return body > TAGS_LIMIT
+        if space + 1 > TAGS_LIMIT:
+            return True
+        body -= space + 1
+    return body > MESSAGE_LIMIT
+
+
 # https://stackoverflow.com/questions/930700/python-parsing-irc-messages
 def parsemsg(s):
     """
@@ -90,6 +142,7 @@ class IRCMessage:
         self.tags = {}
         if tags:
             self.tags.update({t.name: t for t in [Tag(tag) for tag in tags]})
+        self._encoded = None
 
     def __str__(self):
         return "{}<command={}, args={}, prefix={}, tags={}, id={}>".format(self.__class__.__name__, self.command, self.args,
@@ -107,17 +160,29 @@ class IRCMessage:
             tail = self.args[-1]
             if tail:
                 parts.append(":" + str(tail))
-        rv = " ".join(parts)
+        rv = truncate(" ".join(parts), MESSAGE_LIMIT - len(TERMINATOR))
 
         if with_time:
             self.tags["time"] = Tag.build("time", self.time.isoformat() + "Z")
         if with_id:
             self.tags["msgid"] = Tag.build("msgid", self.id)
         if with_tags and self.tags:
-            tags = ";".join([tag.tag for tag in self.tags.values()])
+            tags = join_tags([tag.tag for tag in self.tags.values()])
             rv = "@" + tags + " " + rv
         return rv
 
+    def encode(self, with_tags=False, with_time=False, with_id=False):
+        """
+        The line as sent, cached so a message going to many clients is formatted once per set of capabilities.
+        """
+        key = (with_tags, with_time, with_id)
+        if self._encoded is None:
+            self._encoded = {}
+        data = self._encoded.get(key)
+        if data is None:
+            data = self._encoded[key] = (self.format(*key) + TERMINATOR).encode()
+        return data
+
     @property
     def client_tags(self):
         return [tag.tag for tag in self.tags.values() if tag.is_client_tag]
@@ -127,6 +192,12 @@ class IRCMessage:
         tags, prefix, command, args = parsemsg(s)
         return cls(prefix, command, *args, tags=tags)
 
+    def in_batch(self, batch_id):
+        msg = self.__class__(self.prefix, self.command, *self.args, tags=self.client_tags + ["batch=" + batch_id])
+        msg.time = self.time
+        msg.id = self.id
+        return msg
+
     @classmethod
     def error_invalid_cap_subcommand(cls, prefix, nickname, command):
         return cls(prefix, "410", nickname or "*", command, "Invalid capability command")
@@ -144,8 +215,8 @@ class IRCMessage:
         return cls(prefix, "CAP", nickname or "*", "NAK", " ".join(capabilities))
 
     @classmethod
-    def error_sasl_mechanism(cls, prefix, nickname):
-        return cls(prefix, "908", nickname or "*", "PLAIN", "are available sasl mechanisms")
+    def error_sasl_mechanism(cls, prefix, nickname, mechanisms="PLAIN"):
+        return cls(prefix, "908", nickname or "*", mechanisms, "are available sasl mechanisms")
 
     @classmethod
     def sasl_logged_in(cls, prefix, nickname, identity, account):
@@ -159,10 +230,38 @@ class IRCMessage:
     def error_sasl_fail(cls, prefix, nickname):
         return cls(prefix, "904", nickname or "*", "SASL authentication failed")
 
+    @classmethod
+    def error_input_too_long(cls, prefix, target):
+        return cls(prefix, "417", target or "*", "Input line was too long")
+
+    @classmethod
+    def error_closing_link(cls, host, reason):
+        return cls(None, "ERROR", "Closing Link: {} ({})".format(host, reason))
+
+    @classmethod
+    def error_sasl_aborted(cls, prefix, nickname):
+        return cls(prefix, "906", nickname or "*", "SASL authentication aborted")
+
     @classmethod
     def sasl_continue(cls, prefix):
         return cls(prefix, "AUTHENTICATE +")
 
+    @classmethod
+    def sasl_challenge(cls, prefix, data):
+        return cls(prefix, "AUTHENTICATE", data)
+
+    @classmethod
+    def batch_start(cls, prefix, batch_id, batch_type, *params):
+        return cls(prefix, "BATCH", "+" + batch_id, batch_type, *params)
+
+    @classmethod
+    def batch_end(cls, prefix, batch_id):
+        return cls(prefix, "BATCH", "-" + batch_id)
+
+    @classmethod
+    def fail(cls, prefix, command, code, *context):
+        return cls(prefix, "FAIL", command, code, *context)
+
     @classmethod
     def reply_welcome(cls, prefix, target, nickname, user, hostname):
         return cls(prefix, "001", target,
@@ -277,6 +376,51 @@ class IRCMessage:
     def error_channel_operator_needed(cls, prefix, target, name):
         return cls(prefix, "482", target, "{channel} You're not channel operator".format(channel=name))
 
+    @classmethod
+    def error_cannot_send_to_channel(cls, prefix, target, channel):
+        return cls(prefix, "404", target, channel, "Cannot send to channel")
+
+    @classmethod
+    def error_user_not_in_channel(cls, prefix, target, nickname, channel):
+        return cls(prefix, "441", target, nickname, channel, "They aren't on that channel")
+
+    @classmethod
+    def reply_youre_oper(cls, prefix, target):
+        return cls(prefix, "381", target, "You are now an IRC operator")
+
+    @classmethod
+    def reply_rehashing(cls, prefix, target, path):
+        return cls(prefix, "382", target, path, "Rehashing")
+
+    @classmethod
+    def error_password_mismatch(cls, prefix, target):
+        return cls(prefix, "464", target, "Password incorrect")
+
+    @classmethod
+    def error_no_oper_host(cls, prefix, target):
+        return cls(prefix, "491", target, "No O-lines for your host")
+
+    @classmethod
+    def error_no_privileges(cls, prefix, target):
+        return cls(prefix, "481", target, "Permission Denied- You're not an IRC operator")
+
+    @classmethod
+    def reply_stats_link(cls, prefix, target, name, sendq, sent, sent_bytes, received, received_bytes, open_for):
+        return cls(prefix, "211", target, name, str(sendq), str(sent), str(sent_bytes // 1024), str(received),
+                   str(received_bytes // 1024), str(open_for))
+
+    @classmethod
+    def reply_stats_commands(cls, prefix, target, command, count, byte_count=0, remote_count=0):
+        return cls(prefix, "212", target, command, str(count), str(byte_count), str(remote_count))
+
+    @classmethod
+    def reply_end_stats(cls, prefix, target, query):
+        return cls(prefix, "219", target, query, "End of STATS report")
+
+    @classmethod
+    def reply_stats_debug(cls, prefix, target, text):
+        return cls(prefix, "249", target, text)
+
     @classmethod
     def error_users_dont_match(cls, prefix, target):
         return cls(prefix, "502", target, "Cant change mode for other users")
@@ -308,13 +452,21 @@ class IRCMessage:
     def tag_message(cls, prefix, target, tags):
         return cls(prefix, "TAGMSG", target, tags=tags)
 
+    @classmethod
+    def wallops(cls, prefix, text):
+        return cls(prefix, "WALLOPS", text)
+
+    @classmethod
+    def server_notice(cls, prefix, target, text):
+        return cls(prefix, "NOTICE", target, "*** " + text)
+
     @classmethod
     def ping(cls, server):
         return cls(server, "PING", server)
 
     @classmethod
-    def mode(cls, prefix, target, flags, params=None):
-        return cls(prefix, "MODE", target, flags, params)
+    def mode(cls, prefix, target, flags, *params):
+        return cls(prefix, "MODE", target, flags, *params)
 
     @classmethod
     def quit(cls, prefix, message):
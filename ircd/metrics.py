@@ -0,0 +1,217 @@
+import asyncio
+import logging
+from bisect import bisect_left
+
+log = logging.getLogger(__name__)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+REQUEST_TIMEOUT = 10
+
+LATENCY_BUCKETS = (.0001, .00025, .0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5)
+# command handlers mostly finish in tens of microseconds
+COMMAND_BUCKETS = (.00001, .000025, .00005) + LATENCY_BUCKETS
+SIZE_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+# metrics are only ever updated from the event loop, so plain attribute updates are all the locking needed
+
+class Counter:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def collect(self):
+        return self.value
+
+
+class Gauge:
+    __slots__ = ("value", "func")
+
+    def __init__(self, func=None):
+        self.value = 0
+        self.func = func
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def collect(self):
+        return self.func() if self.func else self.value
+
+
+class Histogram:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        # the last slot counts everything above the largest bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """
+        Upper bound of the bucket holding the q-th observation, inf when it is past the largest bucket.
+        """
+        if not self.count:
+            return None
+        rank, seen = q * self.count, 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+    def collect(self):
+        return self.buckets, list(self.counts), self.sum, self.count
+
+
+class Family:
+    """
+    A named metric, with one child per combination of label values.
+    """
+    def __init__(self, kind, name, help, labels=(), factory=None, source=None):
+        self.kind = kind
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self.factory = factory
+        self.children = {}
+        # returns every (label values, value) pair at collection time, for series that come and go
+        self.source = source
+
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            child = self.children[values] = self.factory()
+        return child
+
+    def collect(self):
+        if self.source:
+            return list(self.source())
+        return [(values, child.collect()) for values, child in self.children.items()]
+
+
+class Registry:
+    def __init__(self):
+        self.families = {}
+
+    def _register(self, kind, name, help, labels, factory, source=None):
+        if name in self.families:
+            raise ValueError("duplicate metric: {}".format(name))
+        family = self.families[name] = Family(kind, name, help, labels, factory, source)
+        return family if labels else family.labels()
+
+    def counter(self, name, help, labels=()):
+        return self._register("counter", name, help, labels, Counter)
+
+    def gauge(self, name, help, labels=(), func=None):
+        """
+        With labels, func returns the (label values, value) pairs of the whole family when collected.
+        """
+        if labels and func:
+            return self._register("gauge", name, help, labels, None, source=func)
+        return self._register("gauge", name, help, labels, lambda: Gauge(func))
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        return self._register("histogram", name, help, labels, lambda: Histogram(buckets))
+
+    def get(self, name):
+        family = self.families[name]
+        return family if family.label_names else family.labels()
+
+    def collect(self):
+        """
+        Copies the current values, cheap enough to run on the event loop.
+        """
+        return [(family.kind, family.name, family.help, family.label_names, family.collect())
+                for family in self.families.values()]
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(name, _escape(value)) for name, value in pairs) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render(collected):
+    """
+    Renders collected metrics in the Prometheus text exposition format.
+    """
+    lines = []
+    for kind, name, help, label_names, samples in collected:
+        lines.append("# HELP {} {}".format(name, help))
+        lines.append("# TYPE {} {}".format(name, kind))
+        for values, data in samples:
+            if kind != "histogram":
+                lines.append("{}{} {}".format(name, _format_labels(label_names, values), _format_value(data)))
+                continue
+
+            buckets, counts, total, count = data
+            cumulative = 0
+            for bound, bucket_count in zip(buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                labels = _format_labels(label_names, values, [("le", _format_value(bound))])
+                lines.append("{}_bucket{} {}".format(name, labels, cumulative))
+            lines.append("{}_sum{} {}".format(name, _format_labels(label_names, values), _format_value(total)))
+            lines.append("{}_count{} {}".format(name, _format_labels(label_names, values), count))
+    return "\n".join(lines) + "\n"
+
+
+async def _handle(registry, reader, writer):
+    try:
+        request = await asyncio.wait_for(reader.readline(), REQUEST_TIMEOUT)
+        while (await asyncio.wait_for(reader.readline(), REQUEST_TIMEOUT)).strip():
+            pass
+
+        parts = request.decode("latin-1").split()
+        if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+            collected = registry.collect()
+            body = (await asyncio.get_running_loop().run_in_executor(None, render, collected)).encode()
+            status = "200 OK"
+        else:
+            body, status = b"not found\n", "404 Not Found"
+
+        writer.write("HTTP/1.0 {}\r\nContent-Type: {}\r\nContent-Length: {}\r\n\r\n".format(
+            status, CONTENT_TYPE, len(body)).encode() + body)
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def serve(registry, addr, port):
+    log.info("serving metrics on %s:%s", addr, port)
+
+    async def _on_connect(reader, writer):
+        await _handle(registry, reader, writer)
+
+    server = await asyncio.start_server(_on_connect, addr, port)
+    async with server:
+        await server.serve_forever()
@@ -1,179 +1,126 @@
 from ircd.mask import Mask
+from ircd.flood import ChannelFlood
 
 
 class ModeParamMissing(ValueError):
     pass
 
 
-class ModeFlag:
-    KEY = None
+# mode strings list flags in this order
+USER_MODES = "aiwrOso"
+CHANNEL_MODES = "psitnmlbevkof"
 
-    def __init__(self):
-        self.value = False
+# channel modes that take a parameter when set and when cleared
+SET_PARAMS = "klbeovf"
+CLEAR_PARAMS = "kbeov"
 
-    def set(self, param=None):
-        self.value = True
+# modes with a parameter accepted per MODE line, advertised as MODES=
+MODES = 4
 
-    def clear(self, param=None):
-        self.value = False
 
-    def is_set(self):
-        return self.value
+def flag_bits(modes):
+    return {flag: 1 << i for i, flag in enumerate(modes)}
 
 
-class UserModeFlag(ModeFlag):
-    def __init__(self, nickname):
-        super(UserModeFlag, self).__init__()
-        self.nickname = nickname
-
-
-class ChannelModeFlag(ModeFlag):
-    def __init__(self, channel):
-        super(ChannelModeFlag, self).__init__()
-        self.channel = channel
-
-
-class UserAwayFlag(UserModeFlag):
-    KEY = "a"
-
-
-class UserInvisibleFlag(UserModeFlag):
-    KEY = "i"
-
-
-class UserWallopsFlag(UserModeFlag):
-    KEY = "w"
-
-
-class UserRestrictedFlag(UserModeFlag):
-    KEY = "r"
-
-
-class UserLocalOperatorFlag(UserModeFlag):
-    KEY = "O"
-
-
-class UserOperatorFlag(UserModeFlag):
-    KEY = "o"
-
-
-class UserServerNoticesFlag(UserModeFlag):
-    KEY = "s"
-
-
-class ChannelPrivateFlag(ChannelModeFlag):
-    KEY = "p"
-
-
-class ChannelInviteOnlyFlag(ChannelModeFlag):
-    KEY = "i"
-
-
-class ChannelTopicClosedFlag(ChannelModeFlag):
-    KEY = "t"
-
-
-class ChannelNoMessagesFlag(ChannelModeFlag):
-    KEY = "n"
-
-
-class ChannelModeratedFlag(ChannelModeFlag):
-    KEY = "m"
-
-
-class ChannelUserLimitFlag(ChannelModeFlag):
-    KEY = "l"
-
-
-class MaskFlag(ChannelModeFlag):
-
-    def add_mask(self, mask):
-        pass
-
-    def clear_mask(self, mask):
-        pass
-
-    def parse(self, param):
-        return Mask.parse(param) if param else None
-
-    def set(self, param=None):
-        super(MaskFlag, self).set(param=param)
-        mask = self.parse(param)
-        if mask:
-            self.add_mask(mask)
-
-    def clear(self, param=None):
-        super(MaskFlag, self).clear(param=param)
-        mask = self.parse(param)
-        if mask:
-            self.clear_mask(mask)
-
-
-class ChannelBanMaskFlag(MaskFlag):
-    KEY = "b"
-
-    def add_mask(self, mask):
-        self.channel.add_ban(mask)
-
-    def clear_mask(self, mask):
-        self.channel.remove_ban(mask)
-
-
-class ChannelExceptionMaskFlag(MaskFlag):
-    KEY = "e"
-
-    def add_mask(self, mask):
-        self.channel.add_exception(mask)
-
-    def clear_mask(self, mask):
-        self.channel.remove_exception(mask)
-
-
-class ChannelVoiceFlag(ChannelModeFlag):
-    KEY = "v"
-
-
-class ChannelKeyFlag(ChannelModeFlag):
-    KEY = "k"
-
-    def set(self, param=None):
-        if not param:
-            raise ModeParamMissing()
-
-        super(ChannelKeyFlag, self).set(param=param)
-        self.channel.key = param
-
-    def clear(self, param=None):
-        super(ChannelKeyFlag, self).clear(param=param)
-        self.channel.key = None
-
-
-class ChannelSecretFlag(ChannelModeFlag):
-    KEY = "s"
-
-
-class ChannelOperatorFlag(ChannelModeFlag):
-    KEY = "o"
-
-    def set(self, param=None):
-        if not param:
-            raise ModeParamMissing()
-
-        super(ChannelOperatorFlag, self).set(param=param)
-        nickname = self.channel.get_member(param)
-        if nickname not in self.channel.operators:
-            self.channel.operators.append(nickname)
-
-    def clear(self, param=None):
-        if not param:
-            raise ModeParamMissing()
-
-        nickname = self.channel.get_member(param)
-        if nickname and nickname in self.channel.operators:
-            self.channel.operators.remove(nickname)
+def parse_modes(flags, params, limit=MODES):
+    """
+    Splits a mode string like "+ov-b" into (op, flag, param) changes, handing out params in order. A param left
+    over after a mode string that starts with + or - is another mode string, as in "-k key +o bob". Modes past
+    the limit of parameters are dropped, params that run out are None.
+    """
+    params = list(params)
+    changes = []
+    op = "+"
+    with_param = 0
+    while True:
+        for flag in flags:
+            if flag in "+-":
+                op = flag
+                continue
+
+            param = None
+            if flag in (SET_PARAMS if op == "+" else CLEAR_PARAMS):
+                with_param += 1
+                if with_param > limit:
+                    continue
+                param = params.pop(0) if params else None
+            changes.append((op, flag, param))
+
+        if not params or params[0][:1] not in ("+", "-"):
+            return changes
+        flags = params.pop(0)
+
+
+def valid_param(op, flag, param):
+    """
+    Whether a parsed change has the parameter it needs, checked before any change is applied.
+    """
+    if op == "+":
+        if flag in "ko":
+            return bool(param)
+        if flag == "f":
+            return ChannelFlood.parse(param) is not None
+    return flag != "o" or bool(param)
+
+
+def format_modes(changes):
+    """
+    The mode string and params for applied changes, with the inverse of parse_modes' grouping.
+    """
+    flags, params, last_op = [], [], None
+    for op, flag, param in changes:
+        if op != last_op:
+            flags.append(op)
+            last_op = op
+        flags.append(flag)
+        if param:
+            params.append(param)
+    return "".join(flags), params
+
+
+class ModeIndex:
+    """
+    The nicknames with each user mode flag, kept up to date by Nickname as its flags change.
+    """
+    def __init__(self, flags=USER_MODES):
+        self.sets = {flag: set() for flag in flags}
+        # operators with +s, who receive server notices
+        self.server_notices = set()
+
+    def __getitem__(self, flag):
+        return self.sets[flag]
+
+    def update(self, nickname, flags):
+        for flag in flags:
+            members = self.sets.get(flag)
+            if members is None:
+                continue
+            if nickname.mode.has_flag(flag):
+                members.add(nickname)
+            else:
+                members.discard(nickname)
+
+        if Mode.OPERATOR in flags or Mode.SERVER_NOTICES in flags:
+            if nickname.mode.has_flag(Mode.OPERATOR) and nickname.mode.has_flag(Mode.SERVER_NOTICES):
+                self.server_notices.add(nickname)
+            else:
+                self.server_notices.discard(nickname)
+
+    def remove(self, nickname):
+        for members in self.sets.values():
+            members.discard(nickname)
+        self.server_notices.discard(nickname)
 
 
 class Mode:
+    """
+    Flags packed into a single int, parameters live in fields on the channel or nickname the mode belongs to.
+    """
+    __slots__ = ("target", "bits", "_mode")
+
+    FLAGS = {}
+    # flags with parameters handled by _set_param and _clear_param
+    PARAMS = ""
 
     AWAY = "a"
     INVISIBLE = "i"
@@ -188,41 +135,48 @@ class Mode:
     CHANNEL_IS_SECRET = "s"
     CHANNEL_KEY = "k"
     CHANNEL_IS_INVITE_ONLY = "i"
+    CHANNEL_MODERATED = "m"
+    CHANNEL_FLOOD = "f"
 
-    ALL_USER_MODES = (UserAwayFlag, UserInvisibleFlag, UserWallopsFlag, UserRestrictedFlag,
-                      UserLocalOperatorFlag, UserServerNoticesFlag, UserOperatorFlag)
-    ALL_CHANNEL_MODES = (ChannelPrivateFlag, ChannelSecretFlag, ChannelInviteOnlyFlag,
-                         ChannelTopicClosedFlag, ChannelNoMessagesFlag, ChannelModeratedFlag,
-                         ChannelUserLimitFlag, ChannelBanMaskFlag, ChannelExceptionMaskFlag,
-                         ChannelVoiceFlag, ChannelKeyFlag, ChannelOperatorFlag)
+    ALL_USER_MODES = USER_MODES
+    ALL_CHANNEL_MODES = CHANNEL_MODES
 
-    def __init__(self, flags):
-        self.flags = {flag.KEY: flag for flag in flags}
+    def __init__(self, target):
+        self.target = target
+        self.bits = 0
+        self._mode = None
 
     @classmethod
     def for_nickname(cls, nickname):
-        flags = [flag_class(nickname) for flag_class in cls.ALL_USER_MODES]
-        return cls(flags)
+        return UserMode(nickname)
 
     @classmethod
     def for_channel(cls, channel):
-        flags = [flag_class(channel) for flag_class in cls.ALL_CHANNEL_MODES]
-        return cls(flags)
+        return ChannelMode(channel)
 
     @property
     def mode(self):
-        return "".join(key for key, flag in self.flags.items() if flag.is_set())
+        if self._mode is None:
+            self._mode = "".join(flag for flag, bit in self.FLAGS.items() if self.bits & bit)
+        return self._mode
 
     def has_flag(self, flag):
-        if flag not in self.flags:
-            return False
-        return self.flags[flag].is_set()
+        return (self.bits & self.FLAGS.get(flag, 0)) != 0
+
+    def _set_param(self, flag, param):
+        pass
+
+    def _clear_param(self, flag, param):
+        return True
 
     def clear_flag(self, flag, param=None):
-        is_set = self.has_flag(flag)
-        if is_set:
-            self.flags[flag].clear(param=param)
-        return is_set
+        bit = self.FLAGS.get(flag, 0)
+        if not self.bits & bit:
+            return False
+        if flag not in self.PARAMS or self._clear_param(flag, param):
+            self.bits &= ~bit
+            self._mode = None
+        return True
 
     def clear_flags(self, flags, param=None):
         cleared_flags = []
@@ -232,11 +186,14 @@ class Mode:
         return "".join(cleared_flags)
 
     def set_flag(self, flag, param=None):
-        flag_set = False
-        if flag in self.flags:
-            self.flags[flag].set(param=param)
-            flag_set = True
-        return flag_set
+        bit = self.FLAGS.get(flag)
+        if bit is None:
+            return False
+        if flag in self.PARAMS:
+            self._set_param(flag, param)
+        self.bits |= bit
+        self._mode = None
+        return True
 
     def set_flags(self, flags, param=None):
         set_flags = []
@@ -244,3 +201,76 @@ class Mode:
             if self.set_flag(flag, param=param):
                 set_flags.append(flag)
         return "".join(set_flags)
+
+
+class UserMode(Mode):
+    __slots__ = ()
+
+    FLAGS = flag_bits(USER_MODES)
+
+
+class ChannelMode(Mode):
+    __slots__ = ()
+
+    FLAGS = flag_bits(CHANNEL_MODES)
+    PARAMS = SET_PARAMS
+
+    def _set_param(self, flag, param):
+        channel = self.target
+        if flag == "k":
+            if not param:
+                raise ModeParamMissing()
+            channel.key = param
+        elif flag == "l":
+            channel.limit = int(param) if param and param.isdigit() else None
+        elif flag == "b" or flag == "e":
+            mask = Mask.parse(param) if param else None
+            if mask:
+                if flag == "b":
+                    channel.add_ban(mask)
+                else:
+                    channel.add_exception(mask)
+        elif flag == "o":
+            if not param:
+                raise ModeParamMissing()
+            nickname = channel.get_member(param)
+            if nickname not in channel.operators:
+                channel.operators.append(nickname)
+        elif flag == "v":
+            nickname = channel.get_member(param) if param else None
+            if nickname and nickname not in channel.voiced:
+                channel.voiced.append(nickname)
+        elif flag == "f":
+            flood = ChannelFlood.parse(param)
+            if not flood:
+                raise ModeParamMissing()
+            channel.flood = flood
+
+    def _clear_param(self, flag, param):
+        channel = self.target
+        if flag == "k":
+            channel.key = None
+        elif flag == "l":
+            channel.limit = None
+        elif flag == "b" or flag == "e":
+            mask = Mask.parse(param) if param else None
+            if mask:
+                if flag == "b":
+                    channel.remove_ban(mask)
+                else:
+                    channel.remove_exception(mask)
+        elif flag == "o":
+            if not param:
+                raise ModeParamMissing()
+            nickname = channel.get_member(param)
+            if nickname and nickname in channel.operators:
+                channel.operators.remove(nickname)
+            # taking ops from one member leaves the flag set
+            return False
+        elif flag == "v":
+            nickname = channel.get_member(param) if param else None
+            if nickname and nickname in channel.voiced:
+                channel.voiced.remove(nickname)
+        elif flag == "f":
+            channel.flood = None
+        return True
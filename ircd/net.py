@@ -1,4 +1,7 @@
+import os
 import time
+import heapq
+import socket
 import asyncio
 import logging
 
@@ -8,11 +11,38 @@ except ImportError:
     websockets = None
 
 from .message import Prefix
-from .message import IRCMessage, TERMINATOR
+from .message import IRCMessage, TERMINATOR, LINE_LIMIT, too_long
+from .flood import FloodControl, EXCESS_FLOOD
+from .sched import FairQueue, LaneQueue, QUANTUM, LINK_WEIGHT, lane_for
+from .clones import TOO_MANY_CONNECTIONS
+from .broadcast import SENDQ_EXCEEDED
 
 PING_INTERVAL = 30
 PING_GRACE = 5
-IDENT_TIMEOUT = 10
+PAUSE_DRAIN_TRIES = 100
+
+# limits on connections that haven't completed NICK and USER (or SERVER)
+REGISTRATION_TIMEOUT = 30
+PREREG_COMMANDS = 32
+PREREG_BYTES = 8192
+MAX_UNREGISTERED = 1024
+REGISTRATION_TIMED_OUT = "Registration timed out"
+REGISTRATION_FLOOD = "Too much data before registration"
+SERVER_BUSY = "Server is busy"
+
+# queue: the processor handles one message per wakeup
+# batch: the processor handles everything pending per wakeup
+# inline: readers process their own messages directly unless they already have some queued
+PROCESS_QUEUE = "queue"
+PROCESS_BATCH = "batch"
+PROCESS_INLINE = "inline"
+PROCESS_MODES = (PROCESS_QUEUE, PROCESS_BATCH, PROCESS_INLINE)
+BATCH_LIMIT = 1024
+INLINE_BATCH = 16
+# queued messages written to a client in one go
+WRITE_BATCH = 64
+# clients with the longest incoming queues exported individually
+TOP_QUEUES = 10
 
 
 QUIT_MESSAGE = "goodbye"
@@ -22,12 +52,17 @@ log = logging.getLogger(__name__)
 
 
 class Client:
-    def __init__(self, address, host, link=False):
+    # messages queued to any client, the dispatcher diffs it to count what each command sends
+    queued = 0
+
+    def __init__(self, address, host, link=False, stream=None):
         self.address = address
         self.host = host or address
         self.link = link
 
         self.name = None
+        # the connection holds a clone count, released once when it goes
+        self.counted = False
         self.connected_at = time.time()
         self.connected = True
         self.disconnected_at = None
@@ -41,11 +76,30 @@ class Client:
         # fields if user
         self.user = None
         self.realname = None
+        # None without an ident lookup, False until one succeeds, then the user it returned
+        self.ident = None
         self.authentication_method = None
-
-        self.outgoing = asyncio.Queue()
+        self.account = None
+        self.sasl = None
+        # a password verification is in flight
+        self.verifying = False
+
+        # given a stream, replies are written straight to it until registration when the queue is created and
+        # on_registered is called to start a writer
+        self.stream = stream
+        self.outgoing = None if stream else LaneQueue()
+        self.on_registered = None
+        # set while the server processes this client's own message, what it sends back goes in the direct lane
+        self.replying = False
         self.ping_count = 0
         self.capabilities = []
+        self.handler = None
+        self.flood = None
+
+        self.messages_in = 0
+        self.bytes_in = 0
+        self.messages_out = 0
+        self.bytes_out = 0
 
     def __str__(self):
         return "<Client({})>".format(self.identity)
@@ -60,6 +114,8 @@ class Client:
 
     def set_identity(self, user, realname):
         self.user, self.realname = user, realname
+        if self.has_identity:
+            self._registered()
 
     def set_server(self, name, hop_count, token, info):
         self.server = True
@@ -67,14 +123,38 @@ class Client:
         self.hop_count = hop_count
         self.token = token
         self.info = info
+        self._registered()
+
+    def _registered(self):
+        if self.outgoing is not None:
+            return
+        self.outgoing = LaneQueue()
+        self.stream = None
+        if self.on_registered:
+            self.on_registered()
+
+    @property
+    def registered(self):
+        return self.server or self.has_identity
 
     def send(self, msg):
-        self.outgoing.put_nowait(msg)
+        Client.queued += 1
+        if self.outgoing is not None:
+            self.outgoing.put_nowait(msg, lane_for(msg, self.replying))
+        elif not self.stream.is_closing():
+            data = format_message(self, msg)
+            self.stream.write(data)
+            self.messages_out += 1
+            self.bytes_out += len(data)
 
     def disconnect(self):
         self.connected = False
         self.disconnected_at = time.time()
-        self.send(None)
+        if self.outgoing is not None:
+            self.outgoing.put_nowait(None)
+        else:
+            # nothing is queued, what was written is flushed before the close
+            self.stream.close()
 
     def clear_ping_count(self):
         self.ping_count = 0
@@ -104,20 +184,82 @@ class Client:
         return "message-ids" in self.capabilities
 
 
-async def readline(stream):
-    return (await stream.readuntil(TERMINATOR.encode())).decode().strip()
+class LineReader:
+    """
+    Splits lines off a stream through a buffer of its own, so input received but not yet handled can be
+    measured for flood control and handed to another process on upgrade. A line longer than limit is skipped
+    a buffer at a time rather than read whole.
+    """
+    def __init__(self, stream, limit=LINE_LIMIT, buffered=b""):
+        self.stream = stream
+        self.limit = limit
+        self.buffer = bytearray(buffered)
+        # the rest of an over long line is being skipped
+        self.skipping = False
+
+    def __len__(self):
+        return len(self.buffer)
+
+    async def readline(self):
+        """
+        The next line as bytes without its terminator, None if it was over the length limits.
+        """
+        terminator = TERMINATOR.encode()
+        while True:
+            end = self.buffer.find(terminator)
+            if end >= 0:
+                data = bytes(self.buffer[:end + len(terminator)])
+                del self.buffer[:end + len(terminator)]
+                if self.skipping:
+                    self.skipping = False
+                    return None
+                if too_long(data):
+                    return None
+                return data.strip()
+
+            if len(self.buffer) > self.limit:
+                # keep what could be the start of a terminator
+                del self.buffer[:1 - len(terminator)]
+                self.skipping = True
+
+            data = await self.stream.read(self.limit)
+            if not data:
+                raise asyncio.IncompleteReadError(bytes(self.buffer), None)
+            self.buffer += data
+
+    async def take(self):
+        """
+        Everything received and not yet returned, once the transport has stopped reading.
+        """
+        while True:
+            read = asyncio.ensure_future(self.stream.read(self.limit))
+            # a read with data waiting completes on its first step
+            await asyncio.sleep(0)
+            if not read.done():
+                read.cancel()
+                break
+            data = read.result()
+            if not data:
+                break
+            self.buffer += data
+        return bytes(self.buffer)
 
 
-async def write_message(client, stream, message):
-    line = message.format(
+def format_message(client, message):
+    return message.encode(
         with_tags=client.has_message_tags,
         with_time=client.has_server_time,
         with_id=client.has_message_id,
-    ) + TERMINATOR
-    bytes = line.encode()
-    stream.write(bytes)
+    )
+
+
+async def write_messages(client, stream, messages):
+    data = b"".join(format_message(client, message) for message in messages)
+    stream.write(data)
+    client.messages_out += len(messages)
+    client.bytes_out += len(data)
     await stream.drain()
-    log.debug("wrote to %s: %s", client, bytes)
+    log.debug("wrote %d messages to %s", len(messages), client)
 
 
 async def resolve_peerinfo(address, port):
@@ -125,33 +267,99 @@ async def resolve_peerinfo(address, port):
     return address, port, client_host
 
 
+class Connection:
+    def __init__(self, reader, writer, reader_task):
+        self.reader = reader
+        self.writer = writer
+        self.reader_task = reader_task
+        self.writer_task = None
+
+
 class Server:
-    def __init__(self, irc, ping_interval=PING_INTERVAL):
+    def __init__(self, irc, ping_interval=PING_INTERVAL, flood=None, quantum=QUANTUM, link_weight=LINK_WEIGHT,
+                 mode=PROCESS_QUEUE, registration_timeout=REGISTRATION_TIMEOUT, max_unregistered=MAX_UNREGISTERED,
+                 ident=None):
+        if mode not in PROCESS_MODES:
+            raise ValueError("unknown process mode: {}".format(mode))
         self.irc = irc
+        self.mode = mode
+        self.flood = flood or FloodControl()
+        self.quantum = quantum
+        self.link_weight = link_weight
         self.servers = []
         self.clients = []
         self.tasks = []
         self.running = asyncio.Event()
         self.ping_interval = ping_interval
+        self.incoming = None
+        self.connections = {}
+        self.registration_timeout = registration_timeout
+        self.max_unregistered = max_unregistered
+        self.ident = ident
+        # connections accepted here that haven't registered yet
+        self.unregistered = set()
+        # accepted connections still waiting on their peer lookup, they count as unregistered too
+        self.connecting = 0
+        self.paused = False
+        # (client, message) being processed, read by the watchdog when the loop stalls
+        self.current = None
+
+        metrics = irc.metrics
+        self.messages_sent = metrics.counter("ircd_messages_sent_total", "Messages written to clients")
+        self.connections_accepted = metrics.counter("ircd_connections_total", "Connections accepted")
+        self.connections_rejected = metrics.counter(
+            "ircd_connections_rejected_total", "Connections refused for going over a clone limit")
+        metrics.gauge("ircd_connections", "Open connections", func=lambda: len(self.connections))
+        metrics.gauge("ircd_unregistered", "Connections yet to register",
+                      func=lambda: len(self.unregistered) + self.connecting)
+        metrics.gauge("ircd_incoming_depth", "Messages waiting to be processed",
+                      func=lambda: len(self.incoming) if self.incoming else 0)
+        metrics.gauge("ircd_incoming_depth_max", "Most messages waiting from a single client",
+                      func=lambda: max((depth for _, depth, _ in self.incoming.stats()), default=0) if self.incoming else 0)
+        metrics.gauge("ircd_incoming_head_latency_seconds", "Longest a queued message has been waiting",
+                      func=lambda: max((latency for _, _, latency in self.incoming.stats()), default=0) if self.incoming else 0)
+        metrics.gauge("ircd_incoming_client_depth", "Messages waiting from each of the clients queueing the most",
+                      labels=("client",), func=lambda: self.top_incoming(1))
+        metrics.gauge("ircd_incoming_client_head_latency_seconds",
+                      "Longest a queued message has been waiting for each of the clients waiting the longest",
+                      labels=("client",), func=lambda: self.top_incoming(2))
+        metrics.gauge("ircd_sendq_total", "Messages waiting to be written to clients",
+                      func=lambda: sum(client.outgoing.qsize() for client in self.connections
+                                       if client.outgoing is not None))
+        metrics.gauge("ircd_sendq_max", "Most messages waiting to be written to a single client",
+                      func=lambda: max((client.outgoing.qsize() for client in self.connections
+                                        if client.outgoing is not None), default=0))
 
     async def run(self, client_listen_addr, client_listen_port,
                   link_listen_addr=None, link_listen_port=None,
                   peer_addr=None, peer_port=None,
-                  ws_addr=None, ws_port=None):
+                  ws_addr=None, ws_port=None, takeover=None):
         log.info("Server %s start", self.irc.host)
-        incoming = asyncio.Queue()
+        incoming = self.incoming = FairQueue(self.quantum, self.link_weight)
         irc_processor = asyncio.create_task(self._irc_processor(incoming))
         self.tasks.append(irc_processor)
-        client_listener = asyncio.create_task(self._listener(client_listen_addr, client_listen_port, False, incoming))
-        coros = [irc_processor, client_listener]
-
-        if link_listen_addr and link_listen_port:
-            link_listener = asyncio.create_task(self._listener(link_listen_addr, link_listen_port, True, incoming))
-            coros.append(link_listener)
-
-        if peer_addr and peer_port:
-            peer_conn = asyncio.create_task(self.connect(peer_addr, peer_port, True))
-            coros.append(peer_conn)
+        coros = [irc_processor]
+
+        if takeover:
+            # listeners and connections are inherited from the process we are replacing
+            for sock, link in takeover.listeners:
+                coros.append(asyncio.create_task(self._listener(None, None, link, incoming, sock=sock)))
+            for client, sock, buffered, pending in takeover.connections:
+                if not client.link:
+                    self.irc.clones.add(client.address)
+                    client.counted = True
+                await self.resume(client, sock, buffered, pending)
+            takeover.done()
+        else:
+            coros.append(asyncio.create_task(self._listener(client_listen_addr, client_listen_port, False, incoming)))
+
+            if link_listen_addr and link_listen_port:
+                link_listener = asyncio.create_task(self._listener(link_listen_addr, link_listen_port, True, incoming))
+                coros.append(link_listener)
+
+            if peer_addr and peer_port:
+                peer_conn = asyncio.create_task(self.connect(peer_addr, peer_port, incoming))
+                coros.append(peer_conn)
 
         if websockets and ws_addr and ws_port:
             log.info("starting ws server on %s:%s", ws_addr, ws_port)
@@ -165,10 +373,18 @@ class Server:
         await asyncio.gather(*coros)
 
     async def shutdown(self):
+        writers = []
         for client, stream in self.clients:
-            await self._drop_client(client, stream)
-
-        for server in self.servers:
+            connection = self.connections.get(client)
+            if connection and connection.writer_task:
+                # the writer flushes what is queued and closes the connection itself
+                self.irc.drop_client(client, QUIT_MESSAGE)
+                writers.append(connection.writer_task)
+            else:
+                await self._drop_client(client, stream)
+        await asyncio.gather(*writers, return_exceptions=True)
+
+        for server, _ in self.servers:
             server.close()
         self.servers = []
 
@@ -179,18 +395,44 @@ class Server:
             except asyncio.CancelledError:
                 pass
 
+        self.irc.shutdown()
         self.running.clear()
 
     async def _client_writer(self, client, stream):
         last_ping = time.time()
-        while client.connected:
+        while True:
             try:
                 message = await asyncio.wait_for(client.outgoing.get(), self.ping_interval)
             except asyncio.TimeoutError:
                 message = None
+            except asyncio.CancelledError:
+                if self.paused:
+                    return
+                raise
 
             if message:
-                await write_message(client, stream, message)
+                # whatever else is waiting goes out in the same write, still in lane order
+                messages = [message]
+                while len(messages) < WRITE_BATCH:
+                    message = client.outgoing.next_message()
+                    if message is None:
+                        break
+                    messages.append(message)
+                try:
+                    await write_messages(client, stream, messages)
+                except ConnectionError:
+                    log.info("error writing to: %s", client.address)
+                    break
+                self.messages_sent.inc(len(messages))
+            elif not client.connected:
+                # everything queued before the disconnect has been written
+                break
+
+            if client.outgoing.overrun:
+                log.info("%s fell too far behind a broadcast log", client.address)
+                stream.write(IRCMessage.error_closing_link(client.host, SENDQ_EXCEEDED).encode())
+                self.irc.drop_client(client, SENDQ_EXCEEDED)
+                break
 
             diff = time.time() - last_ping
 
@@ -205,35 +447,266 @@ class Server:
         log.debug("client writer for %s (%s) shutdown", client.address, client.host)
 
     async def _on_connect(self, reader, writer, link, incoming):
-        host, port = writer.get_extra_info('peername')
-        client_address, client_port, client_host = await resolve_peerinfo(host, port)
+        host, port = writer.get_extra_info('peername')[:2]
+        if not link and len(self.unregistered) + self.connecting >= self.max_unregistered:
+            await self._reject(host, writer, SERVER_BUSY)
+            return
+        if not link and not self.irc.clones.admit(host):
+            await self._reject(host, writer, TOO_MANY_CONNECTIONS)
+            return
+
+        ident = None
+        if not link:
+            self.connecting += 1
+        try:
+            if self.ident and not link:
+                local_address, local_port = writer.get_extra_info('sockname')[:2]
+                ident = asyncio.create_task(self.ident.lookup(host, port, local_port, local_address))
+            client_address, client_port, client_host = await resolve_peerinfo(host, port)
+        except BaseException:
+            # not served yet, so _drop_client won't release the connection
+            if ident:
+                ident.cancel()
+            if not link:
+                self.irc.clones.release(host)
+            writer.close()
+            raise
+        finally:
+            # _serve counts it as unregistered from here on
+            if not link:
+                self.connecting -= 1
         log.info("connection from %s (%s)", client_address, client_host)
 
-        client = Client(client_address, client_host, link=link)
-        self.clients.append((client, writer))
+        # links get their queue straight away, they aren't held to the registration limits
+        client = Client(client_address, client_host, link=link, stream=None if link else writer)
+        client.counted = not link
+        self.connections_accepted.inc()
+        if ident:
+            client.ident = False
+            ident.add_done_callback(lambda task: self._set_ident(client, task))
+        try:
+            await self._serve(client, LineReader(reader), writer, incoming)
+        finally:
+            # nobody is left to use the answer of a lookup still running
+            if ident:
+                ident.cancel()
+
+    def _set_ident(self, client, task):
+        user = None if task.cancelled() else task.result()
+        # too late once registered, the client keeps the ~ it got
+        if user and not client.registered:
+            client.ident = user
+
+    async def _reject(self, host, writer, reason):
+        log.info("refusing connection from %s: %s", host, reason)
+        self.connections_rejected.inc()
+        writer.write(IRCMessage.error_closing_link(host, reason).encode())
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except OSError:
+            pass
 
-        start_writer = False
-        writer_task = None
+    async def _serve(self, client, reader, writer, incoming, start_writer=False):
+        self.clients.append((client, writer))
+        connection = self.connections[client] = Connection(reader, writer, asyncio.current_task())
+
+        def _start_writer():
+            self.unregistered.discard(client)
+            connection.writer_task = asyncio.create_task(self._client_writer(client, writer))
+
+        if start_writer or client.outgoing is not None:
+            _start_writer()
+        else:
+            self.unregistered.add(client)
+            client.on_registered = _start_writer
+        deadline = asyncio.get_running_loop().time() + self.registration_timeout
+
+        handed_off = False
+        try:
+            await self._read_messages(client, reader, incoming, deadline)
+        except asyncio.CancelledError:
+            if not self.paused:
+                raise
+            handed_off = True
+        finally:
+            if not handed_off:
+                self.unregistered.discard(client)
+                self.connections.pop(client, None)
+                if connection.writer_task:
+                    self.irc.drop_client(client, QUIT_MESSAGE)
+                    await connection.writer_task
+                else:
+                    await self._drop_client(client, writer)
+                log.debug("client reader for %s (%s) shutdown", client.address, client.host)
+
+    async def _read_messages(self, client, reader, incoming, deadline):
+        inline = 0
         while client.connected:
             try:
-                line = await readline(reader)
+                if client.registered or client.link:
+                    line = await reader.readline()
+                else:
+                    line = await asyncio.wait_for(reader.readline(), deadline - asyncio.get_running_loop().time())
             except asyncio.IncompleteReadError:
-                log.info("error reading from: %s", client_address)
+                log.info("error reading from: %s", client.address)
+                break
+            except asyncio.TimeoutError:
+                self._close_unregistered(client, REGISTRATION_TIMED_OUT)
                 break
 
-            message = IRCMessage.parse(line)
-            log.debug("read from %s: %s", client_address, message)
-            await incoming.put((client, message))
-            if not start_writer:
-                writer_task = asyncio.create_task(self._client_writer(client, writer))
-                start_writer = True
-        await self._drop_client(client, writer)
-        if writer_task:
-            await writer_task
-        log.debug("client reader for %s (%s) shutdown", client.address, client.host)
+            client.messages_in += 1
+            if line is not None:
+                client.bytes_in += len(line) + len(TERMINATOR)
+            if not client.registered and not client.link and (client.messages_in > PREREG_COMMANDS or
+                                          client.bytes_in + len(reader) > PREREG_BYTES):
+                self._close_unregistered(client, REGISTRATION_FLOOD)
+                break
+            if line is None:
+                client.send(IRCMessage.error_input_too_long(self.irc.host, client.name))
+                continue
+            # empty messages are silently ignored (RFC 1459 2.3.1)
+            if not line:
+                continue
+            try:
+                message = IRCMessage.parse(line.decode())
+            except (ValueError, IndexError) as e:
+                # UnicodeDecodeError is a ValueError too
+                log.debug("ignoring malformed line from %s: %r", client.address, e)
+                continue
+            log.debug("read from %s: %s", client.address, message)
+            if not await self._throttle(client, message, len(reader)):
+                break
+
+            if self.mode == PROCESS_INLINE and not incoming.depth(client):
+                self._process(client, message)
+                # readline doesn't yield while lines are buffered, give everyone else a turn now and then
+                inline += 1
+                if inline >= INLINE_BATCH:
+                    inline = 0
+                    await asyncio.sleep(0)
+            else:
+                await incoming.put((client, message))
+
+    def _close_unregistered(self, client, reason):
+        log.info("dropping unregistered %s: %s", client.address, reason)
+        client.send(IRCMessage.error_closing_link(client.host, reason))
+        self.irc.drop_client(client, reason)
+
+    async def _throttle(self, client, message, buffered=0):
+        delay = self.flood.charge(client, message, buffered=buffered, exempt=self.irc.is_operator(client))
+        if delay is None:
+            self.irc.server_notice("Excess flood from {} [{}]".format(client.identity, client.address))
+            client.send(IRCMessage.error_closing_link(client.host, EXCESS_FLOOD))
+            self.irc.drop_client(client, EXCESS_FLOOD)
+            return False
+        if delay:
+            # not reading while we wait pushes back on the client
+            await asyncio.sleep(delay)
+        return True
+
+    async def pause(self):
+        """
+        Stops accepting and reading so connections can be handed to another process, returns the duplicated
+        listening sockets and the paused connections along with anything buffered for them. Output still in a
+        transport once it had a chance to drain stays there, see unsent.
+        """
+        self.paused = True
+
+        listeners = []
+        for server, link in self.servers:
+            for sock in server.sockets:
+                listeners.append((socket.socket(fileno=os.dup(sock.fileno())), link))
+            server.close()
+        self.servers = []
+
+        for connection in self.connections.values():
+            connection.writer.transport.pause_reading()
+            connection.reader_task.cancel()
+            if connection.writer_task:
+                connection.writer_task.cancel()
+        for connection in self.connections.values():
+            await asyncio.gather(connection.reader_task, connection.writer_task or asyncio.sleep(0), return_exceptions=True)
+
+        # anything already read gets processed now so its replies are captured below
+        while not self.incoming.empty():
+            client, message = self.incoming.get_nowait()
+            self._process(client, message)
+
+        for _ in range(PAUSE_DRAIN_TRIES):
+            if not self.unsent():
+                break
+            await asyncio.sleep(.01)
+
+        connections = []
+        for client, connection in list(self.connections.items()):
+            pending = []
+            while client.outgoing is not None:
+                message = client.outgoing.next_message()
+                if message is None:
+                    break
+                pending.append(format_message(client, message))
+
+            buffered = await connection.reader.take()
+            connections.append((client, connection, buffered, b"".join(pending)))
+        return listeners, connections
+
+    def top_incoming(self, field):
+        """
+        Per client depth (field 1) or head latency (field 2) of the incoming queue, labelled by nickname. Only the
+        TOP_QUEUES largest are exported, so the number of series stays bounded however many clients connect,
+        while the clients worth looking at are always named.
+        """
+        if not self.incoming:
+            return []
+        series = {}
+        for stats in heapq.nlargest(TOP_QUEUES, self.incoming.stats(), key=lambda stats: stats[field]):
+            client = stats[0]
+            label = (client.name or client.address,)
+            series[label] = max(series.get(label, 0), stats[field])
+        return list(series.items())
+
+    def unsent(self):
+        """
+        Clients with output written to their transport but not yet sent.
+        """
+        return [client for client, connection in self.connections.items()
+                if connection.writer.transport.get_write_buffer_size()]
+
+    async def resume(self, client, sock, buffered=b"", pending=b""):
+        if isinstance(sock, Connection):
+            reader, writer = sock.reader, sock.writer
+            writer.transport.resume_reading()
+        else:
+            stream, writer = await asyncio.open_connection(sock=sock, limit=LINE_LIMIT)
+            reader = LineReader(stream, buffered=buffered)
+
+        if pending:
+            writer.write(pending)
+        asyncio.create_task(self._serve(client, reader, writer, self.incoming, start_writer=True))
+
+    async def unpause(self, listeners, connections):
+        self.paused = False
+        self.connections = {}
+        self.clients = []
+        for sock, link in listeners:
+            asyncio.create_task(self._listener(None, None, link, self.incoming, sock=sock))
+        for client, connection, buffered, pending in connections:
+            await self.resume(client, connection, pending=pending)
 
     async def _on_ws_connect(self, ws, path, incoming):
-        host, port = ws.remote_address
+        host, port = ws.remote_address[:2]
+        if not self.irc.clones.admit(host):
+            log.info("refusing ws connection from %s: %s", host, TOO_MANY_CONNECTIONS)
+            self.connections_rejected.inc()
+            await ws.close(reason=TOO_MANY_CONNECTIONS)
+            return
+        try:
+            await self._serve_ws(ws, host, port, incoming)
+        finally:
+            self.irc.clones.release(host)
+
+    async def _serve_ws(self, ws, host, port, incoming):
         client_address, client_port, client_host = await resolve_peerinfo(host, port)
         log.info("ws connection from %s (%s)", client_address, client_host)
         client = Client(client_address, client_host)
@@ -250,46 +723,91 @@ class Server:
                         with_id=client.has_message_id,
                     )
                     await ws.send(line)
+                    client.messages_out += 1
+                    client.bytes_out += len(line)
+                    self.messages_sent.inc()
 
         writer_task = asyncio.create_task(_writer())
         async for line in ws:
+            client.messages_in += 1
+            client.bytes_in += len(line)
+            if too_long((line + TERMINATOR).encode()):
+                client.send(IRCMessage.error_input_too_long(self.irc.host, client.name))
+                continue
             message = IRCMessage.parse(line)
             log.debug("ws read from %s: %s", client_address, message)
+            if not await self._throttle(client, message):
+                break
             await incoming.put((client, message))
 
     async def _drop_client(self, client, writer):
         self.irc.drop_client(client, QUIT_MESSAGE)
+        # shutdown and the connection's own reader can both get here
+        if client.counted:
+            client.counted = False
+            self.irc.clones.release(client.address)
         if writer.is_closing():
             return
-        await writer.drain()
-        writer.write_eof()
+        try:
+            await writer.drain()
+            writer.write_eof()
+        except OSError:
+            pass
         writer.close()
-        await writer.wait_closed()
-
-    async def _listener(self, addr, port, link, incoming):
+        try:
+            await writer.wait_closed()
+        except OSError:
+            pass
+
+    async def _listener(self, addr, port, link, incoming, sock=None):
+        if sock:
+            addr, port = sock.getsockname()[:2]
         log.info("serving %s on %s:%s", "links" if link else "clients", addr, port)
 
         def _start(reader, writer):
             return asyncio.create_task(self._on_connect(reader, writer, link, incoming))
 
-        server = await asyncio.start_server(_start, addr, port)
-        self.servers.append(server)
-        async with server:
-            if not link:
-                self.running.set()
-            await server.serve_forever()
+        if sock:
+            server = await asyncio.start_server(_start, sock=sock, limit=LINE_LIMIT)
+        else:
+            server = await asyncio.start_server(_start, addr, port, limit=LINE_LIMIT)
+        self.servers.append((server, link))
+        try:
+            async with server:
+                if not link:
+                    self.running.set()
+                await server.serve_forever()
+        except asyncio.CancelledError:
+            if not self.paused:
+                raise
+
+    def _process(self, client, message):
+        log.info("processing message from %s: %s", client, message)
+        self.current = client, message
+        client.replying = True
+        try:
+            self.irc.process(client, message)
+        except Exception as e:
+            log.exception("error processing message from %s - %s - %s", client, message, str(e))
+        client.replying = False
+        self.current = None
 
     async def _irc_processor(self, incoming):
+        batch = self.mode == PROCESS_BATCH
         while self.irc.running:
             client, message = await incoming.get()
-            log.info("processing message from %s: %s", client, message)
-            try:
-                self.irc.process(client, message)
-            except Exception as e:
-                log.exception("error processing message from %s - %s - %s", client, message, str(e))
+            self._process(client, message)
+
+            # processing never yields so nothing new arrives while we drain what is already pending, writers
+            # get to run between batches
+            if batch:
+                for _ in range(min(len(incoming), BATCH_LIMIT)):
+                    client, message = incoming.get_nowait()
+                    self._process(client, message)
+                await asyncio.sleep(0)
         log.debug("irc processor shutdown")
 
     async def connect(self, addr, port, incoming):
         log.info("linking to peer %s:%s", addr, port)
-        reader, writer = await asyncio.open_connection(addr, port)
+        reader, writer = await asyncio.open_connection(addr, port, limit=LINE_LIMIT)
         await self._on_connect(reader, writer, True, incoming)
@@ -1,34 +1,38 @@
-from datetime import datetime
+import time
 
 from ircd.mode import Mode
 
 
 class Nickname:
-    def __init__(self, nickname):
+    def __init__(self, nickname, index=None):
         self.nickname = nickname
         self.mode = Mode.for_nickname(self)
-        self.mode.set_flags("s")
-        self.last_seen = datetime.utcnow()
+        self.index = index
+        self.set_mode("s")
+        self.last_seen = time.monotonic()
         self.channels = []
         self.away_message = None
 
     def __repr__(self):
         return "Nickname({})".format(self.nickname)
 
-    def __eq__(self, other):
-        return other and self.nickname == other.nickname
-
     def set_nick(self, nickname):
         self.nickname = nickname
 
     def set_mode(self, flags, param=None):
-        return self.mode.set_flags(flags, param=param)
+        modified = self.mode.set_flags(flags, param=param)
+        if self.index is not None:
+            self.index.update(self, modified)
+        return modified
 
     def clear_mode(self, flags):
-        return self.mode.clear_flags(flags)
+        modified = self.mode.clear_flags(flags)
+        if self.index is not None:
+            self.index.update(self, modified)
+        return modified
 
     def seen(self):
-        self.last_seen = datetime.utcnow()
+        self.last_seen = time.monotonic()
 
     def joined_channel(self, channel):
         if channel not in self.channels:
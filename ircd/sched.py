@@ -0,0 +1,310 @@
+import time
+import asyncio
+import logging
+from collections import deque
+
+from .message import CHAN_START_CHARS
+
+log = logging.getLogger(__name__)
+
+QUANTUM = 4
+LINK_WEIGHT = 8
+
+# outgoing lanes, in priority order
+LANE_CONTROL = 0
+LANE_DIRECT = 1
+LANE_CHANNEL = 2
+LANE_LOW = 3
+LANES = (LANE_CONTROL, LANE_DIRECT, LANE_CHANNEL, LANE_LOW)
+# messages each lane after control may send per round while the lanes below it have some waiting, control always
+# goes first. None drains in strict priority order
+LANE_WEIGHTS = (4, 2, 1)
+
+CONTROL_COMMANDS = {"PING", "PONG", "ERROR"}
+# sent to everyone sharing a channel with the client, they change who later messages come from so LaneQueue
+# keeps them in order with everything else
+FANOUT_COMMANDS = {"NICK", "QUIT"}
+
+
+def lane_for(message, replying=False):
+    """
+    Control messages, then replies to the client's own commands, numerics and anything else addressed to the
+    client, then channel traffic caused by other clients, then TAGMSG.
+    """
+    command = message.command
+    if command in CONTROL_COMMANDS:
+        return LANE_CONTROL
+    if replying or command.isdigit():
+        return LANE_DIRECT
+    if command == "TAGMSG":
+        return LANE_LOW
+    if command in FANOUT_COMMANDS or (message.args and message.args[0][:1] in CHAN_START_CHARS):
+        return LANE_CHANNEL
+    return LANE_DIRECT
+
+
+class FairQueue:
+    """
+    Inbound messages queued per client and served round robin, each client takes up to quantum messages per
+    turn (quantum * link_weight for server links) so one busy connection can't hold everyone else up.
+    Messages from the same client always come out in the order they were put.
+    """
+    def __init__(self, quantum=QUANTUM, link_weight=LINK_WEIGHT):
+        self.quantum = quantum
+        self.link_weight = link_weight
+        self.queues = {}
+        self.active = deque()
+        self.credit = 0
+        self.size = 0
+        self.ready = asyncio.Event()
+
+    def __len__(self):
+        return self.size
+
+    def qsize(self):
+        return self.size
+
+    def empty(self):
+        return not self.size
+
+    def weight(self, client):
+        return self.link_weight if client.link or client.server else 1
+
+    def put_nowait(self, item):
+        client, message = item
+        queue = self.queues.get(client)
+        if queue is None:
+            queue = self.queues[client] = deque()
+            self.active.append(client)
+        queue.append((time.monotonic(), message))
+        self.size += 1
+        self.ready.set()
+
+    async def put(self, item):
+        self.put_nowait(item)
+
+    def get_nowait(self):
+        if not self.size:
+            raise asyncio.QueueEmpty()
+
+        client = self.active[0]
+        queue = self.queues[client]
+        if self.credit <= 0:
+            self.credit = self.quantum * self.weight(client)
+
+        _, message = queue.popleft()
+        self.size -= 1
+        self.credit -= 1
+        if not queue:
+            del self.queues[client]
+            self.active.popleft()
+            self.credit = 0
+        elif self.credit <= 0:
+            self.active.rotate(-1)
+
+        if not self.size:
+            self.ready.clear()
+        return client, message
+
+    async def get(self):
+        while not self.size:
+            await self.ready.wait()
+        return self.get_nowait()
+
+    def depth(self, client):
+        queue = self.queues.get(client)
+        return len(queue) if queue else 0
+
+    def head_latency(self, client, now=None):
+        """
+        Seconds the oldest queued message from client has been waiting.
+        """
+        queue = self.queues.get(client)
+        if not queue:
+            return 0
+        return (time.monotonic() if now is None else now) - queue[0][0]
+
+    def stats(self):
+        now = time.monotonic()
+        return [(client, len(queue), now - queue[0][0]) for client, queue in self.queues.items()]
+
+
+class LaneQueue:
+    """
+    A client's outgoing messages split into priority lanes, FIFO within each lane. Control messages always go
+    first, the other lanes share what's left by weight so channel traffic can't starve while replies are
+    waiting. A None put to close the queue comes out once every lane is empty, anything put after it is dropped.
+
+    NICK and QUIT are barriers: one is only queued once the lanes other than control are empty, and anything
+    put after it is held until it has been taken, so a client never sees messages from a new nickname before
+    the change or ones sent before the change after it.
+
+    The channel lane also reads from the broadcast logs of large channels the client is subscribed to, after
+    anything queued to it directly. A subscription that falls behind its log's tail sets overrun and delivers
+    nothing more.
+    """
+    def __init__(self, weights=LANE_WEIGHTS):
+        self.lanes = tuple(deque() for _ in LANES)
+        self.weights = weights
+        self.credits = list(weights) if weights else None
+        self.size = 0
+        # (message, lane) waiting behind a NICK or QUIT, counted in size
+        self.held = deque()
+        self.closed = False
+        # the None closing the queue is yet to be taken
+        self.closing = False
+        # BroadcastLog -> [next sequence to read, sequence to stop at once unsubscribed]
+        self.logs = {}
+        self.overrun = False
+        self.ready = asyncio.Event()
+
+    def __len__(self):
+        return self.qsize()
+
+    def qsize(self):
+        # broadcasts the client sent itself are counted until they are skipped
+        return self.size + sum((log.head if end is None else end) - cursor
+                               for log, (cursor, end) in self.logs.items())
+
+    def empty(self):
+        if self.size or self.closing:
+            return False
+        # checking the logs is what finds an overrun
+        return not self._has_broadcast() and not self.overrun
+
+    def put_nowait(self, message, lane=None):
+        if self.closed:
+            return
+        if message is None:
+            self.closed = self.closing = True
+        else:
+            if lane is None:
+                lane = lane_for(message)
+            if lane != LANE_CONTROL and (self.held or (message.command in FANOUT_COMMANDS and self.size)):
+                self.held.append((message, lane))
+            else:
+                self.lanes[lane].append(message)
+            self.size += 1
+        self.ready.set()
+
+    async def put(self, message, lane=None):
+        self.put_nowait(message, lane)
+
+    def subscribe(self, log):
+        self.logs[log] = [log.head, None]
+        # a reader already waiting needs to start watching the new log
+        self.ready.set()
+
+    def unsubscribe(self, log):
+        # what was broadcast while subscribed is still delivered
+        subscription = self.logs.get(log)
+        if subscription:
+            subscription[1] = log.head
+
+    def _advance(self, log, subscription):
+        """
+        Moves the cursor past broadcasts from this client, True if there is one to deliver.
+        """
+        cursor, end = subscription
+        if cursor < log.tail:
+            self.overrun = True
+            return False
+
+        limit = log.head if end is None else end
+        while cursor < limit and log.read(cursor)[1] is self:
+            cursor += 1
+        subscription[0] = cursor
+        if cursor < limit:
+            return True
+        if end is not None:
+            del self.logs[log]
+        return False
+
+    def _has_broadcast(self):
+        for log, subscription in list(self.logs.items()):
+            if self._advance(log, subscription):
+                return True
+        return False
+
+    def _next_broadcast(self):
+        for log, subscription in list(self.logs.items()):
+            if self._advance(log, subscription):
+                message, _ = log.read(subscription[0])
+                subscription[0] += 1
+                return message
+            if self.overrun:
+                self.logs.clear()
+                break
+        return None
+
+    def _release(self):
+        """
+        Queues held messages once the lanes have emptied, up to the next barrier. A barrier at the front goes
+        alone so what follows waits for it to be taken.
+        """
+        while self.held:
+            message, lane = self.held[0]
+            if message.command in FANOUT_COMMANDS and self.size > len(self.held):
+                break
+            self.held.popleft()
+            self.lanes[lane].append(message)
+            if message.command in FANOUT_COMMANDS:
+                break
+
+    def _take(self, lane):
+        queue = self.lanes[lane]
+        if queue:
+            self.size -= 1
+            return queue.popleft()
+        if lane == LANE_CHANNEL and self.logs:
+            return self._next_broadcast()
+        return None
+
+    def next_message(self):
+        """
+        The next message in lane order, None when there is nothing to send.
+        """
+        message = self._take(LANE_CONTROL)
+        if message is not None:
+            return message
+        if not self.size and not self.logs:
+            return None
+        if self.held and self.size == len(self.held):
+            self._release()
+
+        if self.credits is None:
+            for lane in LANES[1:]:
+                message = self._take(lane)
+                if message is not None:
+                    return message
+            return None
+
+        for _ in range(2):
+            for i, credit in enumerate(self.credits):
+                if credit > 0:
+                    message = self._take(i + 1)
+                    if message is not None:
+                        self.credits[i] -= 1
+                        return message
+            # everything waiting has used its share, start a new round
+            self.credits[:] = self.weights
+        return None
+
+    def get_nowait(self):
+        message = self.next_message()
+        if message is not None:
+            return message
+        if self.closing:
+            self.closing = False
+            return None
+        if self.overrun:
+            return None
+        raise asyncio.QueueEmpty()
+
+    async def get(self):
+        while self.empty():
+            self.ready.clear()
+            for log in self.logs:
+                log.waiting.add(self)
+            await self.ready.wait()
+        return self.get_nowait()
@@ -0,0 +1,131 @@
+import io
+import os
+import pickle
+import asyncio
+import logging
+
+from ircd.chan import Channel
+from ircd.mask import Mask
+
+log = logging.getLogger(__name__)
+
+MAGIC = b"IRCD"
+VERSION = 1
+SNAPSHOT_INTERVAL = 300
+
+# modes that carry state restored separately or that belong to members
+PARAM_MODES = "kbeovfl"
+
+
+class SnapshotError(ValueError):
+    pass
+
+
+class _Unpickler(pickle.Unpickler):
+    # snapshots only ever contain builtin containers and scalars
+    def find_class(self, module, name):
+        raise SnapshotError("unexpected object in snapshot: {}.{}".format(module, name))
+
+
+def capture(irc):
+    """
+    Captures the durable parts of IRC as plain tuples, cheap enough to run on the event loop. Flags set by a
+    flood lock are left out, their timer doesn't survive a restart to clear them.
+    """
+    channels = [
+        (channel.name, channel.topic, channel.key,
+         "".join(flag for flag in channel.mode.mode if flag not in channel.locked),
+         [str(mask) for mask in channel.bans], [str(mask) for mask in channel.exceptions],
+         channel.flood.param if channel.flood else None, channel.limit)
+        for channel in irc.channels.values()
+    ]
+    return {
+        "channels": channels,
+        "accounts": irc.accounts.dump(),
+    }
+
+
+def restore(irc, state):
+    for name, topic, key, mode, bans, exceptions, *rest in state["channels"]:
+        # snapshots from before +f and +l were kept have no flood setting or limit
+        flood = rest[0] if rest else None
+        limit = rest[1] if len(rest) > 1 else None
+        channel = Channel(name, None)
+        channel.set_topic(topic)
+        for flag in mode:
+            if flag not in PARAM_MODES:
+                channel.set_mode(flag)
+        if key:
+            channel.set_mode("k", param=key)
+        if flood:
+            channel.set_mode("f", param=flood)
+        if limit is not None:
+            channel.set_mode("l", param=str(limit))
+        for mask in filter(None, map(Mask.parse, bans)):
+            channel.add_ban(mask)
+        for mask in filter(None, map(Mask.parse, exceptions)):
+            channel.add_exception(mask)
+        irc.set_channel(channel)
+
+    irc.accounts.load(state["accounts"])
+
+
+def dumps(state):
+    return MAGIC + bytes([VERSION]) + pickle.dumps(state, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def loads(data):
+    if data[:len(MAGIC)] != MAGIC:
+        raise SnapshotError("not a snapshot")
+    version = data[len(MAGIC)]
+    if version != VERSION:
+        raise SnapshotError("unsupported snapshot version {}".format(version))
+    return _Unpickler(io.BytesIO(data[len(MAGIC) + 1:])).load()
+
+
+def write(path, state):
+    data = dumps(state)
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+    fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    return len(data)
+
+
+def read(path):
+    with open(path, "rb") as f:
+        return loads(f.read())
+
+
+def load(irc, path):
+    if not os.path.exists(path):
+        log.info("no snapshot at %s", path)
+        return False
+
+    state = read(path)
+    restore(irc, state)
+    log.info("restored %d channels and %d accounts from %s", len(state["channels"]), len(state["accounts"]), path)
+    return True
+
+
+async def save(irc, path):
+    state = capture(irc)
+    size = await asyncio.get_running_loop().run_in_executor(None, write, path, state)
+    log.info("wrote snapshot of %d channels (%d bytes) to %s", len(state["channels"]), size, path)
+
+
+async def periodic(irc, path, interval=SNAPSHOT_INTERVAL):
+    while irc.running:
+        await asyncio.sleep(interval)
+        try:
+            await save(irc, path)
+        except OSError:
+            log.exception("error writing snapshot to %s", path)
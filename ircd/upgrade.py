@@ -0,0 +1,222 @@
+import os
+import sys
+import array
+import socket
+import struct
+import asyncio
+import logging
+import datetime
+import tempfile
+import subprocess
+
+from ircd import snapshot
+from ircd.net import Client
+from ircd.nick import Nickname
+
+log = logging.getLogger(__name__)
+
+UPGRADE_TIMEOUT = 30
+MAX_FDS = 200
+HEADER = struct.Struct("!IQ")
+ACK = b"OK"
+
+CLIENT_FIELDS = (
+    "name", "connected_at", "server", "hop_count", "token", "info",
+    "user", "realname", "authentication_method", "account", "ping_count", "capabilities",
+)
+
+
+class UpgradeError(Exception):
+    pass
+
+
+def send_fds(sock, fds):
+    for i in range(0, len(fds), MAX_FDS):
+        chunk = array.array("i", fds[i:i + MAX_FDS])
+        sock.sendmsg([b"F"], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, chunk)])
+
+
+def recv_fds(sock, count):
+    fds = array.array("i")
+    while len(fds) < count:
+        size = min(count - len(fds), MAX_FDS)
+        msg, ancdata, flags, _ = sock.recvmsg(1, socket.CMSG_SPACE(size * fds.itemsize))
+        if not msg:
+            raise UpgradeError("connection closed while receiving descriptors")
+        for level, kind, data in ancdata:
+            if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+                fds.frombytes(data[:len(data) - (len(data) % fds.itemsize)])
+    return list(fds)
+
+
+def recv_exactly(sock, size):
+    buf = bytearray()
+    while len(buf) < size:
+        data = sock.recv(size - len(buf))
+        if not data:
+            raise UpgradeError("connection closed while receiving state")
+        buf.extend(data)
+    return bytes(buf)
+
+
+def capture(irc, connections):
+    state = snapshot.capture(irc)
+    state["created"] = irc.created.isoformat()
+    state["nicknames"] = [
+        (nickname.nickname, nickname.mode.mode, nickname.away_message, [channel.name for channel in nickname.channels])
+        for nickname in irc.nicknames.values()
+    ]
+    state["members"] = [
+        (channel.name,
+         [member.nickname for member in channel.members],
+         [operator.nickname for operator in channel.operators if operator],
+         [invited.nickname for invited in channel.invited],
+         [voiced.nickname for voiced in channel.voiced])
+        for channel in irc.channels.values()
+    ]
+    state["clients"] = [
+        dict({field: getattr(client, field) for field in CLIENT_FIELDS},
+             address=client.address, host=client.host, link=client.link, buffered=buffered, pending=pending)
+        for client, _, buffered, pending in connections
+    ]
+    state["links"] = [i for i, (client, _, _, _) in enumerate(connections) if client in irc.links]
+    return state
+
+
+def restore(irc, state):
+    snapshot.restore(irc, state)
+    irc.created = datetime.datetime.fromisoformat(state["created"])
+
+    for name, mode, away_message, _ in state["nicknames"]:
+        nickname = Nickname(name, index=irc.user_modes)
+        nickname.clear_mode(nickname.mode.mode)
+        nickname.set_mode(mode)
+        nickname.away_message = away_message
+        irc.nicknames[name] = nickname
+
+    for name, members, operators, invited, voiced in state["members"]:
+        channel = irc.get_channel(name)
+        channel.members = [irc.nicknames[nick] for nick in members if nick in irc.nicknames]
+        channel.operators = [irc.nicknames[nick] for nick in operators if nick in irc.nicknames]
+        channel.invited = [irc.nicknames[nick] for nick in invited if nick in irc.nicknames]
+        channel.voiced = [irc.nicknames[nick] for nick in voiced if nick in irc.nicknames]
+
+    for name, _, _, channels in state["nicknames"]:
+        irc.nicknames[name].channels = [irc.get_channel(channel) for channel in channels if irc.has_channel(channel)]
+
+    clients = []
+    for i, fields in enumerate(state["clients"]):
+        client = Client(fields["address"], fields["host"], link=fields["link"])
+        for field in CLIENT_FIELDS:
+            setattr(client, field, fields[field])
+
+        if client.name in irc.nicknames:
+            irc.nick_client[client.name] = client
+        if client.has_identity:
+            irc.set_client(client)
+        if i in state["links"]:
+            irc.links.append(client)
+        clients.append((client, fields["buffered"], fields["pending"]))
+    return clients
+
+
+class Takeover:
+    """
+    The receiving end of a hot upgrade, holds the inherited sockets until the server is ready to serve them.
+    """
+    def __init__(self, sock, listeners, connections):
+        self.sock = sock
+        self.listeners = listeners
+        self.connections = connections
+
+    def done(self):
+        self.sock.sendall(ACK)
+        self.sock.close()
+        log.info("took over %d listeners and %d connections", len(self.listeners), len(self.connections))
+
+
+def receive(irc, path):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(path)
+
+    num_fds, size = HEADER.unpack(recv_exactly(sock, HEADER.size))
+    fds = recv_fds(sock, num_fds)
+    state = snapshot.loads(recv_exactly(sock, size))
+
+    clients = restore(irc, state)
+    socks = [socket.socket(fileno=fd) for fd in fds]
+    listeners = list(zip(socks, state["listeners"]))
+    connections = [
+        (client, client_sock, buffered, pending)
+        for (client, buffered, pending), client_sock in zip(clients, socks[len(listeners):])
+    ]
+    return Takeover(sock, listeners, connections)
+
+
+def child_args(path, argv=None):
+    argv = list(sys.argv[1:] if argv is None else argv)
+    if "--takeover" in argv:
+        i = argv.index("--takeover")
+        del argv[i:i + 2]
+    return [sys.executable, "-m", "ircd"] + argv + ["--takeover", path]
+
+
+async def handoff(server, argv=None, timeout=UPGRADE_TIMEOUT):
+    """
+    Starts a new server process and hands it our listeners, connections and state. Returns once the new process
+    has taken over, the caller is expected to exit without closing any connection.
+    """
+    loop = asyncio.get_running_loop()
+    path = os.path.join(tempfile.mkdtemp(prefix="ircd-"), "upgrade.sock")
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(path)
+    listener.listen(1)
+    listener.setblocking(False)
+
+    log.info("starting upgrade via %s", path)
+    proc = subprocess.Popen(child_args(path, argv))
+    try:
+        conn, _ = await asyncio.wait_for(loop.sock_accept(listener), timeout)
+    except asyncio.TimeoutError:
+        proc.kill()
+        raise UpgradeError("new process did not connect")
+    finally:
+        listener.close()
+        os.unlink(path)
+        os.rmdir(os.path.dirname(path))
+
+    listeners, connections = await server.pause()
+    server.irc.history.close()
+    try:
+        # the new process can't send what is left in our transports, it would be lost
+        unsent = server.unsent()
+        if unsent:
+            raise UpgradeError("{} connections have unsent output".format(len(unsent)))
+
+        state = capture(server.irc, connections)
+        state["listeners"] = [link for _, link in listeners]
+        data = snapshot.dumps(state)
+        fds = [sock.fileno() for sock, _ in listeners]
+        fds += [connection.writer.get_extra_info("socket").fileno() for _, connection, _, _ in connections]
+
+        conn.setblocking(True)
+        conn.sendall(HEADER.pack(len(fds), len(data)))
+        send_fds(conn, fds)
+        conn.sendall(data)
+        conn.setblocking(False)
+        if await asyncio.wait_for(loop.sock_recv(conn, len(ACK)), timeout) != ACK:
+            raise UpgradeError("unexpected reply from new process")
+    except (OSError, UpgradeError, asyncio.TimeoutError):
+        log.exception("upgrade failed, resuming")
+        proc.kill()
+        server.irc.history.open()
+        await server.unpause(listeners, connections)
+        raise UpgradeError("handoff failed")
+    finally:
+        conn.close()
+
+    # the connections belong to the new process now, forget them without closing anything
+    server.connections = {}
+    server.clients = []
+    log.info("upgrade complete, handed off to pid %d", proc.pid)
+    return proc
@@ -0,0 +1,81 @@
+import sys
+import time
+import asyncio
+import logging
+import threading
+import traceback
+
+log = logging.getLogger(__name__)
+
+STALL_THRESHOLD = 1.0
+HEARTBEAT_INTERVAL = .25
+
+
+class Watchdog:
+    """
+    Background thread that pings the event loop and, when a ping goes unanswered for longer than the threshold,
+    logs the loop thread's stack and the message the server is processing.
+    """
+    def __init__(self, server, threshold=STALL_THRESHOLD, interval=HEARTBEAT_INTERVAL):
+        self.server = server
+        self.threshold = threshold
+        self.interval = interval
+        self.loop = None
+        self.loop_thread = None
+        self.thread = None
+        self.answered = threading.Event()
+        self.stopped = threading.Event()
+        self.last_report = None
+
+        metrics = server.irc.metrics
+        self.stalls = metrics.counter("ircd_loop_stalls_total", "Times the event loop blocked past the watchdog threshold")
+        self.stall_seconds = metrics.histogram("ircd_loop_stall_seconds", "How long each event loop stall lasted")
+
+    def start(self):
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread = threading.get_ident()
+        self.thread = threading.Thread(target=self._watch, name="ircd-watchdog", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+
+    def _ping(self):
+        self.answered.clear()
+        try:
+            self.loop.call_soon_threadsafe(self.answered.set)
+        except RuntimeError:  # loop closed
+            return False
+        return True
+
+    def _watch(self):
+        while not self.stopped.wait(self.interval):
+            start = time.monotonic()
+            if not self._ping():
+                break
+            if self.answered.wait(self.threshold):
+                continue
+
+            self._report(time.monotonic() - start)
+            while not self.answered.wait(self.interval):
+                if self.stopped.is_set():
+                    return
+            elapsed = time.monotonic() - start
+            log.warning("event loop recovered after %.3fs", elapsed)
+            # metrics belong to the loop, they are updated once it is running again
+            self.loop.call_soon_threadsafe(self._record, elapsed)
+
+    def _report(self, elapsed):
+        frame = sys._current_frames().get(self.loop_thread)
+        stack = "".join(traceback.format_stack(frame)) if frame else "(no stack)\n"
+        current = self.server.current
+        processing = "{} from {}".format(current[1], current[0]) if current else "nothing"
+
+        self.last_report = "event loop stalled for {:.3f}s, processing {}\n{}".format(elapsed, processing, stack)
+        log.warning("%s", self.last_report)
+
+    def _record(self, elapsed):
+        self.stalls.inc()
+        self.stall_seconds.observe(elapsed)
@@ -0,0 +1,242 @@
+import os
+import time
+import json
+import timeit
+import asyncio
+
+import pytest
+
+from ircd import IRC, Server, snapshot
+from ircd.chan import Channel
+from ircd.mask import Mask
+from ircd.flood import FloodControl
+from ircd.net import PROCESS_MODES
+from ircd.bench import Bench, run_inprocess
+from ircd.message import IRCMessage, parsemsg
+
+pytestmark = pytest.mark.benchmark
+
+HOST = "localhost"
+ADDRESS = "127.0.0.1"
+PORT = 9002
+
+
+def report(name, elapsed, count):
+    print("{}: {:.3f}s ({:.1f}us per item)".format(name, elapsed, elapsed / count * 1e6))
+
+
+def test_snapshot_restore():
+    num_channels = 100000
+
+    irc = IRC(HOST)
+    for i in range(num_channels):
+        channel = Channel("#channel-{}".format(i), None)
+        channel.set_topic("topic for channel {}".format(i))
+        channel.set_mode("nt")
+        if i % 10 == 0:
+            channel.set_mode("k", param="key-{}".format(i))
+            channel.add_ban(Mask.parse("*!*@host-{}.example.com".format(i)))
+        irc.set_channel(channel)
+
+    data = snapshot.dumps(snapshot.capture(irc))
+
+    start = time.perf_counter()
+    restored = IRC(HOST)
+    snapshot.restore(restored, snapshot.loads(data))
+    elapsed = time.perf_counter() - start
+
+    report("restore {} channels ({} bytes)".format(num_channels, len(data)), elapsed, num_channels)
+    assert len(restored.channels) == num_channels
+    assert elapsed < 30
+
+
+async def register(reader, writer, nickname, channel):
+    writer.write("NICK {0}\r\nUSER {0} 0 * :{0}\r\nJOIN {1}\r\n".format(nickname, channel).encode())
+    while b" 366 " not in await reader.readline():
+        pass
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("mode", PROCESS_MODES)
+async def test_process_throughput(mode):
+    num_messages = 20000
+
+    irc = IRC(HOST)
+    server = Server(irc, flood=FloodControl(burst=num_messages, rate=num_messages), mode=mode)
+    asyncio.create_task(server.run(ADDRESS, PORT))
+    await server.running.wait()
+
+    reader_a, writer_a = await asyncio.open_connection(ADDRESS, PORT)
+    reader_b, writer_b = await asyncio.open_connection(ADDRESS, PORT)
+    await register(reader_a, writer_a, "foo", "#bench")
+    await register(reader_b, writer_b, "bar", "#bench")
+    await reader_a.readline()  # bar's join
+
+    start = time.perf_counter()
+    writer_a.write(b"".join(b"PRIVMSG #bench :message %d\r\n" % i for i in range(num_messages)))
+    received = 0
+    while received < num_messages:
+        if b" PRIVMSG " in await asyncio.wait_for(reader_b.readline(), 10):
+            received += 1
+    elapsed = time.perf_counter() - start
+
+    report("{} mode, {} messages".format(mode, num_messages), elapsed, num_messages)
+    writer_a.close()
+    writer_b.close()
+    await server.shutdown()
+    assert elapsed < 60
+
+
+@pytest.mark.asyncio
+async def test_load_generator():
+    bench = Bench(clients=20, channels=4, joins=2, distribution="zipf", rate=200, duration=1, tagmsg_ratio=.5)
+    result = await run_inprocess(bench)
+    print(json.dumps(result, indent=2))
+
+    assert result["sent"] >= 150
+    assert result["delivered"] == result["expected"] > 0
+    assert result["latency_ms"]["p50"] <= result["latency_ms"]["p99"] <= result["latency_ms"]["max"]
+    assert result["server"]["rss_bytes"] > 0
+    assert result["server"]["cpu_seconds"] is not None
+
+    # a server that can't be measured reports no CPU time rather than none used
+    unmeasured = bench.report(result["elapsed"], None, None)["server"]
+    assert unmeasured["cpu_seconds"] is None and unmeasured["cpu_us_per_message"] is None
+
+
+BENCH_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench")
+BASELINE = os.path.join(BENCH_DIR, "baseline.json")
+# set IRCD_BENCH_UPDATE=1 to record new baselines instead of comparing against them
+THRESHOLD = float(os.environ.get("IRCD_BENCH_THRESHOLD", "1.5"))
+REPEAT = 7
+NUM_BANS = 1000
+
+
+def load_corpus(name):
+    with open(os.path.join(BENCH_DIR, name)) as f:
+        return [line.rstrip("\r\n") for line in f if line.strip()]
+
+
+def _calibration_work(words="the quick brown fox jumps over the lazy dog".split()):
+    counts = {}
+    for word in words:
+        key = word.upper()
+        counts[key] = counts.get(key, 0) + len(word)
+    return " ".join(sorted(counts))
+
+
+def measure(func, number, calibration_number=5000):
+    """
+    Best time per call of func relative to a fixed pure python workload, so the baseline carries across
+    machines. The two are timed alternately so both see the same clock speed and load.
+    """
+    best, calibration = float("inf"), float("inf")
+    for _ in range(REPEAT):
+        calibration = min(calibration, timeit.timeit(_calibration_work, number=calibration_number) / calibration_number)
+        best = min(best, timeit.timeit(func, number=number) / number)
+    return best, best / calibration
+
+
+def bench_parsemsg():
+    lines = load_corpus("lines.txt")
+
+    def _run():
+        for line in lines:
+            parsemsg(line)
+    return _run, 200
+
+
+def bench_parsemsg_tags():
+    lines = load_corpus("tags.txt")
+
+    def _run():
+        for line in lines:
+            parsemsg(line)
+    return _run, 500
+
+
+def bench_format():
+    messages = [IRCMessage.parse(line) for line in load_corpus("lines.txt") + load_corpus("tags.txt")]
+
+    def _run():
+        for msg in messages:
+            msg.format(with_tags=True, with_time=True, with_id=True)
+    return _run, 100
+
+
+def bench_set_flags():
+    mode = Channel("#bench", None).mode
+
+    def _run():
+        mode.set_flags("ptnmis")
+        mode.clear_flags("ptnmis")
+    return _run, 5000
+
+
+def bench_mask_match():
+    masks = [Mask.parse(s) for s in ("*!*@host-{}.example.com".format(i) for i in range(10))]
+    masks += [Mask.parse(s) for s in ("*!user{}@*".format(i) for i in range(5))]
+    masks += [Mask.parse(s) for s in ("nick{}*!*@*".format(i) for i in range(5))]
+    identities = ["nick{0}!user{0}@host-{0}.example.org".format(i) for i in range(20)]
+    for mask in masks:
+        mask.match(identities[0])  # compile outside the timing
+
+    def _run():
+        for mask in masks:
+            for identity in identities:
+                mask.match(identity)
+    return _run, 50
+
+
+def bench_is_banned():
+    channel = Channel("#bench", None)
+    for i in range(NUM_BANS):
+        channel.add_ban(Mask.parse("*!*@host-{}.example.com".format(i)))
+    channel.is_banned("warmup!warmup@warmup.example.com")
+
+    def _run():
+        # one miss scans every ban, one hit stops halfway
+        channel.is_banned("alice!alice@clean.example.org")
+        channel.is_banned("bob!bob@host-{}.example.com".format(NUM_BANS // 2))
+    return _run, 20
+
+
+MICROBENCHMARKS = {
+    "parsemsg": bench_parsemsg,
+    "parsemsg_tags": bench_parsemsg_tags,
+    "format": bench_format,
+    "set_flags": bench_set_flags,
+    "mask_match": bench_mask_match,
+    "is_banned": bench_is_banned,
+}
+
+
+def load_baseline():
+    if not os.path.exists(BASELINE):
+        return {}
+    with open(BASELINE) as f:
+        return json.load(f)
+
+
+@pytest.mark.parametrize("name", sorted(MICROBENCHMARKS))
+def test_microbenchmark(name):
+    """
+    Fails when a benchmark runs more than THRESHOLD times slower than its baseline. With IRCD_BENCH_UPDATE set
+    it asserts nothing and overwrites the benchmark's entry in bench/baseline.json with this run instead.
+    """
+    func, number = MICROBENCHMARKS[name]()
+    elapsed, relative = measure(func, number)
+    report(name, elapsed, 1)
+
+    baseline = load_baseline()
+    if os.environ.get("IRCD_BENCH_UPDATE"):
+        baseline[name] = round(relative, 3)
+        with open(BASELINE, "w") as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+            f.write("\n")
+        return
+
+    if name not in baseline:
+        pytest.skip("no baseline for {}, record one with IRCD_BENCH_UPDATE=1".format(name))
+    assert relative <= baseline[name] * THRESHOLD, "{} is {:.2f}x slower than its baseline".format(
+        name, relative / baseline[name])
@@ -1,13 +1,32 @@
+import time
 import asyncio
 import contextlib
 from unittest import mock
 import datetime
 import base64
+import pickle
+import hmac
+import hashlib
 
 import pytest
 
-from ircd import IRC, Server
+from ircd import IRC, Server, snapshot, upgrade, metrics
 from ircd.irc import SERVER_NAME, SERVER_VERSION
+from ircd.history import History, ENTRY_OVERHEAD
+from ircd.journal import Journal, digest, to_micros
+from ircd.accounts import AccountStore, Credentials, SQLiteAccountStore
+from ircd.flood import FloodControl, WindowCounter, ChannelFlood
+from ircd.sched import FairQueue, LaneQueue, LANE_DIRECT, LANE_CHANNEL, lane_for
+from ircd.net import Client, LineReader, PROCESS_MODES, PROCESS_QUEUE, REGISTRATION_TIMEOUT, MAX_UNREGISTERED, PREREG_COMMANDS, TOP_QUEUES
+from ircd.message import IRCMessage, MESSAGE_LIMIT, TAGS_LIMIT, truncate, join_tags, too_long
+from ircd.chan import Channel
+from ircd.nick import Nickname
+from ircd.mode import ModeParamMissing
+from ircd.watchdog import Watchdog
+from ircd.filter import Filter, parse_rules
+from ircd.clones import CloneIndex, CountIndex
+from ircd.ident import IdentResolver, parse_response
+from ircd.broadcast import BroadcastLog
 
 pytestmark = pytest.mark.asyncio
 
@@ -24,9 +43,12 @@ async def connect(address=ADDRESS, port=PORT):
 
 
 @contextlib.asynccontextmanager
-async def server_conn(address=ADDRESS, port=PORT):
-    irc = IRC(HOST)
-    server = Server(irc, ping_interval=5)
+async def server_conn(address=ADDRESS, port=PORT, flood=None, mode=PROCESS_QUEUE,
+                      registration_timeout=REGISTRATION_TIMEOUT, max_unregistered=MAX_UNREGISTERED, ident=None,
+                      **kwargs):
+    irc = IRC(HOST, **kwargs)
+    server = Server(irc, ping_interval=5, flood=flood, mode=mode, registration_timeout=registration_timeout,
+                    max_unregistered=max_unregistered, ident=ident)
 
     asyncio.create_task(server.run(address, port))
     await server.running.wait()
@@ -71,9 +93,9 @@ async def ident(reader, writer, irc, nick):
 
         ":localhost 003 {} :This server was created {}".format(nick, irc.created),
         ":localhost 004 {} :{} {} abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ".format(nick, SERVER_NAME, SERVER_VERSION),
-        ':localhost 005 {} :AWAYLEN= CASEMAPPING=ascii CHANLIMIT= CHANTYPES=#'.format(nick),
+        ':localhost 005 {} :AWAYLEN= CASEMAPPING=ascii CHANLIMIT= CHANTYPES=# CHATHISTORY=100 MODES=4'.format(nick),
         ':localhost 251 * :There are {} user(s) on {} server(s)'.format(len(irc.nicknames), len(irc.links) + 1),
-        ':localhost 252 0 :There are 0 operator(s) online',
+        ':localhost 252 {} :There are {} operator(s) online'.format(len(irc.operators), len(irc.operators)),
         ':localhost 254 {} :There are {} channels(s) formed'.format(len(irc.channels), len(irc.channels)),
         ':localhost 255 * :I have {} client(s) and {} server(s)'.format(len(irc.clients), len(irc.links) + 1),
         ':localhost 221 {} :+s'.format(nick),
@@ -149,6 +171,21 @@ async def test_nick():
         assert client.name == "bar"
         assert "bar" in irc.nicknames
 
+        # the connection keeps its handler and nickname across renames, commands are case insensitive
+        handler = client.handler
+        last_seen = irc.get_nickname("bar").last_seen
+        await send(writer, [
+            "motd"
+        ])
+        assert await readall(reader) == [
+            ':localhost 375 bar :- message of the day -',
+            ':localhost 372 bar :hello world',
+            ':localhost 376 bar :- end of message -',
+        ]
+        assert client.handler is handler
+        assert handler.nickname is irc.get_nickname("bar")
+        assert handler.nickname.last_seen > last_seen
+
 
 @pytest.mark.asyncio
 async def test_join_part():
@@ -370,6 +407,30 @@ async def test_channel_mode():
         assert channel.mode.mode == ""
 
 
+@pytest.mark.asyncio
+async def test_mode_flags():
+    channel = Channel("#", None)
+    mode = channel.mode
+    assert mode.set_flags("ntx") == "nt"
+    assert mode.mode == "tn"
+    assert mode.set_flags("l", param="10") == "l"
+    assert channel.limit == 10
+    assert mode.mode == "tnl"
+    assert mode.clear_flags("lnx") == "ln"
+    assert channel.limit is None
+    assert mode.mode == "t"
+    assert mode.has_flag("t") and not mode.has_flag("n") and not mode.has_flag("x")
+
+    with pytest.raises(ModeParamMissing):
+        mode.set_flags("k")
+    assert mode.mode == "t"
+
+    nickname = Nickname("foo")
+    assert nickname.mode.mode == "s"
+    nickname.set_away("gone")
+    assert nickname.is_away and nickname.mode.mode == "as"
+
+
 @pytest.mark.asyncio
 async def test_channel_operator():
     async with server_conn() as (irc, reader_a, writer_a), connect() as (reader_b, writer_b):
@@ -410,6 +471,37 @@ async def test_channel_operator():
         assert nickname not in channel.operators
 
 
+@pytest.mark.asyncio
+async def test_channel_multiple_modes():
+    async with server_conn() as (irc, reader_a, writer_a), connect() as (reader_b, writer_b):
+        await ident(reader_a, writer_a, irc, "foo")
+        await join(reader_a, writer_a, irc, "foo", "#")
+        await ident(reader_b, writer_b, irc, "bar")
+        await join(reader_b, writer_b, irc, "bar", "#")
+        await readall(reader_a)
+
+        channel = irc.channels["#"]
+
+        await send(writer_a, ["MODE # +nto-i+v bar bar"])
+        assert await readall(reader_a) == [":foo!foo@localhost MODE # +ntov bar :bar"]
+        assert await readall(reader_b) == [":foo!foo@localhost MODE # +ntov bar :bar"]
+        assert irc.get_nickname("bar") in channel.operators
+        assert irc.get_nickname("bar") in channel.voiced
+
+        # nothing is applied when any of the modes is bad
+        await send(writer_a, ["MODE # +mo baz", "MODE # +ik"])
+        assert await readall(reader_a) == [
+            ":localhost 441 foo baz # :They aren't on that channel",
+            ":localhost 461 foo MODE :Not enough parameters",
+        ]
+        assert channel.mode.mode == "tnvo"
+
+        # only the first MODES modes with a parameter are used
+        await send(writer_a, ["MODE # +bbbbb *!*@a *!*@b *!*@c *!*@d *!*@e"])
+        assert await readall(reader_a) == [":foo!foo@localhost MODE # +bbbb *!*@a *!*@b *!*@c :*!*@d"]
+        assert [str(mask) for mask in channel.bans] == ["*!*@a", "*!*@b", "*!*@c", "*!*@d"]
+
+
 @pytest.mark.asyncio
 async def test_set_channel_secret():
     async with server_conn() as (irc, reader, writer):
@@ -441,6 +533,34 @@ async def test_set_channel_secret():
         assert irc.channels["#"].key is None
 
 
+@pytest.mark.asyncio
+async def test_clear_key_with_param():
+    async with server_conn() as (irc, reader_a, writer_a), connect() as (reader_b, writer_b):
+        await ident(reader_a, writer_a, irc, "foo")
+        await join(reader_a, writer_a, irc, "foo", "#c")
+        await ident(reader_b, writer_b, irc, "bob")
+        await join(reader_b, writer_b, irc, "bob", "#c")
+        await send(writer_a, ["MODE #c +k key"])
+        await readall(reader_a)
+
+        # -k takes the key as its parameter, the next mode gets the one after it
+        await send(writer_a, ["MODE #c -k key +o bob"])
+        assert await readall(reader_a) == [
+            ":foo!foo@localhost MODE #c -k+o key :bob"
+        ]
+        channel = irc.channels["#c"]
+        assert channel.key is None
+        assert channel.is_operator(irc.get_nickname("bob"))
+
+        await send(writer_a, ["MODE #c +k -key", "MODE #c -k+v -key bob"])
+        assert await readall(reader_a) == [
+            ":foo!foo@localhost MODE #c +k :-key",
+            ":foo!foo@localhost MODE #c -k+v -key :bob",
+        ]
+        assert channel.key is None
+        assert irc.get_nickname("bob") in channel.voiced
+
+
 @pytest.mark.asyncio
 async def test_topic():
     async with server_conn() as (irc, reader, writer):
@@ -709,6 +829,1103 @@ async def test_away():
         ]
 
 
+@pytest.mark.asyncio
+async def test_chathistory():
+    async with server_conn() as (irc, reader_a, writer_a), connect() as (reader_b, writer_b):
+        await ident(reader_a, writer_a, irc, "foo")
+        await join(reader_a, writer_a, irc, "foo", "#")
+
+        await ident(reader_b, writer_b, irc, "bar")
+        await join(reader_b, writer_b, irc, "bar", "#")
+        await readall(reader_a)
+
+        await send(writer_a, ["PRIVMSG # :message {}".format(i) for i in range(5)])
+        await readall(reader_b)
+
+        entries = irc.history.get("#")
+        msgid = entries[2].msgid
+
+        with mock.patch("ircd.irc.generate_id") as id_patch:
+            id_patch.return_value = "XXX"
+
+            await send(writer_b, [
+                "CHATHISTORY LATEST # * 2",
+                "CHATHISTORY BEFORE # msgid={} 10".format(msgid),
+                "CHATHISTORY AFTER # timestamp={}Z 1".format(entries[2].timestamp.isoformat()),
+            ])
+            assert await readall(reader_b) == [
+                ":localhost BATCH +XXX chathistory :#",
+                ":foo!foo@localhost PRIVMSG # :message 3",
+                ":foo!foo@localhost PRIVMSG # :message 4",
+                ":localhost BATCH :-XXX",
+                ":localhost BATCH +XXX chathistory :#",
+                ":foo!foo@localhost PRIVMSG # :message 0",
+                ":foo!foo@localhost PRIVMSG # :message 1",
+                ":localhost BATCH :-XXX",
+                ":localhost BATCH +XXX chathistory :#",
+                ":foo!foo@localhost PRIVMSG # :message 3",
+                ":localhost BATCH :-XXX",
+            ]
+
+        await send(writer_b, [
+            "CHATHISTORY LATEST #nope * 10",
+            "CHATHISTORY BEFORE # * 10",
+        ])
+        assert await readall(reader_b) == [
+            ":localhost FAIL CHATHISTORY INVALID_TARGET LATEST #nope :Messages could not be retrieved",
+            ":localhost FAIL CHATHISTORY INVALID_PARAMS BEFORE :Invalid parameters",
+        ]
+
+
+@pytest.mark.asyncio
+async def test_chathistory_dm():
+    async with server_conn() as (irc, reader_a, writer_a):
+        await ident(reader_a, writer_a, irc, "foo")
+        async with connect() as (reader_b, writer_b):
+            await ident(reader_b, writer_b, irc, "bar")
+
+            # nothing is kept for clients that aren't logged in
+            await send(writer_a, ["PRIVMSG bar :hello"])
+            await readall(reader_b)
+            await send(writer_b, ["CHATHISTORY LATEST foo * 10"])
+            assert await readall(reader_b) == [
+                ":localhost FAIL CHATHISTORY INVALID_TARGET LATEST foo :Messages could not be retrieved",
+            ]
+
+            irc.lookup_client("foo").account = "fooacct"
+            irc.lookup_client("bar").account = "baracct"
+            await send(writer_a, ["PRIVMSG bar :secret"])
+            await readall(reader_b)
+
+            with mock.patch("ircd.irc.generate_id") as id_patch:
+                id_patch.return_value = "XXX"
+                await send(writer_b, [
+                    "CHATHISTORY LATEST foo * 10",
+                    # offsets are converted to UTC
+                    "CHATHISTORY AFTER foo timestamp=2000-01-01T02:00:00+02:00 10",
+                ])
+                assert await readall(reader_b) == [
+                    ":localhost BATCH +XXX chathistory :foo",
+                    ":foo!foo@localhost PRIVMSG bar :secret",
+                    ":localhost BATCH :-XXX",
+                    ":localhost BATCH +XXX chathistory :foo",
+                    ":foo!foo@localhost PRIVMSG bar :secret",
+                    ":localhost BATCH :-XXX",
+                ]
+
+            async with connect() as (reader_c, writer_c):
+                await ident(reader_c, writer_c, irc, "baz")
+                irc.lookup_client("baz").account = "bazacct"
+                await send(writer_c, ["PRIVMSG bar :other"])
+                await readall(reader_b)
+            await readall(reader_b)
+            await readall(reader_a)
+            writer_a.close()
+            await asyncio.sleep(0.1)
+
+            # the peer's account still reaches the conversation once it is offline
+            with mock.patch("ircd.irc.generate_id") as id_patch:
+                id_patch.return_value = "XXX"
+                await send(writer_b, ["CHATHISTORY LATEST fooacct * 10"])
+                assert await readall(reader_b) == [
+                    ":localhost BATCH +XXX chathistory :fooacct",
+                    ":foo!foo@localhost PRIVMSG bar :secret",
+                    ":localhost BATCH :-XXX",
+                ]
+
+        # whoever takes the nickname next doesn't get the conversation
+        async with connect() as (reader_b, writer_b):
+            await ident(reader_b, writer_b, irc, "bar")
+            await send(writer_b, ["CHATHISTORY LATEST fooacct * 10"])
+            assert await readall(reader_b) == [
+                ":localhost FAIL CHATHISTORY INVALID_TARGET LATEST fooacct :Messages could not be retrieved",
+            ]
+            irc.lookup_client("bar").account = "other"
+            with mock.patch("ircd.irc.generate_id") as id_patch:
+                id_patch.return_value = "XXX"
+                await send(writer_b, ["CHATHISTORY LATEST fooacct * 10"])
+                assert await readall(reader_b) == [
+                    ":localhost BATCH +XXX chathistory :fooacct",
+                    ":localhost BATCH :-XXX",
+                ]
+
+        assert set(irc.history.buffers) == {
+            ("account:baracct", "account:fooacct"),
+            ("account:baracct", "account:bazacct"),
+        }
+
+
+@pytest.mark.asyncio
+async def test_history_byte_budget():
+    history = History(length=3, max_bytes=3 * (ENTRY_OVERHEAD + 50))
+    for i in range(4):
+        history.add("#a", IRCMessage("foo", "PRIVMSG", "#a", str(i)))
+    assert [msg.args[1] for msg in history.query("LATEST", "#a", [("*", None)], 10)] == ["1", "2", "3"]
+
+    history.add("#b", IRCMessage("foo", "PRIVMSG", "#b", "x"))
+    assert history.get("#a") is None
+    assert history.size <= history.max_bytes
+
+
+@pytest.mark.asyncio
+async def test_history_journal(tmp_path):
+    history = History(length=2, backend=Journal(str(tmp_path), segment_bytes=256))
+    messages = [IRCMessage("foo!foo@localhost", "PRIVMSG", "#a", "message {}".format(i), tags=["+x=y"]) for i in range(10)]
+    for message in messages:
+        history.add("#a", message)
+    history.close()
+
+    # older messages come from disk once the buffer runs out
+    history = History(length=2, backend=Journal(str(tmp_path)))
+    history.add("#a", IRCMessage("foo!foo@localhost", "PRIVMSG", "#a", "message 10"))
+    latest = history.query("LATEST", "#a", [("*", None)], 4)
+    assert [message.args[1] for message in latest] == ["message 7", "message 8", "message 9", "message 10"]
+
+    before = history.query("BEFORE", "#a", [("msgid", messages[3].id)], 2)
+    assert [message.id for message in before] == [messages[1].id, messages[2].id]
+    assert before[0].time == messages[1].time
+    assert before[0].client_tags == ["+x=y"]
+
+    # answers the buffer covers don't touch the backend, ones reaching past its oldest entry do
+    history.add("#a", IRCMessage("foo!foo@localhost", "PRIVMSG", "#a", "message 11"))
+    with mock.patch.object(history.backend, "query") as backend_query:
+        latest = history.query("LATEST", "#a", [("*", None)], 1)
+        assert [message.args[1] for message in latest] == ["message 11"]
+        assert not backend_query.called
+
+    future = asyncio.get_running_loop().create_future()
+    history.query_async("AFTER", "#a", [("timestamp", messages[0].time)], 2, future.set_result)
+    assert [message.id for message in await future] == [messages[1].id, messages[2].id]
+
+    assert len(history.backend.get_log("#a").segments) > 1
+    history.close()
+
+
+@pytest.mark.asyncio
+async def test_journal_expire(tmp_path):
+    journal = Journal(str(tmp_path), segment_bytes=256, retention=60)
+    old = datetime.datetime.utcnow() - datetime.timedelta(hours=1)
+    for i in range(3):
+        message = IRCMessage("foo!foo@localhost", "PRIVMSG", "#a", "message {}".format(i))
+        message.time = old
+        journal.append("#a", message)
+    journal.close()
+
+    # the current segment is removed as well once everything in it has expired
+    journal = Journal(str(tmp_path), retention=60)
+    journal.expire()
+    assert journal.get_log("#a").segments == []
+    assert journal.query("LATEST", "#a", [("*", None)], 10) == []
+
+    # a record is readable as soon as it is written, without waiting for the writer to flush
+    message = IRCMessage("foo!foo@localhost", "PRIVMSG", "#a", "new")
+    journal._write("#a", to_micros(message.time), digest(message.id), message.format().encode())
+    assert [message.args[1] for message in journal.query("LATEST", "#a", [("*", None)], 10)] == ["new"]
+    journal.close()
+
+
+@pytest.mark.asyncio
+async def test_snapshot(tmp_path):
+    async with server_conn() as (irc, reader, writer):
+        await ident(reader, writer, irc, "foo")
+        await join(reader, writer, irc, "foo", "#")
+        await send(writer, [
+            "TOPIC # :hello world",
+            "MODE # +t",
+            "MODE # +k :sekret",
+            "MODE # +b *!*@example.com",
+            "MODE # +f 3:10,j1:10",
+            "MODE # +l 5",
+        ])
+        await readall(reader)
+        # a flood lock's flag isn't kept, nothing would clear it after a restart
+        irc.lock_channel(irc.get_channel("#"), "m")
+        irc.accounts.register("foo", "bar", iterations=4096)
+
+        path = str(tmp_path / "ircd.snapshot")
+        await snapshot.save(irc, path)
+
+    restored = IRC(HOST)
+    assert snapshot.load(restored, path)
+    channel = restored.get_channel("#")
+    assert channel.topic == "hello world"
+    assert channel.key == "sekret"
+    assert channel.mode.mode == "tlkf"
+    assert channel.flood.param == "3:10,j1:10"
+    assert channel.limit == 5
+    assert [str(mask) for mask in channel.bans] == ["*!*@example.com"]
+    assert channel.members == []
+
+    # whoever joins first doesn't take over the restored channel
+    nickname = Nickname("bar")
+    assert channel.join(nickname, key="sekret")
+    assert channel.members == [nickname] and channel.operators == []
+    assert restored.accounts.verify("foo", "bar")
+    assert not restored.accounts.verify("foo", "baz")
+
+    with open(path, "wb") as f:
+        f.write(snapshot.MAGIC + bytes([snapshot.VERSION]) + pickle.dumps(IRC))
+    with pytest.raises(snapshot.SnapshotError):
+        snapshot.read(path)
+
+
+@pytest.mark.asyncio
+async def test_upgrade_state():
+    async with server_conn() as (irc, reader_a, writer_a), connect() as (reader_b, writer_b):
+        await ident(reader_a, writer_a, irc, "foo")
+        await join(reader_a, writer_a, irc, "foo", "#")
+        await ident(reader_b, writer_b, irc, "bar")
+        await join(reader_b, writer_b, irc, "bar", "#")
+        await send(writer_a, ["MODE # +mv bar"])
+        await readall(reader_a)
+        state = upgrade.capture(irc, [])
+
+    restored = IRC(HOST)
+    upgrade.restore(restored, state)
+    channel = restored.get_channel("#")
+    assert [nickname.nickname for nickname in channel.members] == ["foo", "bar"]
+    assert channel.operators == [restored.get_nickname("foo")]
+    assert channel.voiced == [restored.get_nickname("bar")]
+    assert channel.can_speak(restored.get_nickname("bar"))
+
+
+@pytest.mark.asyncio
+async def test_upgrade():
+    irc = IRC(HOST)
+    server = Server(irc, ping_interval=5)
+    asyncio.create_task(server.run(ADDRESS, PORT))
+    await server.running.wait()
+
+    async with connect() as (reader_a, writer_a), connect() as (reader_b, writer_b):
+        await ident(reader_a, writer_a, irc, "foo")
+        await join(reader_a, writer_a, irc, "foo", "#")
+        await ident(reader_b, writer_b, irc, "bar")
+        await join(reader_b, writer_b, irc, "bar", "#")
+        await readall(reader_a)
+
+        # output the old process couldn't send holds the upgrade back
+        transport = next(iter(server.connections.values())).writer.transport
+        with mock.patch.object(type(transport), "get_write_buffer_size", return_value=1):
+            with pytest.raises(upgrade.UpgradeError):
+                await upgrade.handoff(server, ["--host", HOST, "--listen", "{}:{}".format(ADDRESS, PORT)])
+        await send(writer_a, ["PRIVMSG # :not yet"])
+        assert await readall(reader_b) == [":foo!foo@localhost PRIVMSG # :not yet"]
+
+        proc = await upgrade.handoff(server, ["--host", HOST, "--listen", "{}:{}".format(ADDRESS, PORT)])
+        try:
+            await send(writer_a, [
+                "PRIVMSG # :still here",
+                "NAMES #",
+            ])
+            assert await readall(reader_a) == [
+                ":localhost 353 foo = # :bar foo",
+                ":localhost 366 foo # :End of /NAMES list.",
+            ]
+            assert await readall(reader_b) == [
+                ":foo!foo@localhost PRIVMSG # :still here",
+            ]
+
+            # new connections are accepted by the new process too
+            async with connect() as (reader_c, writer_c):
+                await send(writer_c, ["NICK foo"])
+                assert await readall(reader_c) == [":localhost 433 :foo"]
+        finally:
+            proc.terminate()
+            proc.wait()
+
+    await server.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_flood():
+    flood = FloodControl(burst=2, rate=5, recvq=512)
+    async with server_conn(flood=flood) as (irc, reader, writer):
+        await ident(reader, writer, irc, "foo")
+
+        # over budget input is delayed rather than dropped
+        start = asyncio.get_running_loop().time()
+        await send(writer, [
+            "AWAY :brb",
+            "AWAY",
+            "AWAY :brb",
+            "AWAY",
+        ])
+        lines = [await asyncio.wait_for(reader.readline(), 5) for _ in range(4)]
+        assert asyncio.get_running_loop().time() - start >= .2
+        assert lines[-1] == b":localhost 305 foo :You are no longer marked as being away\r\n"
+
+        # operators are exempt
+        irc.get_nickname("foo").set_mode("o")
+        await send(writer, ["AWAY :brb", "AWAY"] * 20)
+        assert len(await readall(reader)) == 40
+        irc.get_nickname("foo").clear_mode("o")
+
+        await send(writer, ["AWAY :brb", "AWAY"] * 50)
+        data = await asyncio.wait_for(reader.read(), 5)
+        assert data.endswith(b"ERROR :Closing Link: localhost (Excess Flood)\r\n")
+        assert not irc.has_nickname("foo")
+
+
+@pytest.mark.asyncio
+async def test_window_counter():
+    counter = WindowCounter(3, 10)
+    start = counter.start
+    assert not any(counter.hit(start + i) for i in range(3))
+    assert counter.hit(start + 3)
+
+    # halfway through the next window half of the previous one still counts
+    assert not counter.hit(start + 15)
+    assert counter.hit(start + 15)
+    assert counter.current == 2 and counter.previous == 4
+
+    # two windows later nothing from before counts
+    assert not counter.hit(start + 40)
+    assert counter.previous == 0
+
+    assert ChannelFlood.parse("10:5,j3:30").joins.period == 30
+    assert ChannelFlood.parse("10:5").joins is None
+    assert ChannelFlood.parse("10") is None
+    assert ChannelFlood.parse("0:5") is None
+
+
+@pytest.mark.asyncio
+async def test_channel_flood():
+    async with server_conn(flood=FloodControl(burst=100)) as (irc, reader_a, writer_a), \
+            connect() as (reader_b, writer_b), connect() as (reader_c, writer_c):
+        irc.channel_flood_lock = .5
+        await ident(reader_a, writer_a, irc, "foo")
+        await join(reader_a, writer_a, irc, "foo", "#")
+        await ident(reader_b, writer_b, irc, "bar")
+        await join(reader_b, writer_b, irc, "bar", "#")
+        await readall(reader_a)
+
+        await send(writer_a, ["MODE # +f :junk", "MODE # +f 3:10,j1:10"])
+        assert await readall(reader_a) == [
+            ":localhost 461 foo MODE :Not enough parameters",
+            ":foo!foo@localhost MODE # +f :3:10,j1:10",
+        ]
+        await readall(reader_b)
+
+        await send(writer_b, ["PRIVMSG # :{}".format(i) for i in range(5)])
+        assert await readall(reader_a) == [
+            ":bar!bar@localhost PRIVMSG # :0",
+            ":bar!bar@localhost PRIVMSG # :1",
+            ":bar!bar@localhost PRIVMSG # :2",
+            ":localhost MODE # :+m",
+        ]
+        assert await readall(reader_b) == [
+            ":localhost MODE # :+m",
+            ":localhost 404 bar # :Cannot send to channel",
+            ":localhost 404 bar # :Cannot send to channel",
+        ]
+
+        # operators can still talk
+        await send(writer_a, ["PRIVMSG # :calm down"])
+        assert await readall(reader_b) == [":foo!foo@localhost PRIVMSG # :calm down"]
+
+        await asyncio.sleep(.5)
+        assert await readall(reader_a) == [":localhost MODE # :-m"]
+        assert not irc.channels["#"].is_moderated
+
+        await ident(reader_c, writer_c, irc, "baz")
+        await send(writer_c, ["JOIN #"])
+        await readall(reader_c)
+        await send(writer_c, ["PART #", "JOIN #"])
+        assert await readall(reader_c) == [
+            ":baz!baz@localhost PART :#",
+            ":localhost 473 baz :# :Cannot join channel (+i)",
+        ]
+        assert irc.channels["#"].is_invite_only
+
+        # an operator setting the flag again keeps it past the lock
+        await send(writer_a, ["MODE # +i"])
+        await asyncio.sleep(.6)
+        assert irc.channels["#"].is_invite_only
+
+
+@pytest.mark.asyncio
+async def test_fair_queue():
+    queue = FairQueue(quantum=2, link_weight=3)
+    a, b, link = Client("a", "a"), Client("b", "b"), Client("c", "c", link=True)
+    for i in range(5):
+        await queue.put((a, "a{}".format(i)))
+    for i in range(8):
+        await queue.put((link, "l{}".format(i)))
+    await queue.put((b, "b0"))
+
+    assert queue.qsize() == 14
+    assert queue.depth(a) == 5 and queue.depth(b) == 1
+    assert queue.head_latency(a) >= 0
+    assert sorted(depth for _, depth, _ in queue.stats()) == [1, 5, 8]
+
+    order = [(await queue.get())[1] for _ in range(14)]
+    assert order == [
+        "a0", "a1", "l0", "l1", "l2", "l3", "l4", "l5", "b0",
+        "a2", "a3", "l6", "l7", "a4",
+    ]
+    assert queue.empty()
+    with pytest.raises(asyncio.QueueEmpty):
+        queue.get_nowait()
+
+
+@pytest.mark.asyncio
+async def test_incoming_metrics():
+    irc = IRC(HOST)
+    server = Server(irc)
+    server.incoming = FairQueue()
+    for i in range(TOP_QUEUES + 5):
+        client = Client("127.0.0.1", HOST)
+        client.name = "c{}".format(i)
+        for j in range(i + 1):
+            await server.incoming.put((client, "m{}".format(j)))
+
+    # only the clients queueing the most get a series of their own
+    depth = irc.metrics.get("ircd_incoming_client_depth")
+    assert sorted(depth.collect(), key=lambda sample: -sample[1]) == [
+        (("c{}".format(i),), i + 1) for i in reversed(range(5, TOP_QUEUES + 5))]
+    assert len(irc.metrics.get("ircd_incoming_client_head_latency_seconds").collect()) == TOP_QUEUES
+    assert irc.metrics.get("ircd_incoming_depth_max").collect() == TOP_QUEUES + 5
+
+    lines = metrics.render(irc.metrics.collect()).splitlines()
+    assert 'ircd_incoming_client_depth{{client="c{}"}} {}'.format(TOP_QUEUES + 4, TOP_QUEUES + 5) in lines
+
+
+@pytest.mark.asyncio
+async def test_lane_queue():
+    assert lane_for(IRCMessage.reply_pong("localhost", "x")) == 0
+    assert lane_for(IRCMessage("foo!foo@localhost", "PRIVMSG", "bar", "hi")) == LANE_DIRECT
+    assert lane_for(IRCMessage("foo!foo@localhost", "PRIVMSG", "#a", "hi")) == LANE_CHANNEL
+    assert lane_for(IRCMessage("foo!foo@localhost", "PRIVMSG", "#a", "hi"), replying=True) == LANE_DIRECT
+    assert lane_for(IRCMessage("foo!foo@localhost", "TAGMSG", "#a", tags=["+typing=active"])) == 3
+
+    def fill(queue):
+        for i in range(6):
+            queue.put_nowait(IRCMessage("foo!foo@localhost", "PRIVMSG", "#a", "c{}".format(i)))
+            queue.put_nowait(IRCMessage("foo!foo@localhost", "TAGMSG", "bar", "t{}".format(i)))
+            queue.put_nowait(IRCMessage("localhost", "NOTICE", "bar", "d{}".format(i)))
+        queue.put_nowait(IRCMessage("localhost", "PING", "p"))
+        queue.put_nowait(None)
+
+    queue = LaneQueue()
+    fill(queue)
+    queue.put_nowait(IRCMessage("localhost", "NOTICE", "bar", "dropped"))
+    assert queue.qsize() == 19
+
+    order = [(await queue.get()).args[-1] for _ in range(19)]
+    assert order == [
+        "p", "d0", "d1", "d2", "d3", "c0", "c1", "t0", "d4", "d5", "c2", "c3", "t1",
+        "c4", "c5", "t2", "t3", "t4", "t5",
+    ]
+    assert not queue.empty() and await queue.get() is None
+    assert queue.empty()
+
+    strict = LaneQueue(weights=None)
+    fill(strict)
+    assert [strict.get_nowait().args[-1] for _ in range(19)][:8] == ["p", "d0", "d1", "d2", "d3", "d4", "d5", "c0"]
+
+    # a nickname change waits for what was queued before it and holds back everything after it
+    queue = LaneQueue()
+    queue.put_nowait(IRCMessage("foo!foo@localhost", "PRIVMSG", "#a", "c0"))
+    queue.put_nowait(IRCMessage("foo!foo@localhost", "PRIVMSG", "bar", "d0"))
+    queue.put_nowait(IRCMessage("foo!foo@localhost", "NICK", "baz"))
+    queue.put_nowait(IRCMessage("baz!foo@localhost", "PRIVMSG", "bar", "d1"))
+    queue.put_nowait(IRCMessage("baz!foo@localhost", "PRIVMSG", "#a", "c1"))
+    queue.put_nowait(IRCMessage("baz!foo@localhost", "QUIT", "bye"))
+    queue.put_nowait(IRCMessage("localhost", "PING", "p"))
+    assert queue.qsize() == 7
+    assert [queue.get_nowait().args[-1] for _ in range(7)] == ["p", "d0", "c0", "baz", "d1", "c1", "bye"]
+    assert queue.empty()
+
+
+@pytest.mark.asyncio
+async def test_broadcast_log():
+    log = BroadcastLog(size=4)
+    a, b = LaneQueue(), LaneQueue()
+    a.subscribe(log)
+    b.subscribe(log)
+
+    def message(text):
+        return IRCMessage("foo!foo@localhost", "PRIVMSG", "#a", text)
+
+    log.append(message("0"), skip=a)
+    log.append(message("1"), skip=b)
+    a.put_nowait(IRCMessage("localhost", "NOTICE", "a", "direct"))
+    assert a.qsize() == 3 and b.qsize() == 2
+    assert [a.get_nowait().args[-1] for _ in range(2)] == ["direct", "1"]
+    assert a.empty()
+
+    # a waiting reader is woken by the next append
+    getter = asyncio.create_task(a.get())
+    await asyncio.sleep(0)
+    assert a in log.waiting
+    log.append(message("2"))
+    assert (await getter).args[-1] == "2"
+
+    # what was broadcast before unsubscribing is still delivered
+    a.unsubscribe(log)
+    log.append(message("3"))
+    assert a.empty() and not a.logs
+    assert b.get_nowait().args[-1] == "0"
+
+    for i in range(4, 8):
+        log.append(message(str(i)))
+    assert not b.empty() and b.overrun
+    assert b.get_nowait() is None and not b.logs
+
+
+@pytest.mark.asyncio
+async def test_broadcast_channel():
+    async with server_conn(broadcast_threshold=2) as (irc, reader_a, writer_a), connect() as (reader_b, writer_b):
+        await ident(reader_a, writer_a, irc, "foo")
+        await ident(reader_b, writer_b, irc, "bar")
+        await join(reader_a, writer_a, irc, "foo", "#")
+        await join(reader_b, writer_b, irc, "bar", "#")
+        assert await readall(reader_a) == [":bar!bar@localhost JOIN :#"]
+
+        channel = irc.get_channel("#")
+        assert channel.log is not None
+        bar = irc.lookup_client("bar")
+        assert channel.log in bar.outgoing.logs
+
+        await send(writer_a, ["PRIVMSG # :hello", "MODE # +m"])
+        assert await readall(reader_a) == [":foo!foo@localhost MODE # :+m"]
+        assert await readall(reader_b) == [":foo!foo@localhost PRIVMSG # :hello", ":foo!foo@localhost MODE # :+m"]
+
+        await send(writer_b, ["PART #"])
+        assert await readall(reader_b) == [":bar!bar@localhost PART :#"]
+        assert await readall(reader_a) == [":bar!bar@localhost PART :#"]
+        assert not bar.outgoing.logs
+
+        await send(writer_a, ["PRIVMSG # :anyone?"])
+        assert await readall(reader_b) == []
+        assert channel.log.head == 5
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("mode", PROCESS_MODES)
+async def test_process_modes(mode):
+    flood = FloodControl(burst=100)
+    async with server_conn(mode=mode, flood=flood) as (irc, reader_a, writer_a), connect() as (reader_b, writer_b):
+        await ident(reader_a, writer_a, irc, "foo")
+        await join(reader_a, writer_a, irc, "foo", "#")
+        await ident(reader_b, writer_b, irc, "bar")
+        await join(reader_b, writer_b, irc, "bar", "#")
+        await readall(reader_a)
+
+        await send(writer_a, ["PRIVMSG # :{}".format(i) for i in range(50)])
+        assert await readall(reader_b) == [":foo!foo@localhost PRIVMSG # :{}".format(i) for i in range(50)]
+
+
+@pytest.mark.asyncio
+async def test_metrics():
+    async def get(path):
+        reader, writer = await asyncio.open_connection(ADDRESS, PORT + 1)
+        writer.write("GET {} HTTP/1.0\r\nHost: localhost\r\n\r\n".format(path).encode())
+        response = await reader.read()
+        writer.close()
+        return response.decode()
+
+    async with server_conn() as (irc, reader, writer):
+        task = asyncio.create_task(metrics.serve(irc.metrics, ADDRESS, PORT + 1))
+        await asyncio.sleep(.1)
+
+        await ident(reader, writer, irc, "foo")
+        await join(reader, writer, irc, "foo", "#")
+        await send(writer, ["PRIVMSG # :hello"])
+        await readall(reader)
+
+        response = await get("/metrics")
+        head, body = response.split("\r\n\r\n", 1)
+        assert head.startswith("HTTP/1.0 200 OK")
+        lines = body.splitlines()
+        assert "# TYPE ircd_messages_received_total counter" in lines
+        assert "ircd_messages_received_total 4" in lines
+        assert "ircd_registrations_total 1" in lines
+        assert "ircd_clients 1" in lines
+        assert "ircd_channels 1" in lines
+        assert "ircd_connections 1" in lines
+        # the join and the message
+        assert 'ircd_channel_fanout_bucket{le="1"} 2' in lines
+        assert 'ircd_channel_fanout_bucket{le="+Inf"} 2' in lines
+        assert "ircd_channel_fanout_count 2" in lines
+
+        assert (await get("/")).startswith("HTTP/1.0 404 Not Found")
+        task.cancel()
+
+
+@pytest.mark.asyncio
+async def test_stats():
+    async with server_conn() as (irc, reader, writer):
+        await ident(reader, writer, irc, "foo")
+        await join(reader, writer, irc, "foo", "#")
+        await send(writer, ["PRIVMSG # :hello", "STATS m"])
+        assert await readall(reader) == [":localhost 481 foo :Permission Denied- You're not an IRC operator"]
+
+        irc.get_nickname("foo").set_mode("o")
+        await send(writer, ["STATS m"])
+        assert await readall(reader) == [
+            ":localhost 212 foo JOIN 1 0 :0",
+            ":localhost 212 foo NICK 1 0 :0",
+            ":localhost 212 foo PRIVMSG 1 0 :0",
+            ":localhost 212 foo STATS 1 0 :0",
+            ":localhost 212 foo USER 1 0 :0",
+            ":localhost 219 foo m :End of STATS report",
+        ]
+
+        client = irc.lookup_client("foo")
+        await send(writer, ["STATS l"])
+        replies = await readall(reader)
+        # name, sendq, messages and kbytes sent, messages and kbytes received
+        assert replies[0].split()[3:9] == ["foo!foo@localhost", "0", str(client.messages_out - 2),
+                                           str(client.bytes_out // 1024), str(client.messages_in), "0"]
+        assert replies[1:] == [":localhost 219 foo l :End of STATS report"]
+
+        await send(writer, ["STATS p"])
+        replies = await readall(reader)
+        assert [reply.split()[3] for reply in replies] == [":JOIN", ":NICK", ":PRIVMSG", ":STATS", ":USER", "p"]
+        assert "calls=1 " in replies[0] and "sent=4.0" in replies[0]
+        assert "sent=0.0" in replies[2]
+
+        metric = irc.metrics.get("ircd_command_seconds").labels("USER")
+        assert metric.count == 1 and 0 < metric.quantile(.5) < 1
+
+
+@pytest.mark.asyncio
+async def test_clone_index():
+    counts = CountIndex()
+    for key in "abbcccd":
+        counts.increment(key)
+    counts.decrement("d")
+    assert counts.top(2) == [("c", 3), ("b", 2)]
+    assert counts["d"] == 0 and len(counts) == 3
+    for _ in range(3):
+        counts.decrement("c")
+    assert counts.top(5) == [("b", 2), ("a", 1)]
+
+    clones = CloneIndex(limit=2, cidr_limit=3, classes=["192.0.2.128/25=5"])
+    assert clones.admit("198.51.100.1") and clones.admit("198.51.100.1")
+    assert not clones.admit("198.51.100.1")
+    assert clones.admit("::ffff:198.51.100.2")
+    # the /24 is full
+    assert not clones.admit("198.51.100.3")
+    assert clones.admit("198.51.101.1")
+
+    assert clones.admit("2001:db8::1") and clones.admit("2001:db8::2") and clones.admit("2001:db8::3")
+    assert not clones.admit("2001:db8::4")
+    assert clones.admit("2001:db8:0:1::1")
+
+    # in a class: its own limit, no network limit
+    assert all(clones.admit("192.0.2.200") for _ in range(5))
+    assert not clones.admit("192.0.2.200")
+    assert all(clones.admit("127.0.0.1") for _ in range(50))
+
+    clones.release("198.51.100.1")
+    assert clones.admit("198.51.100.3")
+
+    addresses, networks = clones.top(2)
+    assert addresses == [("127.0.0.1", 50), ("192.0.2.200", 5)]
+    assert sorted((str(network), count) for network, count in networks) == [
+        ("198.51.100.0/24", 3), ("2001:db8::/64", 3)]
+
+
+@pytest.mark.asyncio
+async def test_clone_limit():
+    async with server_conn(clones=CloneIndex(classes=["127.0.0.0/8=2"])) as (irc, reader_a, writer_a):
+        async with connect() as (reader_b, writer_b):
+            async with connect() as (reader_c, writer_c):
+                assert await readall(reader_c) == ["ERROR :Closing Link: 127.0.0.1 (Too many connections from your host)"]
+                assert await reader_c.read() == b""
+            assert irc.metrics.get("ircd_connections_rejected_total").value == 1
+
+            await ident(reader_a, writer_a, irc, "foo")
+            irc.get_nickname("foo").set_mode("o")
+            await send(writer_a, ["STATS c"])
+            assert await readall(reader_a) == [
+                ":localhost 249 foo :clones 127.0.0.1 2",
+                ":localhost 219 foo c :End of STATS report",
+            ]
+
+        await asyncio.sleep(.1)
+        async with connect() as (reader_c, writer_c):
+            await ident(reader_c, writer_c, irc, "bar")
+        await asyncio.sleep(.1)
+        assert irc.clones.addresses["127.0.0.1"] == 1
+
+        # a connection that fails before it is served doesn't keep its count
+        with mock.patch("ircd.net.resolve_peerinfo", side_effect=OSError("lookup failed")):
+            async with connect() as (reader_c, writer_c):
+                assert await reader_c.read() == b""
+        assert irc.clones.addresses["127.0.0.1"] == 1
+
+
+@pytest.mark.asyncio
+async def test_registration_limits():
+    async with server_conn(registration_timeout=.3, max_unregistered=2) as (irc, reader_a, writer_a):
+        unregistered = irc.metrics.get("ircd_unregistered")
+        async with connect() as (reader_b, writer_b), connect() as (reader_c, writer_c):
+            assert await readall(reader_c) == ["ERROR :Closing Link: 127.0.0.1 (Server is busy)"]
+            assert unregistered.collect() == 2
+
+            # replies before registration are written directly, nothing is queued
+            await send(writer_a, ["CAP LS"])
+            assert await readall(reader_a) == [":localhost CAP * LS :" + " ".join(irc.get_capabilities())]
+            await ident(reader_a, writer_a, irc, "foo")
+            assert unregistered.collect() == 1
+            assert irc.lookup_client("foo").outgoing is not None
+
+            await send(writer_b, ["CAP END"] * (PREREG_COMMANDS + 1))
+            assert await readall(reader_b) == ["ERROR :Closing Link: localhost (Too much data before registration)"]
+            assert await reader_b.read() == b""
+
+        async with connect() as (reader_b, writer_b):
+            await send(writer_b, ["NICK bar"])
+            await asyncio.sleep(.4)
+            assert await readall(reader_b) == ["ERROR :Closing Link: localhost (Registration timed out)"]
+            assert await reader_b.read() == b""
+            assert not irc.has_nickname("bar")
+        assert unregistered.collect() == 0
+
+        # connections still being looked up count against the limit too
+        resolved = asyncio.Event()
+
+        async def resolve_peerinfo(host, port):
+            await resolved.wait()
+            return host, port, HOST
+
+        with mock.patch("ircd.net.resolve_peerinfo", resolve_peerinfo):
+            async with connect() as (reader_b, writer_b), connect() as (reader_c, writer_c):
+                await asyncio.sleep(.1)
+                assert unregistered.collect() == 2
+                async with connect() as (reader_d, writer_d):
+                    assert await readall(reader_d) == ["ERROR :Closing Link: 127.0.0.1 (Server is busy)"]
+                resolved.set()
+                await send(writer_b, ["NICK bar"])
+                assert await readall(reader_b) == []
+                assert unregistered.collect() == 2
+        await asyncio.sleep(.1)
+        assert unregistered.collect() == 0
+
+
+@pytest.mark.asyncio
+async def test_ident_lookup():
+    assert parse_response("6193, 23 : USERID : UNIX : stjohns\r\n", 6193, 23) == "stjohns"
+    assert parse_response("6193, 23 : USERID : UNIX : averyverylongname", 6193, 23) == "averyveryl"
+    assert parse_response("6193, 23 : ERROR : NO-USER", 6193, 23) is None
+    assert parse_response("6193, 24 : USERID : UNIX : stjohns", 6193, 23) is None
+    assert parse_response("6193, 23 : USERID : UNIX : st@johns", 6193, 23) is None
+
+    queries = []
+    closed = []
+    stalled = asyncio.Event()
+    released = asyncio.Event()
+
+    async def identd(reader, writer):
+        line = (await reader.readline()).decode().strip()
+        queries.append(line)
+        if stalled.is_set():
+            eof = asyncio.ensure_future(reader.read())
+            await asyncio.wait([asyncio.ensure_future(released.wait()), eof], return_when=asyncio.FIRST_COMPLETED)
+            if eof.done():
+                # the server gave up on the query
+                closed.append(line)
+                return
+        writer.write("{} : USERID : UNIX : alice\r\n".format(line).encode())
+        writer.close()
+
+    identd_server = await asyncio.start_server(identd, ADDRESS, 0)
+    resolver = IdentResolver(timeout=.2, port=identd_server.sockets[0].getsockname()[1])
+    with mock.patch("ircd.ident.asyncio.open_connection", wraps=asyncio.open_connection) as open_connection:
+        async with server_conn(ident=resolver) as (irc, reader_a, writer_a):
+            await asyncio.sleep(.1)
+            await send(writer_a, ["NICK foo", "USER foo 0 * :foo"])
+            assert (await readall(reader_a))[0] == ":foo!alice@localhost NICK :foo"
+            remote_port, local_port = queries[0].split(", ")
+            assert local_port == str(PORT)
+            # the query comes from the address the client connected to
+            assert open_connection.call_args.kwargs["local_addr"] == (ADDRESS, 0)
+
+            # results are cached for the same pair of ports
+            assert await resolver.lookup(ADDRESS, int(remote_port), PORT, ADDRESS) == "alice"
+            assert len(queries) == 1
+
+            # registration doesn't wait for a slow lookup
+            stalled.set()
+            async with connect() as (reader_b, writer_b):
+                await send(writer_b, ["NICK bar", "USER bar 0 * :bar"])
+                assert (await readall(reader_b))[0] == ":bar!~bar@localhost NICK :bar"
+                await asyncio.sleep(.2)
+                assert irc.lookup_client("bar").user == "~bar"
+
+            # a client that goes before its lookup answers doesn't leave the lookup running
+            resolver.timeout = 5
+            async with connect():
+                await asyncio.sleep(.1)
+            await asyncio.sleep(.1)
+            assert len(queries) == 3 and closed == queries[1:]
+            released.set()
+
+    identd_server.close()
+    await identd_server.wait_closed()
+
+
+@pytest.mark.asyncio
+async def test_line_reader():
+    stream = asyncio.StreamReader()
+    stream.feed_data(b"a\r\n" + b"x" * 100 + b"\r\nb\r\nc")
+    reader = LineReader(stream, limit=16)
+    assert await reader.readline() == b"a"
+    # too long, skipped
+    assert await reader.readline() is None
+    assert await reader.readline() == b"b"
+    assert await reader.take() == b"c"
+    assert len(reader) == 1
+
+    stream.feed_eof()
+    with pytest.raises(asyncio.IncompleteReadError):
+        await reader.readline()
+
+
+@pytest.mark.asyncio
+async def test_malformed_lines():
+    async with server_conn(max_unregistered=2) as (irc, reader_a, writer_a):
+        unregistered = irc.metrics.get("ircd_unregistered")
+        # blank lines are ignored, lines that don't parse or decode are dropped
+        writer_a.write(b"\r\n   \r\n\xff\xfe\r\n@tag\r\n:prefix\r\n:prefix \r\n")
+        await send(writer_a, ["CAP LS"])
+        assert await readall(reader_a) == [":localhost CAP * LS :" + " ".join(irc.get_capabilities())]
+
+        async with connect() as (reader_b, writer_b):
+            writer_b.write(b"\r\n\xff\r\n")
+            await asyncio.sleep(.1)
+        await asyncio.sleep(.1)
+        assert unregistered.collect() == 1
+        assert irc.clones.addresses["127.0.0.1"] == 1
+
+        async with connect() as (reader_b, writer_b):
+            await ident(reader_b, writer_b, irc, "bar")
+
+
+@pytest.mark.asyncio
+async def test_clone_release_once():
+    irc = IRC(HOST)
+    server = Server(irc)
+    assert irc.clones.admit("127.0.0.1") and irc.clones.admit("127.0.0.1")
+    client = Client("127.0.0.1", "localhost")
+    client.counted = True
+
+    writer = mock.Mock()
+    writer.is_closing.return_value = True
+    await server._drop_client(client, writer)
+    await server._drop_client(client, writer)
+    assert irc.clones.addresses["127.0.0.1"] == 1
+
+
+@pytest.mark.asyncio
+async def test_line_limits():
+    assert truncate("abc", 2) == "ab"
+    assert truncate("\u00e9" * 300, 511) == "\u00e9" * 255
+    assert truncate("\u20ac" * 4, 11) == "\u20ac" * 3
+    assert join_tags(["a=" + "x" * 8000, "b=" + "y" * 500, "c=z"]) == "a=" + "x" * 8000 + ";c=z"
+
+    assert not too_long(b"x" * (MESSAGE_LIMIT - 2) + b"\r\n")
+    assert too_long(b"x" * (MESSAGE_LIMIT - 1) + b"\r\n")
+    assert not too_long(b"@" + b"t" * (TAGS_LIMIT - 2) + b" PING :x\r\n")
+    assert too_long(b"@" + b"t" * (TAGS_LIMIT - 1) + b" PING :x\r\n")
+
+    async with server_conn() as (irc, reader_a, writer_a), connect() as (reader_b, writer_b):
+        await ident(reader_a, writer_a, irc, "foo")
+        await ident(reader_b, writer_b, irc, "bar")
+
+        await send(writer_a, ["PRIVMSG bar :" + "x" * 100000, "@" + "t" * TAGS_LIMIT + " PING :x",
+                              "PRIVMSG bar :" + "y" * 600, "PING :still here"])
+        # the PONG is in the control lane and can overtake the 417s
+        assert sorted(await readall(reader_a)) == [":localhost 417 foo :Input line was too long"] * 3 + [
+            "PONG :still here"]
+        assert await readall(reader_b) == []
+
+        text = "\u00e9" * 248
+        await send(writer_a, ["PRIVMSG bar :" + text])
+        line = (await reader_b.readline())
+        assert len(line) == MESSAGE_LIMIT
+        assert line.decode() == ":foo!foo@localhost PRIVMSG bar :" + text[:239] + "\r\n"
+
+
+@pytest.mark.asyncio
+async def test_oper():
+    async with server_conn(opers=["admin"]) as (irc, reader_a, writer_a), connect() as (reader_b, writer_b):
+        irc.accounts.register("admin", "sekret", iterations=4096)
+        await ident(reader_a, writer_a, irc, "foo")
+
+        await send(writer_a, ["OPER nobody sekret", "OPER admin wrong"])
+        assert await readall(reader_a) == [
+            ":localhost 491 foo :No O-lines for your host",
+            ":localhost 464 foo :Password incorrect",
+        ]
+        await send(writer_a, ["WALLOPS :hello"])
+        assert await readall(reader_a) == [":localhost 481 foo :Permission Denied- You're not an IRC operator"]
+
+        await send(writer_a, ["OPER admin sekret"])
+        assert await readall(reader_a) == [
+            ":localhost 381 foo :You are now an IRC operator",
+            ":foo!foo@localhost MODE foo :+o",
+            ":localhost NOTICE foo :*** foo!foo@localhost is now an operator",
+        ]
+        nickname = irc.get_nickname("foo")
+        assert irc.operators == {nickname}
+        assert irc.notice_subscribers == {nickname}
+
+        await ident(reader_b, writer_b, irc, "bar")
+        assert await readall(reader_a) == [":localhost NOTICE foo :*** Client connecting: bar!bar@localhost [127.0.0.1]"]
+
+        await send(writer_b, ["MODE bar +w", "WALLOPS :hello"])
+        assert await readall(reader_b) == [
+            ":bar!bar@localhost MODE bar :+w",
+            ":localhost 481 bar :Permission Denied- You're not an IRC operator",
+        ]
+        assert irc.wallops == {irc.get_nickname("bar")}
+
+        await send(writer_a, ["WALLOPS :hello"])
+        assert await readall(reader_b) == [":foo!foo@localhost WALLOPS :hello"]
+        assert await readall(reader_a) == []
+
+        # without +s operators get no notices
+        await send(writer_a, ["MODE foo -s"])
+        await readall(reader_a)
+        assert irc.notice_subscribers == set()
+        await send(writer_b, ["QUIT :bye"])
+        await readall(reader_b)
+        assert await readall(reader_a) == []
+        assert irc.wallops == set()
+
+        await send(writer_a, ["MODE foo +s"])
+        await readall(reader_a)
+        irc.server_notice("hello")
+        assert await readall(reader_a) == [":localhost NOTICE foo :*** hello"]
+
+        await send(writer_a, ["QUIT"])
+        await readall(reader_a)
+        assert irc.notice_subscribers == set()
+
+    msg = IRCMessage.server_notice(HOST, "foo", "hello")
+    assert msg.encode(with_tags=True) is msg.encode(with_tags=True)
+    assert msg.encode() == b":localhost NOTICE foo :*** hello\r\n"
+
+
+@pytest.mark.asyncio
+async def test_filter_rules():
+    rules = parse_rules([
+        "# comment",
+        "tag literal he",
+        "tag literal she",
+        "block literal hers",
+        "kill url *.evil.example/*",
+        "block regex fr[e3]{2} +b[i1]tc[o0]in",
+        "block regex (",
+        "explode literal boom",
+    ])
+    assert [rule.name for rule in rules] == ["2", "3", "4", "5", "6"]
+
+    content_filter = Filter(rules=rules)
+    assert sorted(rule.pattern for rule in content_filter.automaton.search("uSHErs")) == ["he", "hers", "she"]
+    assert content_filter.scan("ushers").action == "block"
+    assert content_filter.scan("she said").action == "tag"
+    assert content_filter.scan("see https://www.evil.example/x").name == "5"
+    assert content_filter.scan("FR33   bitcoin").name == "6"
+    assert content_filter.scan("nothing to see") is None
+    # url and regex rules share one combined regex
+    assert sorted(rule.name for rule in content_filter.groups.values()) == ["5", "6"]
+
+    # inline flags and backreferences only work in a pattern of their own
+    content_filter = Filter(rules=parse_rules(["tag regex (?i)spam", "block regex (a)\\1", "tag literal hers"]))
+    assert content_filter.scan("SPAM").name == "1"
+    assert content_filter.scan("abab") is None
+    assert content_filter.scan("baa").name == "2"
+    assert not content_filter.groups
+
+    # a less severe match overlapping a more severe one doesn't hide it
+    content_filter = Filter(rules=parse_rules(["tag regex buy \\w+", "kill regex cheap pills", "tag literal buy"]))
+    assert content_filter.scan("buy cheap pills").action == "kill"
+    assert content_filter.scan("buy cheap").action == "tag"
+
+    content_filter = Filter(rules=rules)
+    msg = IRCMessage.parse("PRIVMSG #c :ushers")
+    assert content_filter.check(msg).name == "4"
+
+    # clean text takes one pass of the combined regex, the per severity ones aren't run
+    content_filter = Filter(rules=parse_rules(["tag regex foo", "kill regex bar", "block regex baz"]))
+    content_filter.levels = [(severity, mock.Mock(wraps=regex), separate)
+                             for severity, regex, separate in content_filter.levels]
+    assert content_filter.scan("nothing to see") is None
+    assert not any(regex.search.called for _, regex, _ in content_filter.levels)
+    assert content_filter.scan("foo bar baz").action == "kill"
+
+    content_filter.set_rules([])
+    assert content_filter.check(msg) is None
+
+
+@pytest.mark.asyncio
+async def test_filter(tmp_path):
+    path = tmp_path / "filters"
+    path.write_text("block literal buy cheap\ntag regex https?://\\S+\\.ru\\b\n")
+
+    async with server_conn(filter=Filter(str(path))) as (irc, reader_a, writer_a), \
+            connect() as (reader_b, writer_b):
+        await ident(reader_a, writer_a, irc, "foo")
+        await join(reader_a, writer_a, irc, "foo", "#")
+        await ident(reader_b, writer_b, irc, "bar")
+        await send(writer_b, ["CAP REQ :message-tags"])
+        assert await readall(reader_b) == [":localhost CAP bar ACK :message-tags"]
+        await join(reader_b, writer_b, irc, "bar", "#")
+        await readall(reader_a)
+        await readall(reader_b)
+
+        await send(writer_a, ["PRIVMSG # :BUY CHEAP watches", "PRIVMSG bar :buy cheap", "PRIVMSG # :see http://x.ru"])
+        assert await readall(reader_a) == [
+            ":localhost NOTICE foo :Message blocked by filter 1",
+            ":localhost NOTICE foo :Message blocked by filter 1",
+        ]
+        assert await readall(reader_b) == ["@ircd/filter=2 :foo!foo@localhost PRIVMSG # :see http://x.ru"]
+
+        await send(writer_a, ["REHASH"])
+        assert await readall(reader_a) == [":localhost 481 foo :Permission Denied- You're not an IRC operator"]
+
+        path.write_text("kill literal buy cheap\n")
+        irc.get_nickname("foo").set_mode("o")
+        await send(writer_a, ["REHASH"])
+        assert await readall(reader_a) == [":localhost 382 foo {} :Rehashing".format(path)]
+
+        await send(writer_b, ["PRIVMSG # :see http://x.ru", "PRIVMSG # :buy cheap"])
+        # notices are in the direct lane, ahead of the channel traffic
+        assert await readall(reader_a) == [
+            ":localhost NOTICE foo :*** Filter 1 (kill) matched message from bar!bar@localhost",
+            ":localhost NOTICE foo :*** Client exiting: bar!bar@localhost [Killed (filtered)]",
+            ":bar!bar@localhost PRIVMSG # :see http://x.ru",
+            ":bar!bar@localhost PART :#",
+        ]
+        assert await readall(reader_b) == ["ERROR :Closing Link: localhost (Killed (filtered))"]
+
+
+@pytest.mark.asyncio
+async def test_watchdog():
+    irc = IRC(HOST)
+    server = Server(irc)
+    watchdog = Watchdog(server, threshold=.05, interval=.01)
+    watchdog.start()
+
+    def _blocking_list(client, msg):
+        time.sleep(.3)
+
+    with mock.patch.object(irc, "process", _blocking_list):
+        server._process(Client("a", "a"), IRCMessage.parse("LIST"))
+    await asyncio.sleep(.1)
+    watchdog.stop()
+
+    assert "processing IRCMessage<command=LIST" in watchdog.last_report
+    assert "_blocking_list" in watchdog.last_report
+    assert irc.metrics.get("ircd_loop_stalls_total").value == 1
+    assert .2 < irc.metrics.get("ircd_loop_stall_seconds").sum < 1
+
+
 @pytest.mark.asyncio
 async def test_server():
     async with server_conn() as (irc, reader, writer):
@@ -743,7 +1960,7 @@ async def test_capabilities():
         resp = await readall(reader)
         print(resp)
         assert resp == [
-            ':localhost CAP * LS :message-tags server-time message-ids sasl',
+            ':localhost CAP * LS :message-tags server-time message-ids sasl batch draft/chathistory',
             ':localhost CAP * NAK :foo bar baz',
         ]
         await ident(reader, writer, irc, "foo")
@@ -925,6 +2142,7 @@ async def test_sasl():
     bad_pass = base64.b64encode(b"qux \x00 qux \x00 qux ")
 
     async with server_conn() as (irc, reader_a, writer_a), connect() as (reader_b, writer_b):
+        irc.accounts.register("bar", "baz", iterations=4096)
 
         await send(writer_a, [
             "CAP REQ :sasl",
@@ -993,6 +2211,155 @@ async def test_sasl():
             ':localhost 904 * :SASL authentication failed',
         ]
 
+        # one verification in flight per client, and no more than max_pending across the server
+        irc.accounts.register("qux", "quux")
+        good_pass = base64.b64encode(b"qux\x00qux\x00quux").decode()
+        await send(writer_b, [
+            "AUTHENTICATE " + good_pass,
+            "AUTHENTICATE " + good_pass,
+        ])
+        resp = await readall(reader_b)
+        print(resp)
+        assert resp == [
+            ':localhost 904 * :SASL authentication failed',
+            ':localhost 900 * :you are now logged in',
+            ':localhost 903 * :SASL authentication successful'
+        ]
+        assert irc.accounts.pending == 0
+
+        irc.accounts.register("qux", "quux", iterations=4096)
+        irc.accounts.max_pending = 0
+        await send(writer_b, [
+            "AUTHENTICATE " + good_pass,
+        ])
+        resp = await readall(reader_b)
+        print(resp)
+        assert resp == [
+            ':localhost 904 * :SASL authentication failed',
+        ]
+        assert irc.verifications_refused.value == 2
+
+
+@pytest.mark.asyncio
+async def test_verify_cache():
+    accounts = AccountStore(cache_ttl=60)
+    accounts.register("bar", "baz", iterations=4096)
+
+    async def verify(password):
+        future = asyncio.get_running_loop().create_future()
+        assert accounts.verify_async("bar", password, future.set_result)
+        return await future
+
+    assert await verify("baz")
+    # changed elsewhere, e.g. by another process sharing the database
+    accounts.set("bar", Credentials.create("qux", iterations=4096))
+    assert await verify("baz")
+    with mock.patch("ircd.accounts.time.monotonic", return_value=time.monotonic() + 61):
+        assert not await verify("baz")
+        assert await verify("qux")
+    accounts.close()
+
+
+def scram_proof(password, server_first, client_first_bare, client_final_bare):
+    attributes = dict(part.split("=", 1) for part in server_first.split(","))
+    salted = Credentials.salted_password(password, base64.b64decode(attributes["s"]), int(attributes["i"]))
+    client_key = hmac.new(salted, b"Client Key", hashlib.sha256).digest()
+    auth_message = ",".join([client_first_bare, server_first, client_final_bare]).encode()
+    signature = hmac.new(hashlib.sha256(client_key).digest(), auth_message, hashlib.sha256).digest()
+    return base64.b64encode(bytes(x ^ y for x, y in zip(client_key, signature))).decode()
+
+
+@pytest.mark.asyncio
+async def test_sasl_scram(tmp_path):
+    accounts = SQLiteAccountStore(str(tmp_path / "accounts.db"))
+    accounts.register("bar", "baz", iterations=4096)
+    assert len(accounts) == 1
+
+    def b64(s):
+        return base64.b64encode(s.encode()).decode()
+
+    async with server_conn(accounts=accounts) as (irc, reader, writer):
+        await send(writer, [
+            "CAP REQ :sasl",
+            "AUTHENTICATE DIGEST-MD5",
+            "AUTHENTICATE SCRAM-SHA-256",
+        ])
+        resp = await readall(reader)
+        print(resp)
+        assert resp == [
+            ':localhost CAP * ACK :sasl',
+            ':localhost 908 * PLAIN,SCRAM-SHA-256 :are available sasl mechanisms',
+            ':localhost AUTHENTICATE +',
+        ]
+
+        client_first_bare = "n=bar,r=clientnonce"
+        await send(writer, [
+            "AUTHENTICATE " + b64("n,," + client_first_bare),
+        ])
+        resp = await readall(reader)
+        print(resp)
+        server_first = base64.b64decode(resp[0].split(":", 2)[2]).decode()
+        assert server_first.startswith("r=clientnonce")
+        assert server_first.endswith(",i=4096")
+
+        client_final_bare = "c=" + b64("n,,") + "," + server_first.split(",")[0]
+        proof = scram_proof("baz", server_first, client_first_bare, client_final_bare)
+        await send(writer, [
+            "AUTHENTICATE " + b64(client_final_bare + ",p=" + proof),
+        ])
+        resp = await readall(reader)
+        print(resp)
+        assert base64.b64decode(resp[0].split(":", 2)[2]).startswith(b"v=")
+
+        await send(writer, [
+            "AUTHENTICATE +",
+        ])
+        resp = await readall(reader)
+        print(resp)
+        assert resp == [
+            ':localhost 900 * :you are now logged in',
+            ':localhost 903 * :SASL authentication successful'
+        ]
+
+        # a wrong password fails the proof, abort resets the exchange
+        await send(writer, [
+            "AUTHENTICATE SCRAM-SHA-256",
+            "AUTHENTICATE " + b64("n,," + client_first_bare),
+        ])
+        resp = await readall(reader)
+        server_first = base64.b64decode(resp[1].split(":", 2)[2]).decode()
+        client_final_bare = "c=" + b64("n,,") + "," + server_first.split(",")[0]
+        proof = scram_proof("qux", server_first, client_first_bare, client_final_bare)
+        await send(writer, [
+            "AUTHENTICATE " + b64(client_final_bare + ",p=" + proof),
+            "AUTHENTICATE SCRAM-SHA-256",
+            "AUTHENTICATE *",
+        ])
+        resp = await readall(reader)
+        print(resp)
+        assert resp == [
+            ':localhost 904 * :SASL authentication failed',
+            ':localhost AUTHENTICATE +',
+            ':localhost 906 * :SASL authentication aborted',
+        ]
+
+        # account lookups are held to the same limit as verifications
+        irc.accounts.max_pending = 0
+        async with connect() as (reader_b, writer_b):
+            await send(writer_b, [
+                "CAP REQ :sasl",
+                "AUTHENTICATE SCRAM-SHA-256",
+                "AUTHENTICATE " + b64("n,," + client_first_bare),
+            ])
+            assert await readall(reader_b) == [
+                ':localhost CAP * ACK :sasl',
+                ':localhost AUTHENTICATE +',
+                ':localhost 904 * :SASL authentication failed',
+            ]
+        assert not accounts.get_async("bar", mock.Mock())
+        assert accounts.pending == 0
+
+
 @pytest.mark.asyncio
 async def test_message_ids():
     async with server_conn() as (irc, reader, writer):